@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import platform
+import argparse
+import statistics
+import numpy as np
+import policy_op
+import policy_check
+import json_handle
+import candidate_store
+import policy_types
+import policy_array
+import mutation
+from fitness_cache import policy_set_key
+from deap import base, creator, tools
+
+""" Micro-benchmarks of the policy_op, policy_check and json_handle hot paths.
+
+        python benchmark.py run [--sizes 100 1000 ...] [--output FILE]
+        python benchmark.py compare BASELINE CURRENT [--threshold 0.1]
+
+        Every benchmark builds its input for n items (individuals or policies) with a fixed
+        seed, then times the operation repeat times and keeps the best and the median time.
+        Inputs are built outside the timed part, operations which change their input get
+        a fresh copy for every repetition. A benchmark may also return a cleanup function,
+        which is called after its repetitions.
+        compare reports the time per item of every (benchmark, size) and exits with 1 if
+        one is slower than the baseline by more than the threshold.
+"""
+
+BENCH_FILE = './json/benchmark.json'
+BENCH_SIZES = (100, 1000, 10000, 100000)
+BENCH_SEED = 12345
+BENCH_DIR = './json/candidates/'
+
+if not hasattr(creator, "FitnessMax"):
+    creator.create("FitnessMax", base.Fitness, weights=(1.0,))
+if not hasattr(creator, "Individual"):
+    creator.create("Individual", list, fitness=creator.FitnessMax)
+
+toolbox = base.Toolbox()
+
+
+def policies(n):
+    return [policy_op.sample_policy() for i in range(0, n)]
+
+
+def individuals_multi(n):
+    return [creator.Individual(policy_op.gen_individual_multi()) for i in range(0, n)]
+
+
+def individuals_variable(n):
+    # the "individual" of main.py: 2 to 50 policies
+    return [creator.Individual(policy_op.gen_individual(random.randint(2, 50))) for i in range(0, n)]
+
+
+def copy_sets(sets):
+    return [[list(policy) for policy in policy_set] for policy_set in sets]
+
+
+def bench_gen_individual(n):
+    return None, lambda data: [policy_op.gen_individual(random.randint(2, 50)) for i in range(0, n)]
+
+
+def bench_gen_individual_ack(n):
+    return None, lambda data: [policy_op.gen_individual_ack() for i in range(0, n)]
+
+
+def bench_gen_individual_multi(n):
+    return None, lambda data: [policy_op.gen_individual_multi() for i in range(0, n)]
+
+
+def bench_gen_individual_directed(n):
+    return None, lambda data: [policy_op.gen_individual_directed() for i in range(0, n)]
+
+
+def bench_gen_policy(n):
+    return None, lambda data: [policy_op.gen_policy() for i in range(0, n)]
+
+
+def bench_mut_policy(n):
+    sets = [policy_op.gen_individual(random.randint(2, 50)) for i in range(0, n)]
+    return lambda: copy_sets(sets), lambda data: [policy_op.mut_policy(s, 0.5) for s in data]
+
+
+def bench_mut_policy_ack(n):
+    sets = [policy_op.gen_individual_ack() for i in range(0, n)]
+    return lambda: copy_sets(sets), lambda data: [policy_op.mut_policy_ack(s, 0.5) for s in data]
+
+
+def bench_mut_policy_multi(n):
+    sets = [policy_op.gen_individual_multi() for i in range(0, n)]
+    return lambda: copy_sets(sets), lambda data: [policy_op.mut_policy_multi(s, 0.5) for s in data]
+
+
+def bench_mut_policy_directed(n):
+    sets = [policy_op.gen_individual_directed() for i in range(0, n)]
+    return lambda: copy_sets(sets), lambda data: [policy_op.mut_policy_directed(s, 0.5) for s in data]
+
+
+def bench_batch_mutation(type_SoS):
+    def bench(n):
+        skeleton = policy_op.get_skeleton(type_SoS)
+        sets = [skeleton.new_individual() for i in range(0, n)]
+        engine = mutation.BatchMutation(skeleton, type_SoS)
+        return lambda: copy_sets(sets), engine.mutate
+    return bench
+
+
+def bench_batch_mutation_array(n):
+    skeleton = policy_op.get_skeleton("multi")
+    genes = policy_array.SkeletonArray(skeleton).new_population(n)
+    engine = mutation.BatchMutation(skeleton, "multi")
+    return lambda: genes.copy(), engine.mutate_array
+
+
+def bench_mut_by_modify(n):
+    items = policies(n)
+    return lambda: [list(policy) for policy in items], lambda data: [policy_op.mut_by_modify(p) for p in data]
+
+
+def bench_check_policy(n):
+    items = policies(n)
+    return lambda: items, lambda data: [policy_check.check_policy(p) for p in data]
+
+
+def bench_check_policy_batch(n):
+    genes = np.array(policies(n), dtype=np.float64)
+    return lambda: genes, policy_check.check_policy_batch
+
+
+def bench_poli_to_dict(n):
+    items = policies(n)
+    return lambda: items, lambda data: [json_handle.poli_to_dict(p) for p in data]
+
+
+def bench_make_policy_json(n):
+    sets = individuals_variable(n)
+
+    def run(data):
+        for s in data:
+            json_handle.make_policy_json("bench_cand_poli_set.json", s)
+    return lambda: sets, run
+
+
+def bench_candidate_store(n):
+    # every policy set twice, as a population with duplicates: the second put only touches the file
+    sets = individuals_variable(max(1, n // 2))
+    directory = tempfile.TemporaryDirectory(prefix="bench_store_")
+    store = candidate_store.CandidateStore(directory.name, max_age=0, grace=0)
+
+    def prepare():
+        store.gc()
+        return sets + sets
+
+    def run(data):
+        for s in data:
+            key, path = store.put(s)
+            store.release(key)
+    return prepare, run, directory.cleanup
+
+
+def bench_read_policy(n):
+    filename = "bench_read_policy.json"
+    json_handle.make_policy_json(filename, policies(n))
+    path = os.path.join(BENCH_DIR, filename)
+    return lambda: path, json_handle.read_policy
+
+
+def bench_deap_clone(n):
+    sets = individuals_multi(n)
+    return lambda: sets, lambda data: [toolbox.clone(ind) for ind in data]
+
+
+def bench_policy_set_key(n):
+    sets = individuals_multi(n)
+    return lambda: sets, lambda data: len(set(policy_set_key(ind) for ind in data))
+
+
+def bench_freeze_policy_set(n):
+    sets = individuals_multi(n)
+    return lambda: sets, lambda data: len(set(policy_types.freeze(ind) for ind in data))
+
+
+def bench_deap_crossover(n):
+    sets = individuals_multi(n)
+
+    def run(data):
+        for child1, child2 in zip(data[::2], data[1::2]):
+            tools.cxTwoPoint(child1, child2)
+    return lambda: [creator.Individual(policy_set) for policy_set in copy_sets(sets)], run
+
+
+benchmarks = {
+    "gen_individual": bench_gen_individual,
+    "gen_individual_ack": bench_gen_individual_ack,
+    "gen_individual_multi": bench_gen_individual_multi,
+    "gen_individual_directed": bench_gen_individual_directed,
+    "gen_policy": bench_gen_policy,
+    "mut_policy": bench_mut_policy,
+    "mut_policy_ack": bench_mut_policy_ack,
+    "mut_policy_multi": bench_mut_policy_multi,
+    "mut_policy_directed": bench_mut_policy_directed,
+    "batch_mutation_ack": bench_batch_mutation("A"),
+    "batch_mutation_multi": bench_batch_mutation("multi"),
+    "batch_mutation_directed": bench_batch_mutation("D"),
+    "batch_mutation_array": bench_batch_mutation_array,
+    "mut_by_modify": bench_mut_by_modify,
+    "check_policy": bench_check_policy,
+    "check_policy_batch": bench_check_policy_batch,
+    "poli_to_dict": bench_poli_to_dict,
+    "make_policy_json": bench_make_policy_json,
+    "candidate_store": bench_candidate_store,
+    "read_policy": bench_read_policy,
+    "deap_clone": bench_deap_clone,
+    "policy_set_key": bench_policy_set_key,
+    "freeze_policy_set": bench_freeze_policy_set,
+    "deap_crossover": bench_deap_crossover,
+}
+
+
+def run_benchmark(name, n, repeat=3, seed=BENCH_SEED):
+    random.seed(seed)
+    np.random.seed(seed)
+    setup = benchmarks[name](n)
+    prepare, func = setup[0:2]
+    times = list()
+    try:
+        for i in range(0, repeat):
+            data = prepare() if prepare is not None else None
+            random.seed(seed + i)
+            start = time.perf_counter()
+            func(data)
+            times.append(time.perf_counter() - start)
+    finally:
+        if len(setup) > 2:
+            setup[2]()
+    return {"best": min(times), "median": statistics.median(times), "per_item": min(times) / n, "repeat": repeat}
+
+
+def run_all(names, sizes, repeat=3, seed=BENCH_SEED, max_seconds=None):
+    results = dict()
+    for name in names:
+        results[name] = dict()
+        for n in sizes:
+            result = run_benchmark(name, n, repeat, seed)
+            results[name][str(n)] = result
+            print("%-24s n=%-7d best %10.6f s  per item %10.3f us" % (name, n, result["best"], result["per_item"] * 1e6))
+            if max_seconds is not None and result["best"] > max_seconds:
+                print("%-24s skipping larger sizes" % name)
+                break
+    for filename in ("bench_cand_poli_set.json", "bench_read_policy.json"):
+        if os.path.exists(os.path.join(BENCH_DIR, filename)):
+            os.remove(os.path.join(BENCH_DIR, filename))
+    return {"python": platform.python_version(), "platform": platform.platform(), "seed": seed,
+            "repeat": repeat, "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+
+
+def compare(baseline, current, threshold=0.1):
+    # (name, size, baseline per item, current per item, ratio) of every common measurement
+    rows = list()
+    for name, sizes in sorted(current["results"].items()):
+        for size, result in sorted(sizes.items(), key=lambda item: int(item[0])):
+            base_result = baseline["results"].get(name, {}).get(size)
+            if base_result is None:
+                continue
+            ratio = result["per_item"] / base_result["per_item"]
+            rows.append((name, int(size), base_result["per_item"], result["per_item"], ratio))
+    regressions = [row for row in rows if row[4] > 1.0 + threshold]
+    return rows, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="run the benchmarks and save the results")
+    run_parser.add_argument("names", nargs="*", default=None, help="benchmarks to run (default: all)")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=list(BENCH_SIZES))
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--seed", type=int, default=BENCH_SEED)
+    run_parser.add_argument("--max-seconds", type=float, default=None,
+                            help="skip the larger sizes of a benchmark once one run takes longer")
+    run_parser.add_argument("--output", default=BENCH_FILE, help="result file (default: %(default)s)")
+    compare_parser = commands.add_parser("compare", help="compare results with a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current", nargs="?", default=BENCH_FILE)
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="allowed slowdown per item, 0.1 = 10%% (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        names = args.names or list(benchmarks)
+        for name in names:
+            if name not in benchmarks:
+                parser.error("unknown benchmark: " + name)
+        report = run_all(names, args.sizes, args.repeat, args.seed, args.max_seconds)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Results saved to", args.output)
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows, regressions = compare(baseline, current, args.threshold)
+        for name, size, base_time, cur_time, ratio in rows:
+            flag = "REGRESSION" if ratio > 1.0 + args.threshold else ""
+            print("%-24s n=%-7d %10.3f us -> %10.3f us  x%.2f %s" % (name, size, base_time * 1e6, cur_time * 1e6,
+                                                                   ratio, flag))
+        print(len(regressions), "regression(s) of", len(rows), "measurements")
+        sys.exit(1 if regressions else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,403 @@
+import os
+import hmac
+import json
+import time
+import socket
+import argparse
+import threading
+import ipaddress
+import socketserver
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from fitness_cache import policy_set_key
+from sim_worker import SimulatorError, SimulatorPool
+from racing import SimFitness
+from metrics import metrics
+
+""" Job broker for distributed evaluation.
+
+        The GA process runs a Broker (a TCP server) and uses Broker.evaluate / Broker.map like
+        SimulatorPool. Workers on any host connect to it, pull jobs, simulate them locally and
+        send the fitness back:
+            python broker.py worker HOST:PORT [--sim-worker CMD] [--token TOKEN]
+        ------------------------------------------------------------------------
+        One JSON message per line in both directions.
+        worker -> broker   {"type": "hello", "worker": "host:pid", "token": "..."}
+                           {"type": "get"}                          ask for a job
+                           {"type": "heartbeat"}                    while simulating
+                           {"type": "result", "id": 3, "fitness": 63.2, "n_simulation": 50, "variance": 4.1}
+                           {"type": "error", "id": 3, "error": "message"}
+        broker -> worker   {"type": "job", "id": 3, "policies": [...], "n_simulation": 50}
+                           {"type": "wait"}                         no job yet, ask again
+        ------------------------------------------------------------------------
+        A worker which closes the connection or is silent for longer than heartbeat_timeout
+        is dropped and its job is queued again; a job which failed or lost its worker
+        max_attempts times fails with SimulatorError. Identical candidates (same policies and
+        n_simulation) which are in flight at the same time are simulated only once.
+        The broker listens on 127.0.0.1 by default. On any other interface a shared token is
+        required: a connection is served only after a hello message with that token.
+"""
+
+BROKER_PORT = 5701
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_TIMEOUT = 30.0
+BROKER_TOKEN_ENV = "SOSPS_BROKER_TOKEN"     # default token of the broker and the workers
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class Job:
+    def __init__(self, job_id, key, message):
+        self.id = job_id
+        self.key = key
+        self.message = message
+        self.future = Future()
+        self.worker = None      # connection which runs the job
+        self.attempts = 0
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    # one connection of a worker
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.name = "%s:%d" % self.client_address
+        if self.server.broker.token is None:
+            self.server.broker.connected(self)
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        broker = self.server.broker
+        for line in self.rfile:
+            message = json.loads(line.decode('utf-8'))
+            kind = message.get("type")
+            if kind == "hello":
+                self.name = message.get("worker", self.name)
+                if not broker.authenticate(self, message.get("token")):
+                    print("Worker", self.name, "rejected: wrong token")
+                    break
+            if not broker.seen(self):
+                break   # dropped as dead meanwhile, or not authenticated
+            if kind == "get":
+                job = broker.next_job(self)
+                self.send(job.message if job is not None else {"type": "wait"})
+            elif kind == "result":
+                broker.finished(self, message["id"], fitness=SimFitness((float(message["fitness"]),),
+                                                                        message.get("n_simulation", 0),
+                                                                        message.get("variance")))
+            elif kind == "error":
+                broker.finished(self, message["id"], error=message["error"])
+
+    def finish(self):
+        self.server.broker.disconnected(self)
+        try:
+            socketserver.StreamRequestHandler.finish(self)
+        except OSError:
+            pass
+
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Broker:
+    def __init__(self, host="127.0.0.1", port=BROKER_PORT, n_simulation=50, n_threads=64,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT, max_attempts=3, token=None):
+        if token is None and not is_loopback(host):
+            raise ValueError("A broker listening on " + str(host) + " needs a token (--broker-token or "
+                             + BROKER_TOKEN_ENV + ")")
+        self.token = token
+        self.n_simulation = n_simulation
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.lock = threading.Condition()
+        self.queue = deque()        # ids of the jobs waiting for a worker
+        self.jobs = dict()          # id -> Job, until it is finished
+        self.in_flight = dict()     # key -> Job, for deduplication
+        self.workers = dict()       # handler -> time of the last message
+        self.next_id = 1
+        self.requeued = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.running = True
+
+        self.server = BrokerServer((host, port), BrokerHandler)
+        self.server.broker = self
+        self.address = self.server.server_address
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+        self.executor = ThreadPoolExecutor(n_threads)
+
+    # GA side
+    def submit(self, indiv_poli_set, n_simulation=None):
+        if n_simulation is None:
+            n_simulation = self.n_simulation
+        policies = [list(policy) for policy in indiv_poli_set]
+        key = policy_set_key(policies) + ":" + str(n_simulation)
+        with self.lock:
+            job = self.in_flight.get(key)
+            if job is not None:
+                self.deduplicated += 1
+                return job.future
+            metrics.count("evaluations")
+            metrics.count("replications", n_simulation)
+            job = Job(self.next_id, key, {"type": "job", "id": self.next_id, "policies": policies,
+                                          "n_simulation": n_simulation})
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.in_flight[key] = job
+            self.queue.append(job.id)
+            self.lock.notify()
+        return job.future
+
+    def evaluate(self, indiv_poli_set, file_num=0, gen_num=0, n_simulation=None):
+        # same signature as policy_eval.evaluate, so it can be registered as toolbox.evaluate
+        future = self.submit(indiv_poli_set, n_simulation)
+        with metrics.phase("simulator"):
+            return future.result()
+
+    def map(self, func, *iterables):
+        return list(self.executor.map(func, *iterables))
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            for job in self.jobs.values():
+                if not job.future.done():
+                    job.future.set_exception(SimulatorError("Broker closed"))
+            handlers = list(self.workers)
+            self.lock.notify_all()
+        self.executor.shutdown(wait=False)
+        self.server.shutdown()
+        for handler in handlers:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {"workers": len(self.workers), "queued": len(self.queue), "running": len(self.jobs) - len(self.queue),
+                    "requeued": self.requeued, "failed": self.failed, "deduplicated": self.deduplicated}
+
+    # worker side (called from the connection threads)
+    def authenticate(self, handler, token):
+        # without a token every connection is a worker from the start (see BrokerHandler.setup)
+        if self.token is None:
+            return True
+        if not isinstance(token, str) or not hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8')):
+            return False
+        self.connected(handler)
+        return True
+
+    def connected(self, handler):
+        with self.lock:
+            self.workers[handler] = time.monotonic()
+
+    def seen(self, handler):
+        with self.lock:
+            if handler not in self.workers:
+                return False
+            self.workers[handler] = time.monotonic()
+            return True
+
+    def next_job(self, handler, wait=1.0):
+        # a queued job for this worker, None if there is none within wait seconds
+        with self.lock:
+            deadline = time.monotonic() + wait
+            while self.running and not self.queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+            if not self.running or handler not in self.workers:
+                return None
+            job = self.jobs[self.queue.popleft()]
+            job.worker = handler
+            job.attempts += 1
+            return job
+
+    def finished(self, handler, job_id, fitness=None, error=None):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.worker is not handler:
+                return  # already requeued and finished by another worker
+            if error is None:
+                del self.jobs[job_id]
+                del self.in_flight[job.key]
+            elif self.requeue(job):
+                print("Job", job_id, "failed on", handler.name, "- queued again:", error)
+                return
+        if error is not None:
+            job.future.set_exception(SimulatorError("Simulator error: " + error))
+        else:
+            job.future.set_result(fitness)
+
+    def disconnected(self, handler):
+        with self.lock:
+            failed = self.drop(handler)
+        self.fail(failed)
+
+    def drop(self, handler):
+        # lock held: forget the worker and queue its job again;
+        # returns the jobs out of attempts, to be failed after the lock is released
+        failed = list()
+        if self.workers.pop(handler, None) is None:
+            return failed
+        for job in [job for job in self.jobs.values() if job.worker is handler]:
+            if self.requeue(job):
+                print("Worker", handler.name, "lost, job", job.id, "queued again")
+            else:
+                print("Worker", handler.name, "lost, job", job.id, "failed after", job.attempts, "attempts")
+                failed.append(job)
+        return failed
+
+    def fail(self, jobs):
+        for job in jobs:
+            job.future.set_exception(SimulatorError("Simulator error: job lost its worker " + str(job.attempts)
+                                                    + " times"))
+
+    def requeue(self, job):
+        # lock held: queue the job again, False (and the job is removed) if it used all its attempts
+        if job.attempts >= self.max_attempts:
+            del self.jobs[job.id]
+            del self.in_flight[job.key]
+            self.failed += 1
+            return False
+        job.worker = None
+        self.queue.appendleft(job.id)
+        self.requeued += 1
+        self.lock.notify()
+        return True
+
+    def monitor(self):
+        # drop workers which did not send anything for heartbeat_timeout seconds
+        while self.running:
+            time.sleep(min(1.0, self.heartbeat_timeout / 4))
+            failed = list()
+            with self.lock:
+                now = time.monotonic()
+                dead = [handler for handler, last in self.workers.items() if now - last > self.heartbeat_timeout]
+                for handler in dead:
+                    failed += self.drop(handler)
+            self.fail(failed)
+            for handler in dead:
+                try:
+                    handler.connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def parse_address(address, default_host="127.0.0.1"):
+    host, _, port = address.rpartition(":")
+    return host or default_host, int(port)
+
+
+def run_worker(address, evaluate, heartbeat=HEARTBEAT_INTERVAL, max_jobs=None, token=None):
+    # pull jobs from the broker until it goes away;
+    # evaluate(policies, n_simulation) -> fitness tuple, a SimFitness keeps its replications and variance
+    sock = socket.create_connection(address)
+    rfile = sock.makefile('r', encoding='utf-8')
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            sock.sendall((json.dumps(message) + "\n").encode('utf-8'))
+
+    running = threading.Event()
+
+    def beat():
+        while not running.wait(heartbeat):
+            try:
+                send({"type": "heartbeat"})
+            except OSError:
+                return  # the main loop notices the lost connection
+
+    hello = {"type": "hello", "worker": "%s:%d" % (socket.gethostname(), os.getpid())}
+    if token is not None:
+        hello["token"] = token
+    send(hello)
+    n_jobs = 0
+    try:
+        while max_jobs is None or n_jobs < max_jobs:
+            send({"type": "get"})
+            line = rfile.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            if message["type"] != "job":
+                continue
+
+            running.clear()
+            beater = threading.Thread(target=beat, daemon=True)
+            beater.start()
+            try:
+                fitness = evaluate(message["policies"], message["n_simulation"])
+                response = {"type": "result", "id": message["id"], "fitness": float(fitness[0]),
+                            "n_simulation": getattr(fitness, "n_simulation", message["n_simulation"]),
+                            "variance": getattr(fitness, "variance", None)}
+            except Exception as e:
+                response = {"type": "error", "id": message["id"], "error": str(e)}
+            finally:
+                running.set()
+                beater.join()
+            send(response)
+            n_jobs += 1
+    except (ConnectionError, OSError) as e:
+        print("Broker connection lost:", e)
+    finally:
+        sock.close()
+    return n_jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    worker_parser = commands.add_parser("worker", help="evaluate jobs of a broker")
+    worker_parser.add_argument("address", help="HOST:PORT of the broker")
+    worker_parser.add_argument("--sim-worker", default=None, metavar="CMD",
+                               help="simulate with a long-lived simulator process (default: java per job)")
+    worker_parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL)
+    worker_parser.add_argument("--retry", type=float, default=5.0,
+                               help="seconds between connection attempts (default: %(default)s)")
+    worker_parser.add_argument("--token", default=os.environ.get(BROKER_TOKEN_ENV),
+                               help="token of the broker (default: $" + BROKER_TOKEN_ENV + ")")
+    args = parser.parse_args()
+
+    if args.command != "worker":
+        parser.print_help()
+    else:
+        if args.sim_worker is not None:
+            sim_pool = SimulatorPool(args.sim_worker)
+
+            def simulate(policies, n_simulation):
+                return sim_pool.evaluate(policies, n_simulation=n_simulation)
+        else:
+            import policy_eval
+            policy_eval.init_worker()
+            job_nums = iter(range(0, 1 << 62))
+
+            def simulate(policies, n_simulation):
+                # candidate files of several workers on one host must not collide
+                return policy_eval.evaluate(policies, next(job_nums), "remote" + str(os.getpid()),
+                                            n_simulation=n_simulation)
+
+        address = parse_address(args.address)
+        print(">> Worker for broker", address)
+        while True:
+            try:
+                print(">> Jobs done:", run_worker(address, simulate, args.heartbeat, token=args.token))
+            except OSError as e:
+                print("Cannot connect to broker:", e)
+            time.sleep(args.retry)
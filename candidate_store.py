@@ -0,0 +1,152 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from json_handle import policy_set_json
+from metrics import metrics
+
+""" Content-addressed store of candidate files.
+
+        The simulator reads a policy set from a JSON file. Every distinct policy set is written
+        once as <sha1 of the JSON text>.json and reused by every later evaluation of the same
+        policy set, so nothing has to be cleaned up when a run starts.
+        Files are written atomically (temporary file + rename), so concurrent pool workers can
+        share the store. An entry is referenced while it is simulated (put ... release); gc()
+        removes unreferenced entries older than max_age seconds and, while the store is larger
+        than max_bytes, the least recently used ones. Entries used within the last grace
+        seconds are kept as well, they may be read by the simulator of another process.
+        With tmpfs=True the store lives in /dev/shm (if it exists) instead of on the disk.
+"""
+
+STORE_DIR = './json/candidates'
+TMPFS_DIR = '/dev/shm'
+STORE_MAX_AGE = 24 * 3600.0
+STORE_MAX_BYTES = 256 * 1024 * 1024
+STORE_GRACE = 600.0
+
+entry_name = re.compile(r"^[0-9a-f]{40}\.json$")
+
+
+class CandidateStore:
+    def __init__(self, directory=STORE_DIR, tmpfs=False, max_age=STORE_MAX_AGE, max_bytes=STORE_MAX_BYTES,
+                 grace=STORE_GRACE):
+        if tmpfs and os.path.isdir(TMPFS_DIR):
+            directory = os.path.join(TMPFS_DIR, "sosps-candidates-" + str(os.getuid()))
+        self.directory = os.path.abspath(directory)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.refs = dict()      # key -> number of evaluations using the entry
+        self.entries = dict()   # key -> (size, time of the last use)
+        self.n_bytes = 0
+        self.writes = 0
+        self.reuses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        # entries left by earlier runs (or other processes)
+        with self.lock:
+            self.entries = dict()
+            self.n_bytes = 0
+            for name in os.listdir(self.directory):
+                if not entry_name.match(name):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                self.entries[name[0:40]] = (st.st_size, st.st_mtime)
+                self.n_bytes += st.st_size
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def put(self, policy_set):
+        # (key, path) of the policy set, written if it is not stored yet; release(key) after use
+        text = policy_set_json(policy_set).encode('utf-8')
+        key = hashlib.sha1(text).hexdigest()
+        path = self.path(key)
+        now = time.time()
+        with self.lock:
+            self.refs[key] = self.refs.get(key, 0) + 1
+            known = key in self.entries
+        if known and os.path.exists(path):
+            self.reuses += 1
+            os.utime(path, (now, now))  # the last use decides the age
+        else:
+            with metrics.phase("json_write"):
+                tmp_file = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+                with open(tmp_file, 'wb') as f:
+                    f.write(text)
+                os.replace(tmp_file, path)
+            self.writes += 1
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None:
+                self.n_bytes -= old[0]
+            self.entries[key] = (len(text), now)
+            self.n_bytes += len(text)
+        return key, path
+
+    def release(self, key):
+        with self.lock:
+            n = self.refs.get(key, 0) - 1
+            if n > 0:
+                self.refs[key] = n
+            else:
+                self.refs.pop(key, None)
+
+    def gc(self, now=None):
+        # remove unreferenced entries by age, then by size (oldest first); returns the number removed
+        if now is None:
+            now = time.time()
+        self.scan()
+        with self.lock:
+            removable = sorted((last, key) for key, (size, last) in self.entries.items()
+                               if key not in self.refs and now - last > self.grace)
+            removed = list()
+            n_bytes = self.n_bytes
+            for last, key in removable:
+                if now - last <= self.max_age and (self.max_bytes is None or n_bytes <= self.max_bytes):
+                    break
+                removed.append(key)
+                n_bytes -= self.entries[key][0]
+        n_removed = 0
+        for key in removed:
+            try:
+                os.remove(self.path(key))
+                n_removed += 1
+            except FileNotFoundError:
+                pass    # removed by another process
+            with self.lock:
+                size = self.entries.pop(key, (0, 0))[0]
+                self.n_bytes -= size
+        return n_removed
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.n_bytes, "referenced": len(self.refs),
+                    "writes": self.writes, "reuses": self.reuses}
+
+
+# store of this process, created on first use with store_config
+store = None
+store_config = {"directory": STORE_DIR, "tmpfs": False, "max_age": STORE_MAX_AGE, "max_bytes": STORE_MAX_BYTES,
+                "grace": STORE_GRACE}
+
+
+def configure_store(**config):
+    # change the settings (directory, tmpfs, max_age, max_bytes, grace) of the next store
+    global store
+    store = None
+    store_config.update(config)
+
+
+def get_store():
+    global store
+    if store is None:
+        store = CandidateStore(**store_config)
+    return store
@@ -0,0 +1,82 @@
+import os
+import gzip
+import pickle
+from racing import SimFitness
+
+""" Checkpoints of a generational GA run.
+
+        A checkpoint is a gzip-compressed pickle of plain data (no DEAP or framework classes):
+            type_SoS, generation, phase, population, offspring, best, done, random_state,
+            surrogate, crossover (the state() dicts of Surrogate and AlignedCrossover)
+        Individuals are stored as (policies, fitness values or None, n_simulation, extra), extra
+        holds the replication variance and the parents' fitness of a crossover child.
+        phase "generation": the generation is finished, the run continues with the next one.
+        phase "evaluating": offspring are bred and being evaluated; done maps the cache key
+        of every finished evaluation to its fitness (pack_done), so nothing is simulated twice on resume.
+        This phase is saved only with --checkpoint-evals; otherwise the last checkpoint is the
+        end of the previous generation and the interrupted generation is bred and simulated
+        again (results already in the fitness cache are reused).
+        The file is replaced atomically, a crash while writing keeps the previous checkpoint.
+"""
+
+CHECKPOINT_FILE = './json/checkpoint.pkl.gz'
+CHECKPOINT_VERSION = 2
+# attributes of an individual besides its fitness (main.set_fitness, crossover.AlignedCrossover)
+EXTRA_ATTRIBUTES = ("variance", "cx_parent_fitness")
+
+
+def pack_individuals(individuals):
+    packed = list()
+    for ind in individuals:
+        values = tuple(ind.fitness.values) if ind.fitness.valid else None
+        extra = {name: getattr(ind, name) for name in EXTRA_ATTRIBUTES if getattr(ind, name, None) is not None}
+        packed.append((copy_policies(ind), values, getattr(ind, "n_simulation", None), extra))
+    return packed
+
+
+def copy_policies(ind):
+    # policies which are one list object (the copies of a compliance policy) stay one after pickling
+    copies = dict()
+    return [copies.setdefault(id(policy), list(policy)) for policy in ind]
+
+
+def unpack_individuals(packed, container):
+    individuals = list()
+    for item in packed:
+        policies, values, n_simulation = item[0:3]
+        ind = container(policies)
+        if values is not None:
+            ind.fitness.values = values
+        ind.n_simulation = n_simulation
+        for name, value in (item[3] if len(item) > 3 else {}).items():
+            setattr(ind, name, value)
+        individuals.append(ind)
+    return individuals
+
+
+def pack_done(done):
+    # cache key -> (values, n_simulation, variance); a plain tuple has no replication count
+    return {key: (tuple(fit), getattr(fit, "n_simulation", None), getattr(fit, "variance", None))
+            for key, fit in done.items()}
+
+
+def unpack_done(packed):
+    return {key: tuple(values) if n_simulation is None else SimFitness(values, n_simulation, variance)
+            for key, (values, n_simulation, variance) in packed.items()}
+
+
+def save_checkpoint(filename, state):
+    state = dict(state, version=CHECKPOINT_VERSION)
+    tmp_file = filename + ".tmp"
+    # written after every evaluation with --checkpoint-evals, so speed before size
+    with gzip.open(tmp_file, 'wb', compresslevel=1) as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, filename)
+
+
+def load_checkpoint(filename):
+    with gzip.open(filename, 'rb') as f:
+        state = pickle.load(f)
+    if state.get("version") != CHECKPOINT_VERSION:
+        raise ValueError("Unsupported checkpoint version: " + str(state.get("version")))
+    return state
@@ -0,0 +1,139 @@
+import random
+import numpy as np
+from deap import tools
+from metrics import metrics
+
+""" Gene-aligned crossover for individuals of a fixed skeleton.
+
+        Every individual of the A, D and multi types has the policies of policy_op.Skeleton in
+        the same order, so the free genes of two parents are aligned. Instead of swapping whole
+        policies (tools.cxTwoPoint), the free genes are exchanged in blocks:
+            uniform  every free gene on its own
+            role     all free genes of the policies of one role (RESCUE, TRANSPORT, TREATMENT)
+            action   all free genes of the policies about one action (action and compliance)
+        Every block is exchanged with probability indpb. The masks of a whole batch of pairs are
+        drawn at once, from a generator seeded by random for every batch, so the random state
+        of a checkpoint is enough to continue a run. Only the chosen genes are written, so the
+        gene values keep their types.
+        Individuals of another length (e.g. a previous policy file) fall back to cxTwoPoint.
+        Effectiveness: every child remembers the better fitness of its parents, and observe()
+        counts after the evaluation how many children improved on it.
+"""
+
+CROSSOVER_MODES = ("two_point", "uniform", "role", "action")
+ACTION_GENES = range(6, 15)
+
+
+class AlignedCrossover:
+    def __init__(self, skeleton, mode="uniform", indpb=0.5, rng=None):
+        if mode not in CROSSOVER_MODES:
+            raise ValueError("Unknown crossover mode: " + str(mode))
+        self.mode = mode
+        self.indpb = indpb
+        self.n_policies = len(skeleton)
+        self.rng = rng      # None: every batch is seeded from random (restored on --resume)
+        free = np.array(skeleton.free_positions, dtype=np.intp).reshape(-1, 2)
+        self.free_policy = free[:, 0]
+        self.free_gene = free[:, 1]
+        self.gene_block, self.n_blocks = self.make_blocks(skeleton)
+
+        self.n_crossovers = 0
+        self.n_swapped = 0      # free genes exchanged
+        self.n_changed = 0      # exchanged genes whose values differed
+        self.n_fallback = 0
+        self.n_evaluated = 0
+        self.n_improved = 0
+        self.gain = 0.0
+
+    def make_blocks(self, skeleton):
+        # block index of every free gene
+        if self.mode == "role":
+            keys = [skeleton.genes[p][5] for p in self.free_policy]
+        elif self.mode == "action":
+            action_of = dict()
+            for p, g in zip(self.free_policy, self.free_gene):
+                if g in ACTION_GENES:
+                    action_of[p] = g    # action policy: its action method is free
+            for p, policy in enumerate(skeleton.genes):
+                for g in ACTION_GENES:
+                    if policy[g] == 0:
+                        action_of[p] = g    # compliance policy: the action is marked with 0
+            keys = [action_of[p] for p in self.free_policy]
+        else:
+            keys = list(range(0, len(self.free_policy)))
+        block_ids = dict()
+        gene_block = np.array([block_ids.setdefault(key, len(block_ids)) for key in keys], dtype=np.intp)
+        return gene_block, len(block_ids)
+
+    def __call__(self, ind1, ind2):
+        self.mate_batch([(ind1, ind2)])
+        return ind1, ind2
+
+    def mate_batch(self, pairs):
+        # crossover of every (ind1, ind2) pair in place
+        pairs = list(pairs)
+        aligned = list()
+        for ind1, ind2 in pairs:
+            self.remember_parents(ind1, ind2)
+            if self.mode == "two_point" or len(ind1) != self.n_policies or len(ind2) != self.n_policies:
+                tools.cxTwoPoint(ind1, ind2)
+                self.n_fallback += self.mode != "two_point"
+            else:
+                aligned.append((ind1, ind2))
+        self.n_crossovers += len(pairs)
+        if not aligned:
+            return pairs
+
+        rng = self.rng if self.rng is not None else np.random.default_rng(random.getrandbits(64))
+        block_mask = rng.random((len(aligned), self.n_blocks)) < self.indpb
+        gene_mask = block_mask[:, self.gene_block]
+        for (ind1, ind2), mask in zip(aligned, gene_mask):
+            idx = np.flatnonzero(mask)
+            for p, g in zip(self.free_policy[idx].tolist(), self.free_gene[idx].tolist()):
+                policy1 = ind1[p]
+                policy2 = ind2[p]
+                if policy1[g] != policy2[g]:
+                    policy1[g], policy2[g] = policy2[g], policy1[g]
+                    self.n_changed += 1
+            self.n_swapped += len(idx)
+        metrics.count("crossover_genes", int(gene_mask.sum()))
+        return pairs
+
+    def remember_parents(self, ind1, ind2):
+        # the better fitness of the parents, compared with the child's fitness by observe()
+        values = [ind.fitness.values[0] for ind in (ind1, ind2) if hasattr(ind, "fitness") and ind.fitness.valid]
+        if values:
+            ind1.cx_parent_fitness = ind2.cx_parent_fitness = max(values)
+
+    def observe(self, individuals):
+        # evaluated children: did the crossover (and the mutation after it) improve on the parents?
+        for ind in individuals:
+            parent_fitness = getattr(ind, "cx_parent_fitness", None)
+            if parent_fitness is None or not ind.fitness.valid:
+                continue
+            del ind.cx_parent_fitness
+            gain = ind.fitness.values[0] - parent_fitness
+            self.n_evaluated += 1
+            self.n_improved += gain > 0
+            self.gain += gain
+
+    def state(self):
+        # the counters as plain data for a checkpoint
+        return {"mode": self.mode, "n_crossovers": self.n_crossovers, "n_swapped": self.n_swapped,
+                "n_changed": self.n_changed, "n_fallback": self.n_fallback, "n_evaluated": self.n_evaluated,
+                "n_improved": self.n_improved, "gain": self.gain}
+
+    def restore(self, state):
+        # continue the counters of a checkpoint, unless it was made with another mode
+        if state.get("mode") != self.mode:
+            return False
+        for name in ("n_crossovers", "n_swapped", "n_changed", "n_fallback", "n_evaluated", "n_improved", "gain"):
+            setattr(self, name, state[name])
+        return True
+
+    def stats(self):
+        return {"mode": self.mode, "crossovers": self.n_crossovers, "fallback": self.n_fallback,
+                "genes_swapped": self.n_swapped, "genes_changed": self.n_changed,
+                "evaluated": self.n_evaluated,
+                "improved": round(self.n_improved / float(self.n_evaluated), 4) if self.n_evaluated else 0.0,
+                "mean_gain": round(self.gain / self.n_evaluated, 4) if self.n_evaluated else 0.0}
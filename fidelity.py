@@ -0,0 +1,101 @@
+import random
+import logging
+import functools
+from racing import SimFitness
+
+""" Multi-fidelity evaluation.
+
+        All candidates of a batch are first simulated with few replications (stages[0]).
+        Only the ones within margin of the best result of the stage are promoted to the next
+        stage, which adds the missing replications (stages[1] - stages[0], ...) and combines
+        them with the ones already run. The last stage is the full evaluation.
+        The fitness is a SimFitness, its n_simulation tells which fidelity produced it.
+        Individuals of a lower fidelity were screened out, so selection ranks them below every
+        individual of a higher fidelity (fidelity_key) instead of comparing the numbers.
+"""
+
+FIDELITY_STAGES = (5, 50)
+
+
+def check_stages(stages):
+    # every stage adds replications: positive and strictly increasing
+    stages = tuple(stages)
+    if not stages or any(type(n) is not int or n < 1 for n in stages):
+        raise ValueError("Fidelity stages must be positive integers: " + str(stages))
+    if any(a >= b for a, b in zip(stages, stages[1:])):
+        raise ValueError("Fidelity stages must be strictly increasing: " + str(stages))
+    return stages
+
+
+class MultiFidelity:
+    def __init__(self, evaluate, stages=FIDELITY_STAGES, margin=5.0):
+        # evaluate: policy_eval.evaluate or SimulatorPool.evaluate (both take n_simulation)
+        self.evaluate = evaluate
+        self.stages = check_stages(stages)
+        self.margin = margin
+        self.n_replications = 0     # replications run so far
+        self.n_candidates = 0       # candidates evaluated so far
+
+    def full(self):
+        return self.stages[-1]
+
+    def is_full(self, fit):
+        return getattr(fit, "n_simulation", None) == self.full()
+
+    def evaluate_batch(self, individuals, gen_num, map=map):
+        # fitness of every individual, running the stages with map (toolbox.map)
+        if not individuals:
+            return []
+        totals = [0.0] * len(individuals)
+        used = [0] * len(individuals)
+        promoted = list(range(0, len(individuals)))
+        self.n_candidates += len(individuals)
+
+        for stage, n_simulation in enumerate(self.stages):
+            if stage > 0:
+                candidates = promoted
+                means = [totals[i] / used[i] for i in candidates]
+                threshold = max(means) - self.margin
+                promoted = [i for i, mean in zip(candidates, means) if mean >= threshold]
+                print(">> Fidelity", self.stages[stage - 1], "->", n_simulation, "promoted", len(promoted),
+                      "of", len(candidates), "(threshold", round(threshold, 3), ")")
+                for i, mean in zip(candidates, means):
+                    logging.info("Generation %d candidate %d: %.4f at n=%d, %s", gen_num, i, mean, used[i],
+                                 "promoted" if mean >= threshold else "not promoted")
+
+            n_new = [n_simulation - used[i] for i in promoted]
+            run = functools.partial(self.evaluate_part, gen_num=gen_num)
+            results = map(run, [individuals[i] for i in promoted], promoted, n_new)
+            for i, n, fit in zip(promoted, n_new, results):
+                totals[i] += fit[0] * n
+                used[i] += n
+                self.n_replications += n
+
+        return [SimFitness((total / n,), n) for total, n in zip(totals, used)]
+
+    def evaluate_part(self, indiv_poli_set, file_num, n_simulation, gen_num=0):
+        return self.evaluate(indiv_poli_set, file_num, gen_num, n_simulation=n_simulation)
+
+    def saving(self):
+        # fraction of the replications saved compared to evaluating everything at full fidelity
+        if self.n_candidates == 0:
+            return 0.0
+        return 1.0 - self.n_replications / float(self.n_candidates * self.full())
+
+
+def fidelity_key(full):
+    # sort key: higher fidelity first, then the fitness; None (no multi-fidelity) counts as full
+    def key(ind):
+        n_simulation = getattr(ind, "n_simulation", None)
+        return (full if n_simulation is None else min(n_simulation, full)), ind.fitness
+    return key
+
+
+def sel_fidelity_tournament(individuals, k, tournsize, full=FIDELITY_STAGES[-1]):
+    # tools.selTournament, aspirants are compared by fidelity_key
+    key = fidelity_key(full)
+    chosen = list()
+    for i in range(0, k):
+        aspirants = [random.choice(individuals) for j in range(0, tournsize)]
+        chosen.append(max(aspirants, key=key))
+    return chosen
@@ -0,0 +1,120 @@
+import json
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from racing import SimFitness
+
+""" Fitness cache for policy sets.
+
+        A policy set is keyed by a hash of its numeric policies, so genotype-identical
+        individuals are simulated only once. Recently used entries are kept in memory (LRU),
+        every entry is also stored in a SQLite file which survives across runs.
+        With min_simulation, a SimFitness of fewer replications (a race stopped early, a low
+        fidelity) is neither stored nor returned, so only full evaluations are reused.
+        Entries of different SoS types share the file but are kept apart by a namespace, as are
+        the results of a simulator other than the default jar (e.g. sim_stub.py).
+"""
+
+CACHE_DB = './json/fitness_cache.db'
+
+
+def policy_set_key(policy_set):
+    # canonical text of the numeric policies; 1 and 1.0 give the same key
+    canonical = json.dumps([[float(v) for v in policy] for policy in policy_set], separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def cache_namespace(type_SoS, simulator=None):
+    # simulator: command of the simulator workers, None for the default jar
+    if simulator is None:
+        return type_SoS
+    if not isinstance(simulator, str):
+        simulator = " ".join(simulator)
+    return type_SoS + "|" + " ".join(simulator.split())
+
+
+def encode_fitness(values):
+    # plain fitness tuples are stored as a list, SimFitness also keeps its replication count
+    if isinstance(values, SimFitness):
+        record = {"values": list(values), "n_simulation": values.n_simulation}
+        if values.variance is not None:
+            record["variance"] = values.variance
+        return json.dumps(record)
+    return json.dumps(list(values))
+
+
+def decode_fitness(text):
+    record = json.loads(text)
+    if isinstance(record, dict):
+        return SimFitness(record["values"], record["n_simulation"], record.get("variance"))
+    return tuple(record)
+
+
+class FitnessCache:
+    def __init__(self, filename=CACHE_DB, namespace="", max_size=10000, min_simulation=None):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.min_simulation = min_simulation
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.partial = 0    # results not stored, too few replications
+
+        self.db = None
+        if filename is not None:
+            self.db = sqlite3.connect(filename)
+            self.db.execute("CREATE TABLE IF NOT EXISTS fitness "
+                            "(namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key))")
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.memory)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.db is not None:
+            row = self.db.execute("SELECT value FROM fitness WHERE namespace=? AND key=?",
+                                  (self.namespace, key)).fetchone()
+            values = None if row is None else decode_fitness(row[0])
+            if values is not None and self.is_full(values):
+                self._remember(key, values)
+                self.hits += 1
+                self.disk_hits += 1
+                return values
+
+        self.misses += 1
+        return None
+
+    def is_full(self, values):
+        # plain fitness tuples come from full evaluations
+        n_simulation = getattr(values, "n_simulation", None)
+        return self.min_simulation is None or n_simulation is None or n_simulation >= self.min_simulation
+
+    def put(self, key, values):
+        if not self.is_full(values):
+            self.partial += 1
+            return
+        self._remember(key, values)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO fitness VALUES (?, ?, ?)",
+                            (self.namespace, key, encode_fitness(values)))
+            self.db.commit()
+
+    def _remember(self, key, values):
+        self.memory[key] = values
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "partial": self.partial}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,114 @@
+import os
+import copy
+import heapq
+import itertools
+from operator import attrgetter
+from policy_types import freeze
+from racing import RunningStats
+
+""" Bounded hall of fame and streaming generation statistics.
+
+        HallOfFame keeps clones of the K best individuals seen so far in a min-heap, so the
+        worst member is replaced in O(log K) and nothing is sorted per generation.
+        Individuals are unique by genotype (a policy_types.PolicySet, hashed once).
+        GenerationLog writes one line per generation (min/mean/max/std of the fitness,
+        unique genotypes, evaluations, best so far), computed in one pass over the population.
+"""
+
+GENERATION_LOG = './json/generations.log'
+
+
+class HallOfFame:
+    def __init__(self, maxsize=10, key=attrgetter("fitness"), clone=copy.deepcopy):
+        self.maxsize = maxsize
+        self.key = key
+        self.clone = clone
+        self.heap = list()      # (key, counter, genotype, individual), worst member at heap[0]
+        self.genotypes = set()
+        self.counter = itertools.count()
+        self.top = None         # best entry
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def __getitem__(self, idx):
+        if idx == 0 and self.top is not None:
+            return self.top[3]
+        return self.items()[idx]
+
+    def items(self):
+        # members, best first (sorts K entries)
+        return [entry[3] for entry in sorted(self.heap, key=lambda entry: entry[0:2], reverse=True)]
+
+    def best(self):
+        return self.top[3] if self.top is not None else None
+
+    def update(self, individuals):
+        # returns the number of individuals which entered
+        n_entered = 0
+        for ind in individuals:
+            if not ind.fitness.valid:
+                continue
+            key = self.key(ind)
+            if len(self.heap) == self.maxsize and not key > self.heap[0][0]:
+                continue
+            genotype = freeze(ind)
+            if genotype in self.genotypes:
+                continue
+
+            member = self.clone(ind)
+            key = self.key(member)  # the key of ind may change when ind is mutated later
+            entry = (key, next(self.counter), genotype, member)
+            if len(self.heap) < self.maxsize:
+                heapq.heappush(self.heap, entry)
+            else:
+                removed = heapq.heapreplace(self.heap, entry)
+                self.genotypes.discard(removed[2])
+            self.genotypes.add(genotype)
+            if self.top is None or key > self.top[0]:
+                self.top = entry
+            n_entered += 1
+        return n_entered
+
+
+def generation_stats(individuals):
+    # one pass: fitness statistics and number of unique genotypes
+    stats = RunningStats()
+    low = float('inf')
+    high = float('-inf')
+    genotypes = set()
+    for ind in individuals:
+        genotypes.add(freeze(ind))
+        if ind.fitness.valid:
+            value = ind.fitness.values[0]
+            stats.add(value)
+            low = min(low, value)
+            high = max(high, value)
+    std = stats.variance() ** 0.5 if stats.n > 1 else 0.0
+    return {"size": len(individuals), "evaluated": stats.n, "min": low, "mean": stats.mean, "max": high,
+            "std": std, "unique": len(genotypes)}
+
+
+class GenerationLog:
+    def __init__(self, filename=GENERATION_LOG, append=False):
+        self.filename = filename
+        self.n_evals = 0
+        if filename is not None and (not append or not os.path.exists(filename)):
+            with open(filename, 'w') as f:
+                f.write("gen\tevals\ttotal_evals\tmin\tmean\tmax\tstd\tunique\tsize\tbest\n")
+
+    def record(self, generation, individuals, n_evals, best=None):
+        # n_evals: simulations run for this generation
+        self.n_evals += n_evals
+        stats = generation_stats(individuals)
+        best_value = best.fitness.values[0] if best is not None else stats["max"]
+        line = "%s\t%d\t%d\t%.4f\t%.4f\t%.4f\t%.4f\t%d\t%d\t%.4f" % (
+            generation, n_evals, self.n_evals, stats["min"], stats["mean"], stats["max"], stats["std"],
+            stats["unique"], stats["size"], best_value)
+        if self.filename is not None:
+            with open(self.filename, 'a') as f:
+                f.write(line + "\n")
+        return stats
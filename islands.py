@@ -0,0 +1,54 @@
+import random
+from operator import attrgetter
+from hall_of_fame import generation_stats
+
+""" Island model.
+
+        K populations evolve independently with the usual operators; their offspring are
+        evaluated together, so the islands share the evaluator slots (pool workers, simulator
+        workers or the broker). Every interval generations each island sends clones of its
+        best n_migrants individuals to another island, where they replace the worst ones:
+            ring    island i -> island i+1
+            random  a random permutation without fixed points
+"""
+
+TOPOLOGIES = ("ring", "random")
+
+
+def migration_targets(n_islands, topology="ring"):
+    # target island of every island
+    if n_islands < 2:
+        return [0] * n_islands
+    if topology == "ring":
+        return [(i + 1) % n_islands for i in range(0, n_islands)]
+    if topology == "random":
+        while True:
+            targets = list(range(0, n_islands))
+            random.shuffle(targets)
+            if all(target != i for i, target in enumerate(targets)):
+                return targets
+    raise ValueError("Unknown migration topology: " + str(topology))
+
+
+def migrate(islands, n_migrants, clone, topology="ring", key=attrgetter("fitness")):
+    # all emigrants are chosen before any island is changed
+    targets = migration_targets(len(islands), topology)
+    emigrants = [[clone(ind) for ind in sorted(island, key=key, reverse=True)[0:n_migrants]] for island in islands]
+    for source, target in enumerate(targets):
+        if source == target:
+            continue
+        island = islands[target]
+        worst = sorted(range(0, len(island)), key=lambda i: key(island[i]))[0:len(emigrants[source])]
+        for idx, migrant in zip(worst, emigrants[source]):
+            island[idx] = migrant
+    return targets
+
+
+def print_island_stats(islands):
+    for i, island in enumerate(islands):
+        stats = generation_stats(island)
+        if stats["evaluated"] == 0:
+            print("Island", i, "not evaluated")
+            continue
+        print("Island %d: max %.4f mean %.4f std %.4f min %.4f unique %d/%d" % (
+            i, stats["max"], stats["mean"], stats["std"], stats["min"], stats["unique"], stats["size"]))
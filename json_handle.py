@@ -1,4 +1,8 @@
 import json
+import logging
+import functools
+from pathlib import Path
+from metrics import metrics
 
 """ Representation of a policy
         ------------------------------------------------------------------------
@@ -174,88 +178,210 @@ index_map = {
 }
 
 
-def read_policy(filename):
-    policy_set = list()
+CHUNK_SIZE = 65536
+json_decoder = json.JSONDecoder()
+
+
+class PolicyFileError(Exception):
+    def __init__(self, value, filename, line, column):
+        self.value = value
+        self.filename = filename
+        self.line = line
+        self.column = column
+
+    def __str__(self):
+        return str(self.filename) + ":" + str(self.line) + ":" + str(self.column) + ": " + self.value
+
+
+class JsonStream:
+    # Text buffer over a file which is filled chunk by chunk; consumed text is dropped,
+    # so reading a file is linear in its size. The line of the scanned text is counted
+    # as the reader moves on, the locations asked for never go back.
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.scan = 0           # newlines before buf[scan] are counted
+        self.line = 1           # line of buf[scan]
+        self.line_start = 0     # index of the first character of that line (negative: dropped)
+
+    def fill(self):
+        if self.pos > self.chunk_size:
+            self.location(self.pos)
+            self.buf = self.buf[self.pos:]
+            self.scan -= self.pos
+            self.line_start -= self.pos
+            self.pos = 0
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buf += chunk
+
+    def location(self, idx=None):
+        # (line, column) of buf[idx], idx at or after the previous location
+        if idx is None:
+            idx = self.pos
+        newlines = self.buf.count("\n", self.scan, idx)
+        if newlines:
+            self.line += newlines
+            self.line_start = self.buf.rfind("\n", self.scan, idx) + 1
+        self.scan = idx
+        return self.line, idx - self.line_start + 1
+
+    def peek(self):
+        # next non-whitespace character, '' at the end of the file
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self.fill()
+
+    def decode(self, filename):
+        # decode the JSON value at the current position, reading more text while it is incomplete
+        self.peek()
+        while True:
+            try:
+                value, end = json_decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    line, column = self.location()
+                    self.pos = end
+                    return value, line, column
+            except ValueError as e:
+                if self.eof:
+                    line, column = self.location(getattr(e, "pos", self.pos))
+                    raise PolicyFileError("Invalid JSON: " + getattr(e, "msg", str(e)), filename, line, column)
+            self.fill()
+
+
+def iter_json_items(filename, chunk_size=CHUNK_SIZE):
+    # Yields (value, line, column) for every element of the top-level arrays in a file
+    # (top-level values which are not arrays are yielded themselves).
     with open(filename) as f:
-        for line in f:
+        stream = JsonStream(f, chunk_size)
+        while True:
+            c = stream.peek()
+            if c == "":
+                return
+            if c != "[":
+                yield stream.decode(filename)
+                continue
+
+            stream.pos += 1
+            if stream.peek() == "]":
+                stream.pos += 1
+                continue
             while True:
-                try:
-                    policies = json.loads(line)
-                    for policy in policies:
-                        prev_policy = [None] * 18
-
-                        # policy type
-                        policy_type = policy['policyType']
-                        prev_policy[0] = translate_map['policyType'][policy_type]
-
-                        # conditions
-                        conditions = policy['conditions']
-                        for condition in conditions:
-                            if condition['variable'] == "MCILevel":
-                                prev_policy[1] = int(condition['value'][0])
-                            elif condition['variable'] == "DamageType":
-                                cond_val = condition['value']
-                                prev_policy[2] = translate_map["DamageType"][cond_val]
-                            elif condition['variable'] == "Story":
-                                prev_policy[3] = int(condition['value'][0])
-                            elif condition['variable'] == "Time":
-                                prev_policy[4] = int(condition['value'][0])
-
-                        # role
-                        role = policy['role']
-                        prev_policy[5] = translate_map['role'][role]
-
-                        # action
-                        action = policy['action']
-                        action_name = action['actionName']
-                        action_method = action['actionMethod']
-                        if action_name == "Select":
-                            prev_policy[6] = translate_map["Select"][action_method]
-                        elif action_name == "Stage":
-                            prev_policy[7] = translate_map["Stage"][action_method]
-                        elif action_name == "Load":
-                            prev_policy[8] = translate_map["Load"][action_method]
-                        elif action_name == "DeliverTo":
-                            prev_policy[9] = translate_map["DeliverTo"][action_method]
-                        elif action_name == "ReturnTo":
-                            prev_policy[10] = translate_map["ReturnTo"][action_method]
-                        elif action_name == "Wait":
-                            prev_policy[11] = translate_map["Wait"][action_method]
-                        elif action_name == "Treat":
-                            prev_policy[12] = translate_map["Treat"][action_method]
-                        elif action_name == "Operate":
-                            prev_policy[13] = translate_map["Operate"][action_method]
-                        elif action_name == "Release":
-                            prev_policy[14] = translate_map["Release"][action_method]
-
-                        # method value
-                        if action['methodValue'] == "":
-                            prev_policy[15] = -1
-                        else:
-                            prev_policy[15] = int(action['methodValue'])
-
-                        # minCompliance and enforce
-                        if prev_policy[0] == 1:     # action policy
-                            prev_policy[16] = -1    # do not use min_compliance
-                            # if str_to_bool(policy['enforce']):
-                            if policy['enforce'] == "true":
-                                prev_policy[17] = 1
-                            else:
-                                prev_policy[17] = 0
-                        elif prev_policy[0] == 2:   # compliance policy
-                            prev_policy[16] = float(policy['minCompliance'])
-
-                        # fill -1 into rest of irrelevant indices
-                        for idx in range(0, len(prev_policy)):
-                            if prev_policy[idx] is None:
-                                prev_policy[idx] = -1
-                        policy_set.append(prev_policy)
+                yield stream.decode(filename)
+                c = stream.peek()
+                stream.pos += 1
+                if c == "]":
                     break
-                except ValueError:
-                    # Not yet a complete JSON value
-                    line += next(f)
+                if c != ",":
+                    line, column = stream.location(stream.pos - 1)
+                    raise PolicyFileError("Expected ',' or ']' in policy array", filename, line, column)
+
+
+def dict_to_poli(policy):
+    prev_policy = [None] * 18
+
+    # policy type
+    policy_type = policy['policyType']
+    prev_policy[0] = translate_map['policyType'][policy_type]
+
+    # conditions
+    conditions = policy['conditions']
+    for condition in conditions:
+        if condition['variable'] == "MCILevel":
+            prev_policy[1] = int(condition['value'][0])
+        elif condition['variable'] == "DamageType":
+            cond_val = condition['value']
+            prev_policy[2] = translate_map["DamageType"][cond_val]
+        elif condition['variable'] == "Story":
+            prev_policy[3] = int(condition['value'][0])
+        elif condition['variable'] == "Time":
+            prev_policy[4] = int(condition['value'][0])
+
+    # role
+    role = policy['role']
+    prev_policy[5] = translate_map['role'][role]
+
+    # action
+    action = policy['action']
+    action_name = action['actionName']
+    action_method = action['actionMethod']
+    if action_name == "Select":
+        prev_policy[6] = translate_map["Select"][action_method]
+    elif action_name == "Stage":
+        prev_policy[7] = translate_map["Stage"][action_method]
+    elif action_name == "Load":
+        prev_policy[8] = translate_map["Load"][action_method]
+    elif action_name == "DeliverTo":
+        prev_policy[9] = translate_map["DeliverTo"][action_method]
+    elif action_name == "ReturnTo":
+        prev_policy[10] = translate_map["ReturnTo"][action_method]
+    elif action_name == "Wait":
+        prev_policy[11] = translate_map["Wait"][action_method]
+    elif action_name == "Treat":
+        prev_policy[12] = translate_map["Treat"][action_method]
+    elif action_name == "Operate":
+        prev_policy[13] = translate_map["Operate"][action_method]
+    elif action_name == "Release":
+        prev_policy[14] = translate_map["Release"][action_method]
+
+    # method value
+    if action['methodValue'] == "":
+        prev_policy[15] = -1
+    else:
+        prev_policy[15] = int(action['methodValue'])
+
+    # minCompliance and enforce
+    if prev_policy[0] == 1:     # action policy
+        prev_policy[16] = -1    # do not use min_compliance
+        # if str_to_bool(policy['enforce']):
+        if policy['enforce'] == "true":
+            prev_policy[17] = 1
+        else:
+            prev_policy[17] = 0
+    elif prev_policy[0] == 2:   # compliance policy
+        prev_policy[16] = float(policy['minCompliance'])
+
+    # fill -1 into rest of irrelevant indices
+    for idx in range(0, len(prev_policy)):
+        if prev_policy[idx] is None:
+            prev_policy[idx] = -1
+    return prev_policy
+
+
+def iter_policies(filename, strict=True):
+    # Yields the numeric policies of a policy file one at a time.
+    # A malformed entry raises PolicyFileError with its position, or is skipped with a warning.
+    for entry, (policy, line, column) in enumerate(iter_json_items(filename)):
+        try:
+            numeric_policy = dict_to_poli(policy)
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+            error = PolicyFileError("Malformed policy #" + str(entry) + " (" + repr(e) + ")",
+                                    filename, line, column)
+            if strict:
+                raise error
+            logging.warning(str(error))
+            continue
+        yield numeric_policy
+
 
-    return policy_set
+def iter_policy_dir(dirname, pattern="*.json", strict=True):
+    # Yields (file path, numeric policy) for every policy file in a directory of archives
+    for path in sorted(Path(dirname).glob(pattern)):
+        for policy in iter_policies(path, strict):
+            yield path, policy
+
+
+def read_policy(filename):
+    return list(iter_policies(filename))
 
 
 def poli_to_dict(numeric_policy):
@@ -320,17 +446,40 @@ def poli_to_dict(numeric_policy):
     return policy
 
 
-def make_policy_json(filename, individual):
-    policy_set = list()
+FRAGMENT_CACHE_SIZE = 65536
+
+
+def policy_key(numeric_policy):
+    # 1 and 1.0 are equal as dict keys but are written differently, so the types are part of the key
+    policy = tuple(numeric_policy)
+    return policy, tuple(type(v) is float for v in policy)
+
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def policy_fragment(key, compact=False):
+    # JSON text of one policy as it appears inside the policy set array
+    policy_dict = poli_to_dict(key[0])
+    if compact:
+        return json.dumps(policy_dict, separators=(',', ':'))
+    return "    " + json.dumps(policy_dict, indent=4).replace("\n", "\n    ")
+
+
+def policy_set_json(individual, compact=False):
+    # same text as json.dumps(policy dicts, indent=4), assembled from cached fragments
+    fragments = [policy_fragment(policy_key(policy), compact) for policy in individual]
+    if compact:
+        return "[" + ",".join(fragments) + "]"
+    if not fragments:
+        return "[]"
+    return "[\n" + ",\n".join(fragments) + "\n]"
 
-    for policy in individual:
-        policy_dict = poli_to_dict(policy)
-        policy_set.append(policy_dict)
 
+def make_policy_json(filename, individual, compact=False):
     dir_path = "./json/candidates/"
     file_path = dir_path+filename
-    with open(file_path, 'w') as f:
-        f.write(json.dumps(policy_set, indent=4))
+    with metrics.phase("json_write"):
+        with open(file_path, 'w') as f:
+            f.write(policy_set_json(individual, compact))
 
 
 def val_to_bool(v):
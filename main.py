@@ -1,17 +1,39 @@
 import random, json_handle, policy_eval
+from fitness_cache import FitnessCache, policy_set_key, cache_namespace, CACHE_DB
+from sim_worker import SimulatorPool
+from broker import Broker, parse_address, is_loopback, BROKER_PORT, BROKER_TOKEN_ENV
+from racing import evaluate_racing, MAX_SIMULATION
+from steady_state import steady_state
+from surrogate import Surrogate
+from fidelity import MultiFidelity, fidelity_key, sel_fidelity_tournament, check_stages
+from hall_of_fame import HallOfFame, GenerationLog, GENERATION_LOG
+from crossover import AlignedCrossover, CROSSOVER_MODES
+from mutation import BatchMutation
+from islands import migrate, print_island_stats, TOPOLOGIES
+from metrics import metrics, call_measured, MetricsExporter, METRICS_FILE, PROM_FILE
+from candidate_store import configure_store, get_store, STORE_DIR, STORE_MAX_BYTES
+from sim_log import configure_log, close_log, log_files, SIMUL_LOG, LOG_LEVELS, LOG_MAX_BYTES
+from checkpoint import save_checkpoint, load_checkpoint, pack_individuals, unpack_individuals, pack_done, unpack_done
+from checkpoint import CHECKPOINT_FILE
+from concurrent.futures import ProcessPoolExecutor
 from policy_op import gen_individual, mut_policy, my_initRepeat2
 from policy_op import gen_individual_multi, my_initRepeat, mut_policy_multi, get_prev_policy
 from policy_op import gen_individual_directed, mut_policy_directed, gen_individual_ack, mut_policy_ack
+from policy_op import get_skeleton
 from deap import tools, base, creator
 from operator import attrgetter
 from pathlib import Path
 import itertools
-import json
-import os, shutil
+import os
 import time
 import logging
+import functools
+import asyncio
+import argparse
+import contextlib
+import multiprocessing
 
-# FRAMEWORK_LOG = './framework.log'
+FRAMEWORK_LOG = './json/framework.log'
 
 # create class - first: name, second: base, rest params: variable and values
 creator.create("FitnessMax", base.Fitness, weights=(1.0,))
@@ -44,118 +66,513 @@ toolbox.register("select", tools.selTournament, tournsize=5)
 toolbox.register("evaluate", policy_eval.evaluate)
 
 
-def main(type_SoS):
-    # Generate a population of 'policy_set'
-    if os.path.exists("./json/simulation.log"):
-        os.remove("./json/simulation.log")
-
-    folder = './json/candidates'
-    for the_file in os.listdir(folder):
-        file_path = os.path.join(folder, the_file)
-        try:
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
-                # elif os.path.isdir(file_path): shutil.rmtree(file_path)
-        except Exception as e:
-            print(e)
-
-    print(">> Framework Start. SoS type: ", type_SoS)
-    # Experiment: How about using only action policy for ack and ack+direct?
-    # p_population = toolbox.population_d(n=20)
-    # prev_policy_file = Path("./json/candidates/prev_policy_D.json")
+def main(type_SoS, n_workers=1, cache_file=CACHE_DB, sim_worker_cmd=None, racing_chunk=None,
+         max_evals=None, max_time=None, checkpoint_file=None, checkpoint_evals=False, resume=False,
+         surrogate_pool=None, fidelity=None, fidelity_margin=5.0, metrics_file=None, prom_file=None,
+         broker_address=None, broker_token=None, n_islands=None, migration_interval=5, n_migrants=2, topology="ring",
+         generation_log_file=None, sim_log_level="full", sim_log_max_bytes=LOG_MAX_BYTES,
+         candidate_dir=STORE_DIR, candidate_tmpfs=False, candidate_max_bytes=STORE_MAX_BYTES,
+         crossover_mode="two_point", batch_mutation=True, n_generations=20):
+    # framework messages (promotions, skipped policies); the simulator output has its own log sink
+    logging.basicConfig(filename=FRAMEWORK_LOG, format='%(asctime)s %(message)s', level=logging.INFO)
+    configure_log(level=sim_log_level, max_bytes=sim_log_max_bytes)
+    # candidate files of the simulator, configured before the pool workers are started
+    configure_store(directory=candidate_dir, tmpfs=candidate_tmpfs, max_bytes=candidate_max_bytes)
+
+    # Every resource is released (and the toolbox restored) also when the run is interrupted
+    with contextlib.ExitStack() as resources:
+        resources.callback(close_log)
+        resources.callback(restore_toolbox, dict(toolbox.__dict__))
+
+        # Parallel evaluation: every pool worker runs the simulator in its own directory
+        pool = None
+        sim_pool = None
+        broker = None
+        executor = None
+        steady = max_evals is not None or max_time is not None
+        if broker_address is not None:
+            # distributed: workers on any host pull the candidates from the broker
+            broker = Broker(*broker_address, token=broker_token)
+            resources.callback(broker.close)
+            toolbox.register("evaluate", broker.evaluate)
+            executor = broker.executor
+            toolbox.register("map", executor.map)
+            print(">> Broker listening on", broker.address)
+        elif sim_worker_cmd is not None:
+            # long-lived simulator processes instead of one JVM launch per evaluation
+            sim_pool = SimulatorPool(sim_worker_cmd, n_workers)
+            resources.callback(sim_pool.close)
+            toolbox.register("evaluate", sim_pool.evaluate)
+            executor = sim_pool.executor
+            toolbox.register("map", executor.map)
+            print(">> Simulator workers:", n_workers, sim_worker_cmd)
+        elif steady:
+            worker_dir = policy_eval.worker_base_dir()
+            resources.callback(policy_eval.collect_workers, worker_dir)
+            executor = ProcessPoolExecutor(n_workers, initializer=policy_eval.init_worker, initargs=(worker_dir,))
+            resources.push(executor_closer(executor))
+            toolbox.register("map", executor.map)
+        elif n_workers > 1:
+            worker_dir = policy_eval.worker_base_dir()
+            resources.callback(policy_eval.collect_workers, worker_dir)
+            pool = multiprocessing.Pool(n_workers, initializer=policy_eval.init_worker, initargs=(worker_dir,))
+            resources.push(pool_closer(pool))
+            toolbox.register("map", make_pool_map(pool))
+            print(">> Parallel evaluation with", n_workers, "workers")
+
+        # Resume: continue the run saved in the checkpoint file, keep its candidates and log
+        resume_state = None
+        if resume:
+            resume_state = load_checkpoint(checkpoint_file)
+            type_SoS = resume_state["type_SoS"]
+            print(">> Resume from", checkpoint_file, "generation", resume_state["generation"],
+                  "(" + resume_state["phase"] + ")")
+        else:
+            # Generate a population of 'policy_set'
+            for log_file in log_files(SIMUL_LOG):
+                os.remove(log_file)
+
+            # candidate files are reused across runs, only old ones are removed
+            print(">> Candidate store", get_store().directory, "removed", get_store().gc(), "old files")
+
+        print(">> Framework Start. SoS type: ", type_SoS)
+
+        # Metrics: time of every phase and counters, exported after every generation
+        exporter = None
+        if metrics_file is not None or prom_file is not None:
+            exporter = MetricsExporter(metrics_file, prom_file, append=resume)
+        # one line of statistics per generation
+        generation_log = GenerationLog(generation_log_file, append=resume)
+
+        # Fitness cache: genotype-identical individuals are simulated only once (also across runs)
+        cache = None
+        if cache_file is not None:
+            # fitness of another simulator (e.g. the stub) never mixes with the results of the jar,
+            # partial results (racing, low fidelity) are not reused
+            cache = FitnessCache(cache_file, namespace=cache_namespace(type_SoS, sim_worker_cmd),
+                                 min_simulation=MAX_SIMULATION if fidelity is None else fidelity[-1])
+            resources.callback(cache.close)
+
+        CXPB, MUTPB, NGEN = 0.5, 0.6, n_generations
+        # BEST_PORTION = 0.2
+
+        # Racing: replications run in chunks and stop early once the candidate is settled
+        simulate = toolbox.evaluate
+        if racing_chunk is not None:
+            toolbox.register("evaluate", evaluate_racing, simulate, chunk=racing_chunk)
+
+        # Multi-fidelity: every candidate is screened with few replications, only promising ones get all
+        multi_fidelity = None
+        select = toolbox.select
+        if fidelity is not None:
+            multi_fidelity = MultiFidelity(simulate, fidelity, fidelity_margin)
+            toolbox.register("select", sel_fidelity_tournament, tournsize=5, full=multi_fidelity.full())
+            print(">> Multi-fidelity evaluation, replications:", fidelity, "margin:", fidelity_margin)
+
+        # Crossover: free genes of the fixed skeleton are exchanged in aligned blocks
+        mate = toolbox.mate
+        crossover = AlignedCrossover(get_skeleton(type_SoS), crossover_mode)
+        toolbox.register("mate", crossover)
+        toolbox.register("mate_batch", crossover.mate_batch)
+        print(">> Crossover:", crossover_mode)
+        # Mutation: the mutants of a generation are mutated together (same operator as mutate_individual)
+        if batch_mutation:
+            toolbox.register("mutate_batch", BatchMutation(get_skeleton(type_SoS), type_SoS, m_portion=0.5).mutate)
+
+        # Surrogate: offspring are pre-screened by a model learnt from all evaluations so far
+        surrogate = None
+        if surrogate_pool is not None:
+            surrogate = Surrogate(pool_factor=surrogate_pool)
+
+        if n_islands is not None:
+            # Island model: several populations, offspring of all islands are evaluated together
+            islands = [make_population(type_SoS) for i in range(0, n_islands)]
+            print(">> Evaluate the initial populations of", n_islands, "islands.")
+            evaluate_population([ind for island in islands for ind in island], 0, cache,
+                                multi_fidelity=multi_fidelity)
+            p_population = [ind for island in islands for ind in island]
+            if exporter is not None:
+                exporter.export("init", metrics.take())
+        elif resume_state is not None:
+            p_population = unpack_individuals(resume_state["population"], creator.Individual)
+            if resume_state.get("surrogate") is not None:
+                surrogate = Surrogate.from_state(resume_state["surrogate"])
+            # the statistics of the crossover continue, unless another mode is chosen now
+            if resume_state.get("crossover") is not None:
+                crossover.restore(resume_state["crossover"])
+        else:
+            p_population = init_population(type_SoS, cache, multi_fidelity)
+            if surrogate is not None:
+                surrogate.observe(p_population)
+            if exporter is not None:
+                exporter.export("init", metrics.take())
+            if checkpoint_file is not None:
+                save_checkpoint(checkpoint_file, {
+                    "type_SoS": type_SoS, "generation": 0, "phase": "generation",
+                    "population": pack_individuals(p_population), "offspring": None, "best": [],
+                    "done": dict(), "random_state": random.getstate(),
+                    "surrogate": None if surrogate is None else surrogate.state(), "crossover": crossover.state()})
+        POP = len(p_population)
+
+        if n_islands is not None:
+            p_population = run_islands(islands, type_SoS, cache, CXPB, MUTPB, NGEN, migration_interval, n_migrants,
+                                       topology, multi_fidelity, exporter, generation_log, crossover)
+        elif steady:
+            # Steady-state GA: offspring are bred and inserted while other evaluations are running
+            engine = steady_state(p_population, toolbox, functools.partial(mutate_individual, type_SoS=type_SoS),
+                                  toolbox.evaluate, executor, n_in_flight=n_workers, cxpb=CXPB, mutpb=MUTPB,
+                                  max_evals=max_evals, max_time=max_time, cache=cache, assign=set_fitness,
+                                  first_num=POP)
+            asyncio.run(engine)
+            if exporter is not None:
+                exporter.export("steady", metrics.take())
+        else:
+            p_population = run_generations(p_population, type_SoS, cache, simulate, racing_chunk, CXPB, MUTPB, NGEN,
+                                           checkpoint_file, checkpoint_evals, resume_state, surrogate, multi_fidelity,
+                                           exporter, generation_log, crossover)
+
+        print("Crossover: ", crossover.stats())
+        if broker is not None:
+            print("Broker: ", broker.stats())
+        if sim_pool is not None:
+            print("Simulator worker restarts: ", sim_pool.restarts())
+        if surrogate is not None:
+            print("Surrogate: ", surrogate.stats())
+        if multi_fidelity is not None:
+            print("Multi-fidelity: replications", multi_fidelity.n_replications, "saved",
+                  round(100 * multi_fidelity.saving(), 1), "%")
+        if cache is not None:
+            print("Fitness cache: ", cache.stats())
+        print("Candidate store: ", get_store().stats())
 
-    if type_SoS == "D":
-        p_population = toolbox.population_d(n=20)
-        prev_policy_file = Path("./json/candidates/prev_policy_D.json")
-    elif type_SoS == "A":
-        p_population = toolbox.population_ack(n=20)
-        prev_policy_file = Path("./json/candidates/prev_policy_A.json")
-    else:
-        p_population = toolbox.population_multi(n=20)
-        prev_policy_file = Path("./json/candidates/prev_policy_multi.json")
+    print()
+    print("Total length: ", len(p_population))
 
-    print(">> Initial population is generated. Population size: ", len(p_population))
+    return p_population
 
-    if prev_policy_file.is_file():
-        print("Previous policy file exists.")
-        p_population.append(toolbox.prev_individual(filename=prev_policy_file))
-        print("Finish reading a previous policy file. Add the end of the population.")
 
-    CXPB, MUTPB, NGEN = 0.5, 0.6, 20
-    # BEST_PORTION = 0.2
-    POP = len(p_population)
+def init_population(type_SoS, cache, multi_fidelity=None):
+    p_population = make_population(type_SoS)
 
     # Evaluate the entire population
     print(">> Evaluate the initial population.")
 
     # fitnesses = map(toolbox.evaluate, p_population)
-    fitnesses = map(toolbox.evaluate, p_population, range(0, POP), itertools.repeat(0, POP))
-    for ind, fit in zip(p_population, fitnesses):
-        ind.fitness.values = fit
+    evaluate_population(p_population, 0, cache, multi_fidelity=multi_fidelity)
     print(">> Finish the evaluation of the initial population.")
+    return p_population
+
 
-    best = []
-    for g in range(NGEN):
+def make_population(type_SoS):
+    # Experiment: How about using only action policy for ack and ack+direct?
+    # p_population = toolbox.population_d(n=20)
+    # prev_policy_file = Path("./json/candidates/prev_policy_D.json")
+
+    with metrics.phase("init"):
+        if type_SoS == "D":
+            p_population = toolbox.population_d(n=20)
+            prev_policy_file = Path("./json/candidates/prev_policy_D.json")
+        elif type_SoS == "A":
+            p_population = toolbox.population_ack(n=20)
+            prev_policy_file = Path("./json/candidates/prev_policy_A.json")
+        else:
+            p_population = toolbox.population_multi(n=20)
+            prev_policy_file = Path("./json/candidates/prev_policy_multi.json")
+
+        print(">> Initial population is generated. Population size: ", len(p_population))
+
+        if prev_policy_file.is_file():
+            print("Previous policy file exists.")
+            p_population.append(toolbox.prev_individual(filename=prev_policy_file))
+            print("Finish reading a previous policy file. Add the end of the population.")
+    return p_population
+
+
+def run_generations(p_population, type_SoS, cache, simulate, racing_chunk, CXPB, MUTPB, NGEN,
+                    checkpoint_file=None, checkpoint_evals=False, resume_state=None, surrogate=None,
+                    multi_fidelity=None, exporter=None, generation_log=None, crossover=None):
+    # Generational GA: the whole population is replaced by its offspring every generation
+    key = attrgetter("fitness")
+    if multi_fidelity is not None:
+        key = fidelity_key(multi_fidelity.full())
+    if generation_log is None:
+        generation_log = GenerationLog(None)
+    hall_of_fame = HallOfFame(10, key, toolbox.clone)
+    start_gen = 0
+    offspring = None
+    done = dict()   # cache key -> fitness of the evaluations finished in this generation
+    if resume_state is not None:
+        start_gen = resume_state["generation"]
+        hall_of_fame.update(unpack_individuals(resume_state["best"], creator.Individual))
+        if resume_state["phase"] == "evaluating":
+            offspring = unpack_individuals(resume_state["offspring"], creator.Individual)
+            done = unpack_done(resume_state["done"])
+        random.setstate(resume_state["random_state"])
+
+    def save(gen_num, phase):
+        if checkpoint_file is None:
+            return
+        with metrics.phase("checkpoint"):
+            save_checkpoint(checkpoint_file, {
+                "type_SoS": type_SoS, "generation": gen_num, "phase": phase,
+                "population": pack_individuals(p_population),
+                "offspring": pack_individuals(offspring) if phase == "evaluating" else None,
+                "best": pack_individuals(hall_of_fame.items()), "done": pack_done(done),
+                "random_state": random.getstate(),
+                "surrogate": None if surrogate is None else surrogate.state(),
+                "crossover": None if crossover is None else crossover.state()})
+
+    def on_result(key, fit):
+        done[key] = fit
+        if checkpoint_evals:
+            save(g, "evaluating")
+
+    for g in range(start_gen, NGEN):
         print("<<<<Generation: ", g, ">>>>")
         print("Population Length: ", len(p_population))
 
-        # Select the next generation individuals
-        # best_cand = sorted(p_population, key=attrgetter("fitness"), reverse=True)[0:int(POP*BEST_PORTION)]
-        best_cand = sorted(p_population, key=attrgetter("fitness"), reverse=True)[0:1]
-        # update best
-        if g == 0:
-            best = best_cand
+        if offspring is None:
+            hall_of_fame.update(p_population)
+            print("Current Best: ", hall_of_fame.best().fitness.values[0])
+
+            offspring = breed_offspring(p_population, type_SoS, CXPB, MUTPB)
+            if surrogate is not None and surrogate.enabled():
+                offspring = screen_offspring(offspring, p_population, type_SoS, CXPB, MUTPB, surrogate)
+            if checkpoint_evals:
+                save(g, "evaluating")
         else:
-            cand_fitness = best_cand[0].fitness.values[0]
-            current_fitness = best[0].fitness.values[0]
-            if cand_fitness > current_fitness:
-                best = best_cand
+            print("Resume the evaluation of generation", g, "- finished evaluations:", len(done))
+
+        print("Re-evaluation...")
+        if racing_chunk is not None:
+            toolbox.register("evaluate", evaluate_racing, simulate, chunk=racing_chunk,
+                             incumbent=hall_of_fame.best().fitness.values[0])
+        # Evaluate the individuals with an invalid fitness
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        # fitnesses = map(toolbox.evaluate, invalid_ind)
+        predicted = surrogate.predict(invalid_ind) if surrogate is not None else None
+        n_evals = evaluate_population(invalid_ind, g, cache, done, on_result, multi_fidelity)
+        if crossover is not None:
+            crossover.observe(invalid_ind)
+            print("Crossover: ", crossover.stats())
+        if surrogate is not None:
+            surrogate.observe(invalid_ind, predicted)
+            print("Surrogate: ", surrogate.stats())
+        # The population is entirely replaced by the offspring
+        p_population[:] = offspring
+        offspring = None
+        done = dict()
+        hall_of_fame.update(p_population)
+        with metrics.phase("logging"):
+            print_generation(g, generation_log.record(g, p_population, n_evals, hall_of_fame.best()), n_evals)
+        save(g + 1, "generation")
+        get_store().gc()
+        if exporter is not None:
+            exporter.export(g, metrics.take())
+
+    # as before, the result is the last population and the best individual,
+    # the rest of the hall of fame is only printed
+    print("Hall of fame: ", [ind.fitness.values[0] for ind in hall_of_fame])
+    p_population[:] = p_population + hall_of_fame.items()[0:1]
+
+    return p_population
 
-        print("Best length: ", len(best))
-        print("Current Best: ", best[0].fitness.values[0])
-        print("Pop fits: ", end=" ")
-        print_fitness(p_population)
-        print("Selection...")
 
+def run_islands(islands, type_SoS, cache, CXPB, MUTPB, NGEN, migration_interval, n_migrants, topology,
+                multi_fidelity=None, exporter=None, generation_log=None, crossover=None):
+    # Island model: every island runs the generational GA on its own population,
+    # the best individuals migrate every migration_interval generations
+    key = attrgetter("fitness")
+    if multi_fidelity is not None:
+        key = fidelity_key(multi_fidelity.full())
+    if generation_log is None:
+        generation_log = GenerationLog(None)
+    hall_of_fame = HallOfFame(10, key, toolbox.clone)
+
+    for g in range(0, NGEN):
+        print("<<<<Generation: ", g, ">>>>")
+        for island in islands:
+            hall_of_fame.update(island)
+        print("Current Best: ", hall_of_fame.best().fitness.values[0])
+        with metrics.phase("logging"):
+            print_island_stats(islands)
+
+        offsprings = [breed_offspring(island, type_SoS, CXPB, MUTPB) for island in islands]
+        print("Re-evaluation...")
+        invalid_ind = [ind for offspring in offsprings for ind in offspring if not ind.fitness.valid]
+        n_evals = evaluate_population(invalid_ind, g, cache, multi_fidelity=multi_fidelity)
+        if crossover is not None:
+            crossover.observe(invalid_ind)
+            print("Crossover: ", crossover.stats())
+        for island, offspring in zip(islands, offsprings):
+            island[:] = offspring
+            hall_of_fame.update(island)
+        with metrics.phase("logging"):
+            print_generation(g, generation_log.record(g, [ind for island in islands for ind in island], n_evals,
+                                                      hall_of_fame.best()), n_evals)
+
+        if (g + 1) % migration_interval == 0 and g + 1 < NGEN:
+            with metrics.phase("migration"):
+                targets = migrate(islands, n_migrants, toolbox.clone, topology, key)
+            print("Migration:", n_migrants, "individuals", topology, targets)
+        get_store().gc()
+        if exporter is not None:
+            exporter.export(g, metrics.take())
+
+    for island in islands:
+        hall_of_fame.update(island)
+    print("Hall of fame: ", [ind.fitness.values[0] for ind in hall_of_fame])
+    return [ind for island in islands for ind in island] + hall_of_fame.items()[0:1]
+
+
+def breed_offspring(p_population, type_SoS, CXPB, MUTPB):
+    print("Selection...")
+    with metrics.phase("selection"):
         # offspring = toolbox.select(p_population, len(p_population)-int(POP*BEST_PORTION))
         offspring = toolbox.select(p_population, len(p_population))
-        # Clone the selected individuals
+    # Clone the selected individuals
+    with metrics.phase("clone"):
         offspring = list(map(toolbox.clone, offspring))
-        print("Crossover...")
-        # Apply crossover and mutation on the offspring
+    print("Crossover...")
+    # Apply crossover and mutation on the offspring
+    with metrics.phase("crossover"):
+        pairs = list()
         for child1, child2 in zip(offspring[::2], offspring[1::2]):
             # [start:end:step]
             if random.random() < CXPB:
+                pairs.append((child1, child2))
+        # the masks of all pairs are drawn at once
+        if hasattr(toolbox, "mate_batch"):
+            toolbox.mate_batch(pairs)
+        else:
+            for child1, child2 in pairs:
                 toolbox.mate(child1, child2)
-                del child1.fitness.values
-                del child2.fitness.values
-        print("Mutation...")
-        for mutant in offspring:
-            if random.random() < MUTPB:
-                if type_SoS == "D":
-                    toolbox.mutate_d(mutant)
-                elif type_SoS == "A":
-                    toolbox.mutate_ack(mutant)
-                else:
-                    toolbox.mutate_multi(mutant)
-                del mutant.fitness.values
+        for child1, child2 in pairs:
+            del child1.fitness.values
+            del child2.fitness.values
+    print("Mutation...")
+    with metrics.phase("mutation"):
+        mutants = [mutant for mutant in offspring if random.random() < MUTPB]
+        if hasattr(toolbox, "mutate_batch"):
+            toolbox.mutate_batch(mutants)
+        else:
+            for mutant in mutants:
+                mutate_individual(mutant, type_SoS)
+        for mutant in mutants:
+            del mutant.fitness.values
+    return offspring
+
+
+def screen_offspring(offspring, p_population, type_SoS, CXPB, MUTPB, surrogate):
+    # Breed pool_factor times the offspring and keep the most promising new individuals;
+    # unchanged clones keep their place, they are not simulated anyway
+    keep = [ind for ind in offspring if ind.fitness.valid]
+    candidates = [ind for ind in offspring if not ind.fitness.valid]
+    for i in range(1, surrogate.pool_factor):
+        extra = breed_offspring(p_population, type_SoS, CXPB, MUTPB)
+        candidates.extend(ind for ind in extra if not ind.fitness.valid)
+    print("Surrogate screening:", len(offspring) - len(keep), "of", len(candidates), "candidates")
+    return keep + surrogate.screen(candidates, len(offspring) - len(keep))
+
+
+def evaluate_population(individuals, gen_num, cache=None, done=None, on_result=None, multi_fidelity=None):
+    # Simulate the individuals and set their fitness.
+    # Results in done (an interrupted generation) are reused. With a cache, known genotypes
+    # and duplicates within the batch are not simulated again.
+    # on_result(key, fitness) is called after every finished simulation.
+    # With multi_fidelity the batch is screened at low fidelity; the cache keeps only full results.
+    # Returns the number of individuals simulated.
+    keys = [policy_set_key(ind) for ind in individuals]
+    results = dict(done) if done else dict()
+    to_run = list()     # (key, individual to simulate)
+    for ind, key in zip(individuals, keys):
+        if key in results:
+            continue
+        if cache is not None:
+            fit = cache.get(key)
+            if fit is not None:
+                results[key] = fit
+                metrics.count("cache_hits")
+                continue
+            results[key] = None     # simulated once for the whole batch
+        to_run.append((key, ind))
+
+    run_inds = [ind for key, ind in to_run]
+    own_results = dict()    # without a cache, duplicates keep their own simulation result
+    with metrics.phase("evaluation"):
+        if multi_fidelity is not None:
+            fitnesses = multi_fidelity.evaluate_batch(run_inds, gen_num, toolbox.map)
+        else:
+            fitnesses = toolbox.map(toolbox.evaluate, run_inds, range(0, len(run_inds)),
+                                    itertools.repeat(gen_num, len(run_inds)))
+        for (key, ind), fit in zip(to_run, fitnesses):
+            if cache is not None:
+                cache.put(key, fit)
+            results[key] = fit
+            own_results[id(ind)] = fit
+            if on_result is not None:
+                on_result(key, fit)
+
+    for ind, key in zip(individuals, keys):
+        set_fitness(ind, own_results.get(id(ind), results[key]))
+    return len(run_inds)
+
+
+def set_fitness(ind, fit):
+    # the number of replications (racing) and their variance are kept on the individual,
+    # Fitness does not copy them
+    ind.fitness.values = fit
+    ind.n_simulation = getattr(fit, "n_simulation", None)
+    ind.variance = getattr(fit, "variance", None)
+
+
+def mutate_individual(mutant, type_SoS):
+    if type_SoS == "D":
+        toolbox.mutate_d(mutant)
+    elif type_SoS == "A":
+        toolbox.mutate_ack(mutant)
+    else:
+        toolbox.mutate_multi(mutant)
 
-        print("Re-evaluation...")
-        # Evaluate the individuals with an invalid fitness
-        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-        # fitnesses = map(toolbox.evaluate, invalid_ind)
-        fitnesses = map(toolbox.evaluate, invalid_ind, range(0, len(p_population)), itertools.repeat(g, len(invalid_ind)))
-        for ind, fit in zip(invalid_ind, fitnesses):
-            ind.fitness.values = fit
-        # The population is entirely replaced by the offspring
-        p_population[:] = offspring
 
-    p_population[:] = offspring + best
+def restore_toolbox(registered):
+    # the operators and the evaluation backend registered before main()
+    toolbox.__dict__.clear()
+    toolbox.__dict__.update(registered)
 
-    print()
-    print("Total length: ", len(p_population))
 
-    return p_population
+def pool_closer(pool):
+    # ExitStack exit callback: finish the pool's work, or stop the workers on an exception
+    def close(exc_type, exc, traceback):
+        if exc_type is None:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+        return False
+    return close
+
+
+def executor_closer(executor):
+    def close(exc_type, exc, traceback):
+        executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+        return False
+    return close
+
+
+def make_pool_map(pool):
+    # toolbox.map is called with several iterables like the builtin map;
+    # results are yielded as they arrive (in order), the metrics of the workers are merged
+    def pool_map(func, *iterables):
+        for result, worker_metrics in pool.imap(functools.partial(call_measured, func), zip(*iterables)):
+            metrics.merge(worker_metrics)
+            yield result
+    return pool_map
+
+
+def print_generation(gen_num, stats, n_evals):
+    print("Gen %s: max %.4f mean %.4f std %.4f min %.4f unique %d/%d evaluations %d" % (
+        gen_num, stats["max"], stats["mean"], stats["std"], stats["min"], stats["unique"], stats["size"], n_evals))
 
 
 def print_fitness(individuals):
@@ -171,26 +588,123 @@ def print_individual(individuals):
 
 
 if __name__ == '__main__':
-    start_time = time.clock()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of simulator processes evaluating in parallel (default: 1)")
+    parser.add_argument("--cache", default=CACHE_DB,
+                        help="fitness cache file (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always simulate, do not read or write the fitness cache")
+    parser.add_argument("--racing", type=int, default=None, metavar="CHUNK",
+                        help="adaptive replications: simulate in chunks of CHUNK and stop early")
+    parser.add_argument("--max-evals", type=int, default=None,
+                        help="steady-state GA: stop after this many simulations")
+    parser.add_argument("--max-time", type=float, default=None,
+                        help="steady-state GA: stop after this many seconds")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE,
+                        help="checkpoint file written after every generation (default: %(default)s)")
+    parser.add_argument("--no-checkpoint", action="store_true", help="do not write checkpoints")
+    parser.add_argument("--checkpoint-evals", action="store_true",
+                        help="also write the checkpoint after every finished evaluation")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the run saved in the checkpoint file")
+    parser.add_argument("--surrogate", type=int, default=None, metavar="POOL",
+                        help="breed POOL times the offspring and simulate only the best predicted ones")
+    parser.add_argument("--fidelity", type=int, nargs="+", default=None, metavar="N",
+                        help="multi-fidelity: replications of every stage, e.g. --fidelity 5 50")
+    parser.add_argument("--fidelity-margin", type=float, default=5.0,
+                        help="promote candidates within this margin of the stage's best (default: %(default)s)")
+    parser.add_argument("--metrics", default=METRICS_FILE,
+                        help="per-generation timing metrics as JSON lines (default: %(default)s)")
+    parser.add_argument("--metrics-prom", default=PROM_FILE,
+                        help="Prometheus text-format metrics file (default: %(default)s)")
+    parser.add_argument("--no-metrics", action="store_true", help="do not write metrics files")
+    parser.add_argument("--broker", nargs="?", const="127.0.0.1:" + str(BROKER_PORT), default=None,
+                        metavar="HOST:PORT", help="evaluate on remote workers (python broker.py worker HOST:PORT) "
+                                                  "(default: %(const)s)")
+    parser.add_argument("--broker-token", default=os.environ.get(BROKER_TOKEN_ENV),
+                        help="token the workers must send, required unless the broker listens on a loopback "
+                             "address (default: $" + BROKER_TOKEN_ENV + ")")
+    parser.add_argument("--islands", type=int, default=None, metavar="K",
+                        help="island model with K populations")
+    parser.add_argument("--migration-interval", type=int, default=5,
+                        help="generations between migrations (default: %(default)s)")
+    parser.add_argument("--migrants", type=int, default=2,
+                        help="best individuals sent by every island (default: %(default)s)")
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="ring",
+                        help="migration topology (default: %(default)s)")
+    parser.add_argument("--generation-log", default=GENERATION_LOG,
+                        help="one line of statistics per generation (default: %(default)s)")
+    parser.add_argument("--sim-log", choices=LOG_LEVELS, default="full",
+                        help="simulator output: full, one summary line per evaluation, or discard "
+                             "(default: %(default)s)")
+    parser.add_argument("--sim-log-max-mb", type=float, default=LOG_MAX_BYTES / 1024 / 1024,
+                        help="rotate and gzip the simulator log at this size (default: %(default)s)")
+    parser.add_argument("--sim-worker", default=None, metavar="CMD",
+                        help="evaluate with long-lived simulator processes started by CMD, "
+                             "e.g. \"python sim_stub.py\" (cached apart from the results of the jar)")
+    parser.add_argument("--candidates", default=STORE_DIR,
+                        help="directory of the content-addressed candidate files (default: %(default)s)")
+    parser.add_argument("--candidates-tmpfs", action="store_true",
+                        help="keep the candidate files in /dev/shm")
+    parser.add_argument("--candidates-max-mb", type=float, default=STORE_MAX_BYTES / 1024 / 1024,
+                        help="remove the least recently used candidate files above this size "
+                             "(default: %(default)s)")
+    parser.add_argument("--crossover", choices=CROSSOVER_MODES, default="two_point",
+                        help="two_point swaps whole policies; uniform, role and action exchange the free genes "
+                             "of the skeleton gene by gene, per role or per action (default: %(default)s)")
+    parser.add_argument("--scalar-mutation", action="store_true",
+                        help="mutate the individuals one by one instead of the whole offspring at once")
+    args = parser.parse_args()
+    if args.broker is not None and args.broker_token is None and not is_loopback(parse_address(args.broker)[0]):
+        parser.error("--broker on a public interface needs --broker-token (or $" + BROKER_TOKEN_ENV + ")")
+    if args.resume and args.no_checkpoint:
+        parser.error("--resume reads the checkpoint file, it cannot be used with --no-checkpoint")
+    if args.resume and (args.max_evals is not None or args.max_time is not None):
+        parser.error("--resume continues a generational run, it cannot be used with --max-evals/--max-time")
+    if args.islands is not None and (args.resume or args.surrogate is not None or args.max_evals is not None
+                                     or args.max_time is not None):
+        parser.error("--islands cannot be used with --resume/--surrogate/--max-evals/--max-time")
+    if args.fidelity is not None and (args.racing is not None or args.max_evals is not None
+                                      or args.max_time is not None):
+        parser.error("--fidelity works on generations, it cannot be used with --racing/--max-evals/--max-time")
+    if args.fidelity is not None:
+        try:
+            check_stages(args.fidelity)
+        except ValueError as e:
+            parser.error("--fidelity: " + str(e))
+
+    start_time = time.perf_counter()
     type_SoS = ""
-    with open('./json/SoSproperties.json') as f:
-        for line in f:
-            while True:
-                try:
-                    SoS_properties = json.loads(line)
-                    type_SoS = SoS_properties['typeSoS']
-                    break
-                except ValueError:
-                    line += next(f)
-
-    result_pop = main(type_SoS)
+    for SoS_properties, line, column in json_handle.iter_json_items('./json/SoSproperties.json'):
+        type_SoS = SoS_properties['typeSoS']
+
+    cache_file = None if args.no_cache else args.cache
+    checkpoint_file = None if args.no_checkpoint else args.checkpoint
+    result_pop = main(type_SoS, n_workers=args.workers, cache_file=cache_file, sim_worker_cmd=args.sim_worker,
+                      racing_chunk=args.racing, max_evals=args.max_evals, max_time=args.max_time,
+                      checkpoint_file=checkpoint_file, checkpoint_evals=args.checkpoint_evals,
+                      resume=args.resume, surrogate_pool=args.surrogate,
+                      fidelity=args.fidelity, fidelity_margin=args.fidelity_margin,
+                      metrics_file=None if args.no_metrics else args.metrics,
+                      prom_file=None if args.no_metrics else args.metrics_prom,
+                      broker_address=None if args.broker is None else parse_address(args.broker),
+                      broker_token=args.broker_token,
+                      n_islands=args.islands, migration_interval=args.migration_interval, n_migrants=args.migrants,
+                      topology=args.topology, generation_log_file=args.generation_log,
+                      sim_log_level=args.sim_log, sim_log_max_bytes=int(args.sim_log_max_mb * 1024 * 1024),
+                      candidate_dir=args.candidates, candidate_tmpfs=args.candidates_tmpfs,
+                      candidate_max_bytes=int(args.candidates_max_mb * 1024 * 1024),
+                      crossover_mode=args.crossover, batch_mutation=not args.scalar_mutation)
 
     for ind in result_pop:
         logging.debug(print(ind.fitness.values))
 
-    s_inds = sorted(result_pop, key=attrgetter("fitness"), reverse=True)
+    # low-fidelity results are never ranked above full evaluations
+    result_key = attrgetter("fitness") if args.fidelity is None else fidelity_key(args.fidelity[-1])
+    s_inds = sorted(result_pop, key=result_key, reverse=True)
 
-    end_time = time.clock()
+    end_time = time.perf_counter()
     running_time = end_time - start_time
 
     json_handle.make_policy_json("output_policy.json", s_inds[0])
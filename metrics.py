@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+""" Timing metrics of the GA loop.
+
+        Every process has one Metrics object (metrics) which sums the wall-clock time of
+        named phases (selection, clone, crossover, mutation, json_write, simulator, result_parse,
+        logging, ...) and counters (evaluations, cache_hits, replications).
+        Pool workers send the metrics of every call back with its result (call_measured),
+        the main process merges them.
+        MetricsExporter writes the metrics of every generation as one JSON line and keeps the
+        running totals in a Prometheus text-format file for the node_exporter textfile collector.
+"""
+
+METRICS_FILE = './json/metrics.jsonl'
+PROM_FILE = './json/sosps.prom'
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()    # SimulatorPool evaluates in threads
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def take(self):
+        # plain-data snapshot, the metrics start again from zero
+        with self.lock:
+            snapshot = {"seconds": dict(self.seconds), "calls": dict(self.calls), "counters": dict(self.counters)}
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, seconds in snapshot["seconds"].items():
+                self.seconds[name] += seconds
+            for name, calls in snapshot["calls"].items():
+                self.calls[name] += calls
+            for name, n in snapshot["counters"].items():
+                self.counters[name] += n
+
+
+metrics = Metrics()
+
+
+def call_measured(func, args):
+    # runs in a pool worker: the result and the metrics of this call
+    metrics.take()
+    result = func(*args)
+    return result, metrics.take()
+
+
+class MetricsExporter:
+    def __init__(self, filename=METRICS_FILE, prom_file=PROM_FILE, append=False):
+        self.filename = filename
+        self.prom_file = prom_file
+        self.start = time.time()
+        self.last = time.perf_counter()
+        self.totals = Metrics()
+        self.wall = 0.0
+        if filename is not None and not append and os.path.exists(filename):
+            os.remove(filename)
+
+    def export(self, generation, snapshot):
+        # snapshot: metrics.take() of the generation
+        now = time.perf_counter()
+        wall = now - self.last
+        self.last = now
+        self.totals.merge(snapshot)
+        self.wall += wall
+
+        if self.filename is not None:
+            record = {"generation": generation, "time": round(time.time(), 3), "wall_seconds": wall,
+                      "phases": {name: {"seconds": seconds, "calls": snapshot["calls"].get(name, 0)}
+                                 for name, seconds in sorted(snapshot["seconds"].items())},
+                      "counters": dict(sorted(snapshot["counters"].items()))}
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        if self.prom_file is not None:
+            self.write_prom(generation)
+
+    def write_prom(self, generation):
+        totals = self.totals.take()
+        self.totals.merge(totals)
+        lines = ["# HELP sosps_phase_seconds_total Wall-clock seconds spent in a GA phase.",
+                 "# TYPE sosps_phase_seconds_total counter"]
+        for name, seconds in sorted(totals["seconds"].items()):
+            lines.append('sosps_phase_seconds_total{phase="%s"} %.6f' % (name, seconds))
+        lines += ["# HELP sosps_phase_calls_total Number of times a GA phase ran.",
+                  "# TYPE sosps_phase_calls_total counter"]
+        for name, calls in sorted(totals["calls"].items()):
+            lines.append('sosps_phase_calls_total{phase="%s"} %d' % (name, calls))
+        for name, n in sorted(totals["counters"].items()):
+            lines += ["# HELP sosps_%s_total Number of %s." % (name, name.replace("_", " ")),
+                      "# TYPE sosps_%s_total counter" % name,
+                      "sosps_%s_total %d" % (name, n)]
+        lines += ["# HELP sosps_wall_seconds_total Wall-clock seconds of the exported generations.",
+                  "# TYPE sosps_wall_seconds_total counter",
+                  "sosps_wall_seconds_total %.6f" % self.wall,
+                  "# HELP sosps_generation Last finished generation.",
+                  "# TYPE sosps_generation gauge",
+                  "sosps_generation %d" % (generation if isinstance(generation, int) else -1),
+                  "# HELP sosps_start_time_seconds Start of the run since the epoch.",
+                  "# TYPE sosps_start_time_seconds gauge",
+                  "sosps_start_time_seconds %.3f" % self.start]
+        # the collector may read at any time: write a temporary file and rename it
+        tmp_file = self.prom_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.prom_file)
@@ -0,0 +1,194 @@
+import random
+import numpy as np
+from policy_op import value_map, mut_policy_ack, mut_policy_multi, mut_policy_directed
+from policy_array import COMPLIANCE
+
+""" Batch mutation of a whole offspring population.
+
+        Same semantics as policy_op.mut_policy_ack / _multi / _directed, for individuals of the
+        fixed skeleton of their SoS type: int(n_policies * m_portion) distinct policies of every
+        individual are mutated, an action policy by one of
+            method   (A, D, multi) a new method value [15], only for wait / release policies
+            enforce  (multi) enforce [17] flipped
+            action   (A, D, multi) a new value of its action gene
+        chosen uniformly, a compliance policy (A, multi) gets another compliance value [16].
+        The static facts of every policy (type, action gene, method value) come from the
+        skeleton, so all positions, choices and new values of a batch are drawn at once, from a
+        generator seeded by random for every batch (a checkpoint's random state covers it):
+        draw() returns the edits, apply_edits() writes them into the list form and
+        mutate_array() into the array form of policy_array. The copies of a compliance policy
+        are one list object in the list form (policy_op.Skeleton.aliases), mutate_array() keeps
+        their rows equal the same way.
+        Individuals of another length fall back to the scalar operator.
+"""
+
+CHOICES = {
+    "A": ("method", "action"),
+    "D": ("method", "action"),
+    "multi": ("method", "enforce", "action"),
+}
+SCALAR_MUTATION = {"A": mut_policy_ack, "D": mut_policy_directed, "multi": mut_policy_multi}
+
+# kinds of edits
+SET_VALUE = 0       # gene = value_map[gene][code]
+FLIP = 1            # enforce 1 -> 0, anything else -> 1
+OTHER_VALUE = 2     # compliance: uniformly another value than the current one
+
+compliance_values = value_map[COMPLIANCE]
+compliance_index = {value: idx for idx, value in enumerate(compliance_values)}
+
+
+class Edits:
+    # one edit per mutated policy, all arrays of the same length
+    def __init__(self, individual, policy, gene, kind, code, u):
+        self.individual = individual
+        self.policy = policy
+        self.gene = gene
+        self.kind = kind
+        self.code = code    # index into value_map[gene] (SET_VALUE)
+        self.u = u          # uniform draw in [0, 1) (OTHER_VALUE)
+
+    def __len__(self):
+        return len(self.individual)
+
+
+class BatchMutation:
+    def __init__(self, skeleton, type_SoS, m_portion=0.5, rng=None):
+        if type_SoS not in ("A", "D"):
+            type_SoS = "multi"
+        self.type_SoS = type_SoS
+        self.choices = CHOICES[type_SoS]
+        self.m_portion = m_portion
+        self.n_policies = len(skeleton)
+        self.rng = rng      # None: every batch is seeded from random (restored on --resume)
+
+        self.policy_type = np.array([policy[0] for policy in skeleton.genes], dtype=np.int8)
+        # the row an edit of a policy is written to, its aliases are copied from there
+        self.source = np.arange(self.n_policies)
+        for p, source_idx in skeleton.aliases:
+            self.source[p] = source_idx
+        self.alias_policy = np.array([p for p, source_idx in skeleton.aliases], dtype=np.intp)
+        self.action_gene = np.full(self.n_policies, -1, dtype=np.intp)
+        self.has_method = np.zeros(self.n_policies, dtype=bool)
+        for p, g in skeleton.free_positions:
+            if 6 <= g <= 14:
+                self.action_gene[p] = g
+            elif g == 15:
+                self.has_method[p] = True   # wait / release
+        self.domain_size = np.array([len(value_map[g]) if g in value_map else 0 for g in range(0, 18)],
+                                    dtype=np.intp)
+        self.value_table = np.zeros((18, self.domain_size.max()), dtype=np.int8)
+        for g in range(0, 18):
+            if g != COMPLIANCE and self.domain_size[g]:
+                self.value_table[g, 0:self.domain_size[g]] = list(value_map[g])
+        self.n_mutated = 0
+        self.n_fallback = 0
+
+    def draw(self, n):
+        # edits of n individuals
+        k = int(self.n_policies * self.m_portion)
+        if n == 0 or k == 0:
+            empty = np.zeros(0, dtype=np.intp)
+            return Edits(empty, empty, empty, empty, empty, np.zeros(0))
+        rng = self.rng if self.rng is not None else np.random.default_rng(random.getrandbits(64))
+        # k distinct policies per individual: the k smallest of n_policies uniform keys
+        keys = rng.random((n, self.n_policies))
+        policy = np.argpartition(keys, k - 1, axis=1)[:, 0:k].ravel()
+        individual = np.repeat(np.arange(n), k)
+        choice = rng.integers(0, len(self.choices), size=len(policy))
+        u = rng.random(len(policy))
+
+        ptype = self.policy_type[policy]
+        gene = np.full(len(policy), -1, dtype=np.intp)
+        kind = np.full(len(policy), SET_VALUE, dtype=np.intp)
+        action = ptype == 1
+        chosen = np.array(self.choices)[choice]
+        method = action & (chosen == "method") & self.has_method[policy]
+        gene[method] = 15
+        gene[action & (chosen == "action")] = self.action_gene[policy[action & (chosen == "action")]]
+        enforce = action & (chosen == "enforce")
+        gene[enforce] = 17
+        kind[enforce] = FLIP
+        if self.type_SoS != "D":
+            compliance = ptype == 2
+            gene[compliance] = COMPLIANCE
+            kind[compliance] = OTHER_VALUE
+
+        keep = gene != -1   # e.g. a method choice on a policy without a method value
+        gene = gene[keep]
+        code = (u[keep] * self.domain_size[gene]).astype(np.intp)
+        return Edits(individual[keep], policy[keep], gene, kind[keep], code, u[keep])
+
+    def mutate(self, population):
+        # mutates the individuals (list form) in place
+        aligned = [ind for ind in population if len(ind) == self.n_policies]
+        for ind in population:
+            if len(ind) != self.n_policies:
+                SCALAR_MUTATION[self.type_SoS](ind, self.m_portion)
+                self.n_fallback += 1
+        apply_edits(aligned, self.draw(len(aligned)))
+        self.n_mutated += len(aligned)
+        return population
+
+    def mutate_array(self, genes, edits=None):
+        # mutates a (n_individuals, n_policies, 18) array of policy_array in place
+        if edits is None:
+            edits = self.draw(len(genes))
+        p = self.source[edits.policy]
+        # edits of aliased policies can hit the same gene, they are applied in order like apply_edits
+        rank = repeat_rank(np.ravel_multi_index((edits.individual, p, edits.gene), genes.shape))
+        for r in range(0, rank.max(initial=-1) + 1):
+            sel = rank == r
+            i, g = edits.individual[sel], edits.gene[sel]
+            current = genes[i, p[sel], g]
+            new = self.value_table[g, edits.code[sel]]
+
+            kind = edits.kind[sel]
+            flip = kind == FLIP
+            new[flip] = np.where(current[flip] == 1, 0, 1)
+            other = kind == OTHER_VALUE
+            new[other] = other_index(current[other], edits.u[sel][other])
+            genes[i, p[sel], g] = new
+        genes[:, self.alias_policy] = genes[:, self.source[self.alias_policy]]
+        return genes
+
+
+def repeat_rank(keys):
+    # for every key, the number of equal keys before it
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    positions = np.arange(len(keys))
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group_start = np.maximum.accumulate(np.where(first, positions, 0))
+    rank = np.empty(len(keys), dtype=np.intp)
+    rank[order] = positions - group_start
+    return rank
+
+
+def other_index(current, u):
+    # uniformly one of the compliance indices except current (any index if current is -1)
+    n_values = len(compliance_values)
+    known = current >= 0
+    r = np.where(known, u * (n_values - 1), u * n_values).astype(np.intp)
+    return np.where(known & (r >= current), r + 1, r)
+
+
+def apply_edits(population, edits):
+    # the new values are taken from value_map, so they have the types of the scalar operators
+    n_values = len(compliance_values)
+    for i, p, g, kind, code, u in zip(edits.individual.tolist(), edits.policy.tolist(), edits.gene.tolist(),
+                                      edits.kind.tolist(), edits.code.tolist(), edits.u.tolist()):
+        policy = population[i][p]
+        if kind == SET_VALUE:
+            policy[g] = value_map[g][code]
+        elif kind == FLIP:
+            policy[g] = 0 if policy[g] == 1 else 1
+        else:
+            # same draw as other_index
+            current = compliance_index.get(policy[g], -1)
+            if current < 0:
+                policy[g] = compliance_values[int(u * n_values)]
+            else:
+                r = int(u * (n_values - 1))
+                policy[g] = compliance_values[r + 1 if r >= current else r]
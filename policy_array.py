@@ -0,0 +1,106 @@
+import numpy as np
+from policy_op import value_map
+
+""" Array representation of a population.
+
+        A population is stored as one dense int8 array of shape (n_individuals, n_policies, 18)
+        instead of lists of 18-element lists. The compliance gene [16] holds the index into
+        value_map[16] (-1 stays -1). Individuals shorter than the longest one are padded
+        with rows of PAD. The conversion to and from the list form is lossless, so a decoded
+        individual can be passed to json_handle.make_policy_json as before.
+        This is a storage and batch-operator form (mutation.BatchMutation.mutate_array,
+        benchmark.py), the GA in main.py still keeps its population as lists.
+"""
+
+N_GENES = 18
+COMPLIANCE = 16
+PAD = -2
+
+compliance_values = np.array(value_map[COMPLIANCE], dtype=np.float64)
+
+
+def encode_policies(policies):
+    # list of numeric policies -> (n_policies, 18) int8 array
+    genes = np.array(policies, dtype=np.float64).reshape(-1, N_GENES)
+
+    compliance = genes[:, COMPLIANCE]
+    used = compliance != -1
+    comp_idx = np.searchsorted(compliance_values, compliance[used])
+    comp_idx = np.minimum(comp_idx, len(compliance_values) - 1)
+    if not np.array_equal(compliance_values[comp_idx], compliance[used]):
+        raise ValueError("Compliance value not in value_map[16]: " + str(compliance[used]))
+    genes[used, COMPLIANCE] = comp_idx
+
+    if not np.array_equal(genes, np.rint(genes)) or genes.min(initial=0) < -1 or genes.max(initial=0) > 127:
+        raise ValueError("Policy gene cannot be stored as a small int")
+    return genes.astype(np.int8)
+
+
+def population_to_array(population):
+    n_policies = max((len(ind) for ind in population), default=0)
+    if all(len(ind) == n_policies for ind in population):
+        # fixed skeleton: encode everything at once
+        flat = [policy for ind in population for policy in ind]
+        return encode_policies(flat).reshape(len(population), n_policies, N_GENES)
+
+    genes = np.full((len(population), n_policies, N_GENES), PAD, dtype=np.int8)
+    for i, ind in enumerate(population):
+        genes[i, 0:len(ind)] = encode_policies(ind)
+    return genes
+
+
+def decode_individual(genes, container=list):
+    # (n_policies, 18) array -> container of numeric policies (list form)
+    policies = genes[genes[:, 0] != PAD].tolist()
+    for policy in policies:
+        if policy[COMPLIANCE] != -1:
+            policy[COMPLIANCE] = value_map[COMPLIANCE][policy[COMPLIANCE]]
+    return container(policies)
+
+
+def array_to_population(genes, container=list):
+    return [decode_individual(ind_genes, container) for ind_genes in genes]
+
+
+def individual_lengths(genes):
+    return np.count_nonzero(genes[:, :, 0] != PAD, axis=1)
+
+
+class SkeletonArray:
+    # a compiled policy_op.Skeleton in array form
+    def __init__(self, skeleton):
+        self.skeleton = skeleton
+        self.genes = encode_policies(skeleton.genes)
+        free = np.array(skeleton.free_positions, dtype=np.intp).reshape(-1, 2)
+        self.free_policy = free[:, 0]
+        self.free_gene = free[:, 1]
+        aliases = np.array(skeleton.aliases, dtype=np.intp).reshape(-1, 2)
+        self.alias_policy = aliases[:, 0]
+        self.alias_source = aliases[:, 1]
+        # encoded domain values, row i holds the values of free gene i (padded)
+        self.domain_sizes = np.array([len(domain) for domain in skeleton.domains], dtype=np.intp)
+        self.domain_codes = np.zeros((len(skeleton.domains), max(self.domain_sizes, default=1)), dtype=np.int8)
+        for i, domain in enumerate(skeleton.domains):
+            if self.free_gene[i] == COMPLIANCE:
+                self.domain_codes[i, 0:len(domain)] = np.arange(len(domain))
+            else:
+                self.domain_codes[i, 0:len(domain)] = domain
+
+    def draw_free_genes(self, n, rng):
+        # (n, n_free) uniform draws from every free gene's domain
+        draws = (rng.random((n, len(self.domain_sizes))) * self.domain_sizes).astype(np.intp)
+        return self.domain_codes[np.arange(len(self.domain_sizes)), draws]
+
+    def new_population(self, n, rng=None):
+        # n individuals at once: copy the template, fill all free genes in bulk
+        if rng is None:
+            rng = np.random.default_rng()
+        genes = np.repeat(self.genes[np.newaxis], n, axis=0)
+        genes[:, self.free_policy, self.free_gene] = self.draw_free_genes(n, rng)
+        genes[:, self.alias_policy] = genes[:, self.alias_source]
+        return genes
+
+
+def fitness_array(population):
+    # first fitness value of every individual, nan if it is not evaluated
+    return np.array([ind.fitness.values[0] if ind.fitness.valid else np.nan for ind in population])
@@ -1,5 +1,6 @@
 import traceback
 import sys
+import numpy as np
 
 """ Representation of a policy
         ------------------------------------------------------------------------
@@ -177,6 +178,87 @@ def check_policy(policy):
     return True
 
 
+# Error codes of check_policy_batch, in the order check_policy tests them
+POLICY_OK = 0
+TYPE_ERROR = 1
+ROLE_ERROR = 2
+CONDITION_ERROR = 3
+ACTION_ERROR = 4
+COMPLIANCE_ERROR = 5
+ENFORCE_ERROR = 6
+
+# role value -> which condition (1-4) / action (6-14) indices belong to it
+role_cond_table = np.zeros((max(role_cond_map) + 1, 18), dtype=bool)
+role_action_table = np.zeros((max(role_action_map) + 1, 18), dtype=bool)
+for role_value in role_cond_map:
+    role_cond_table[role_value, role_cond_map[role_value]] = True
+    role_action_table[role_value, role_action_map[role_value]] = True
+
+# value_table[idx, v + 1]: v is in value_map[idx], for genes 0-14 and -1 <= v < 127
+OUT_OF_RANGE = 128
+value_table = np.zeros((15, OUT_OF_RANGE + 1), dtype=bool)
+for gene_idx in range(0, 15):
+    for gene_value in value_map[gene_idx]:
+        value_table[gene_idx, gene_value + 1] = True
+
+
+def check_policy_batch(genes):
+    # Vectorized check_policy for an array of policies (..., 18).
+    # Returns a boolean mask of valid policies and the error code of the first failed check.
+    genes = np.asarray(genes)
+    shape = genes.shape[:-1]
+    # one contiguous vector per gene
+    cols = np.ascontiguousarray(genes.reshape(-1, 18).T)
+    errors = np.zeros(cols.shape[1], dtype=np.int8)
+
+    def fail(failed, code):
+        errors[(errors == POLICY_OK) & failed] = code
+
+    def member(idx):
+        # membership of gene idx in value_map[idx] through a table lookup
+        col = cols[idx]
+        codes = np.clip(col, -1, OUT_OF_RANGE - 1).astype(np.intp) + 1
+        if not np.issubdtype(col.dtype, np.integer):
+            codes[np.rint(col) != col] = OUT_OF_RANGE
+        return value_table[idx][codes]
+
+    policy_type = cols[0]
+    is_action = policy_type == 1
+    is_compliance = policy_type == 2
+    fail(~member(0), TYPE_ERROR)
+    role_valid = member(5)
+    fail(~role_valid, ROLE_ERROR)
+    # rows with an invalid role already failed, index them with role 0 (no indices)
+    role_idx = np.where(role_valid, cols[5], 0).astype(np.intp)
+
+    # conditions: at least one, only role-related ones, and every role condition has a proper value
+    any_cond = np.zeros(len(errors), dtype=bool)
+    cond_error = np.zeros(len(errors), dtype=bool)
+    for idx in range(1, 5):
+        cond_set = cols[idx] != -1
+        role_cond = role_cond_table[:, idx][role_idx]
+        any_cond |= cond_set
+        cond_error |= (cond_set & ~role_cond) | (role_cond & ~member(idx))
+    fail(~any_cond | cond_error, CONDITION_ERROR)
+
+    # actions: exactly one, with a proper method (action policy) or marked by 0 (compliance policy)
+    n_actions = np.zeros(len(errors), dtype=np.int8)
+    action_error = np.zeros(len(errors), dtype=bool)
+    for idx in range(6, 15):
+        action_set = cols[idx] != -1
+        role_action = role_action_table[:, idx][role_idx] & action_set
+        n_actions += action_set
+        action_error |= is_action & role_action & ~member(idx)
+        action_error |= is_compliance & role_action & (cols[idx] != 0)
+    fail((n_actions != 1) | action_error, ACTION_ERROR)
+
+    fail((is_action & (cols[16] != -1)) | (is_compliance & (cols[16] == -1)), COMPLIANCE_ERROR)
+    fail(is_action & (cols[17] == -1), ENFORCE_ERROR)
+
+    errors = errors.reshape(shape)
+    return errors == POLICY_OK, errors
+
+
 def if_contains_all(value, t_list):
     return all(i == value for i in t_list)
 
@@ -1,51 +1,113 @@
 import os
-import logging
+import shutil
+import math
+import time
 import subprocess
-from json_handle import make_policy_json
+import multiprocessing.util
+from candidate_store import get_store, configure_store
+from metrics import metrics
+from racing import SimFitness
+from sim_result import read_result, remove_results, ResultFormatError
+from sim_worker import SimulatorError
+from sim_log import SIMUL_LOG, configure_log, get_log_sink, forget_log, close_log, merge_log, summary_line
+
+SIMUL_JAR = os.path.abspath('SIMVASoS-MCI_NotExcluded_NewComp.jar')
+# simulator command, called with the candidate file and the number of replications
+SIMUL_CMD = ["java", "-jar", SIMUL_JAR]
+WORKER_DIR = './json/workers'
+
+# working directory of the current process (each pool worker gets its own)
+work_dir = '.'
+
+
+def init_worker(base_dir=WORKER_DIR):
+    # Called once in every pool worker.
+    # SIMVA-SoS writes Sim_Result.txt into its cwd, so concurrent runs need separate directories.
+    global work_dir
+    work_dir = os.path.abspath(os.path.join(base_dir, str(os.getpid())))
+    os.makedirs(work_dir, exist_ok=True)
+
+    # the simulator still resolves ./json/... relative to its cwd
+    json_link = os.path.join(work_dir, 'json')
+    if not os.path.lexists(json_link):
+        os.symlink(os.path.abspath('./json'), json_link)
+
+    # the store of the parent is not shared, the files are
+    configure_store()
+
+    # every worker writes its own simulator log next to its results
+    forget_log()
+    configure_log(filename=os.path.join(work_dir, os.path.basename(SIMUL_LOG)))
+    multiprocessing.util.Finalize(None, close_log, exitpriority=10)
+
+
+def worker_base_dir():
+    # directory of the pool workers of this process, removed by collect_workers
+    return os.path.join(WORKER_DIR, str(os.getpid()))
+
+
+def collect_workers(base_dir):
+    # Called when the pool has stopped: the simulator logs of the workers are appended
+    # to the log of this process and the worker directories are removed.
+    if not os.path.isdir(base_dir):
+        return
+    for name in sorted(os.listdir(base_dir)):
+        worker_log = os.path.join(base_dir, name, os.path.basename(SIMUL_LOG))
+        try:
+            merge_log(worker_log, get_log_sink())
+        except OSError as e:
+            print("Cannot merge the simulator log of worker", name, ":", e)
+    shutil.rmtree(base_dir, ignore_errors=True)
 
-SIMUL_LOG = './json/simulation.log'
 
 # def evaluate(indiv_poli_set):
-def evaluate(indiv_poli_set, file_num, gen_num):
+def evaluate(indiv_poli_set, file_num, gen_num, n_simulation=50):
     # java simulator combine
     # one file --> execution --> result value
     # result = [file1, file2, ... file_#population]
     # compare current best solution
 
-    logging.basicConfig(filename=SIMUL_LOG, format='%(message)s', level=logging.DEBUG)
-    # logging.basicConfig(filename=SIMUL_LOG, level=logging.DEBUG)
-
     # command = "java -jar SIMVASoS-MCI_original.jar ./json/candidates/"
     # command = "java -jar SIMVASoS-MCI_NotExcluded.jar ./json/candidates/"
-    command = "java -jar SIMVASoS-MCI_NotExcluded_NewComp.jar ./json/candidates/"
-    # file_name = "cand_poli_set.json"
-    file_name = str(gen_num)+"_cand_poli_set" + str(file_num) + ".json"
-    # file_name = "archivedPolicy.json
-    n_simulation = 50
-    total_command = command+file_name+" "+str(n_simulation)
-
-    make_policy_json(file_name, indiv_poli_set)
+    command = SIMUL_CMD
+    # the candidate file is named by its content and written only once (candidate_store)
+    store = get_store()
+    key, cand_file = store.put(indiv_poli_set)
+    file_name = str(gen_num) + "_cand_poli_set" + str(file_num) + "_" + key + ".json"
+    # absolute paths, the simulator runs inside the worker directory
+    total_command = command + [cand_file, str(n_simulation)]
 
+    metrics.count("evaluations")
+    metrics.count("replications", n_simulation)
+    remove_results(work_dir)
+    start = time.perf_counter()
     try:
         # run SIMVA-SoS MCI (Java Program)
-        proc = subprocess.run(total_command.split(), stdout=subprocess.PIPE)
-        for line in proc.stdout.splitlines():
-            logging.debug(line.decode('utf-8'))
-            # print(line.decode('utf-8'))
-    except subprocess.CalledProcessError as e:
-        print(e.output)
-
-    # read the result file
-    eval_result = 0.0
-    with open("Sim_Result.txt") as f:
-        while True:
-            line = f.read().strip()
-            if not line:
-                break
-            eval_result = float(line)
-    print("Simulation Result:", eval_result, "%")
-    return eval_result,
-
-
+        with metrics.phase("simulator"):
+            proc = subprocess.run(total_command, stdout=subprocess.PIPE, cwd=work_dir)
+        output = proc.stdout
+    finally:
+        store.release(key)
+    seconds = time.perf_counter() - start
 
+    # read the result file: every replication from Sim_Result.bin, or the mean from Sim_Result.txt
+    with metrics.phase("result_parse"):
+        try:
+            result = read_result(work_dir, n_simulation)
+        except (OSError, ResultFormatError) as e:
+            get_log_sink().capture("=== " + file_name + " n=" + str(n_simulation), output,
+                                   summary_line(file_name, n_simulation, "none", output, seconds))
+            raise SimulatorError("No simulation result for " + cand_file + " (exit status " + str(proc.returncode)
+                                 + ", " + str(e) + "), output:\n"
+                                 + output[-2000:].decode('utf-8', errors='replace'))
+    eval_result = result.mean
 
+    # the output is written by the log sink's thread
+    with metrics.phase("logging"):
+        get_log_sink().capture("=== " + file_name + " n=" + str(n_simulation), output,
+                               summary_line(file_name, n_simulation, eval_result, output, seconds))
+    if not math.isnan(result.variance):
+        print("Simulation Result:", eval_result, "% +-", round(result.half_width, 4))
+        return SimFitness((eval_result,), result.n, result.variance)
+    print("Simulation Result:", eval_result, "%")
+    return SimFitness((eval_result,), n_simulation)
@@ -1,6 +1,6 @@
 import random
 from json_handle import read_policy
-from policy_check import check_policy, check_full_description, check_one_description, if_contains_all
+from policy_check import check_full_description, check_one_description, if_contains_all
 import itertools
 
 """ Representation of a policy
@@ -146,141 +146,109 @@ def make_combination_comp(action):
     return list(itertools.product(*conditions))
 
 
-def gen_individual_ack():
-    policy_set = list()
+class Skeleton:
+    # Policy structure shared by every individual of one SoS type, compiled once.
+    # genes: template policies (free genes hold -1)
+    # free_positions: (policy index, gene index) of the random genes, domains: their values
+    # aliases: (policy index, source index), the policy is the same list object as its source
+    def __init__(self, genes, free_positions, domains, aliases=()):
+        self.genes = genes
+        self.free_positions = free_positions
+        self.domains = domains
+        self.aliases = list(aliases)
+
+    def __len__(self):
+        return len(self.genes)
+
+    def new_individual(self, container=list):
+        policy_set = [list(policy) for policy in self.genes]
+        for (policy_idx, gene_idx), domain in zip(self.free_positions, self.domains):
+            policy_set[policy_idx][gene_idx] = domain[random.randint(0, len(domain) - 1)]
+        for policy_idx, source_idx in self.aliases:
+            policy_set[policy_idx] = policy_set[source_idx]
+        return container(policy_set)
+
+
+def compile_skeleton(type_SoS):
+    # type_SoS: "A" (acknowledged), "D" (directed), anything else is multi
+    genes = list()
+    free_positions = list()
+    domains = list()
+    aliases = list()
+
+    def add_free(gene_idx, domain):
+        # free gene of the policy which is appended next
+        free_positions.append((len(genes), gene_idx))
+        domains.append(list(domain))
+
     # action policies
     for role in value_map[5]:  # role = 1, 2, 3
-        policy_type = 1
         for action in role_action_map[role]:
-            combinations = make_combination(action)
-            for combination in combinations:
-                policy = [None] * 18
-                policy[0] = policy_type
+            for combination in make_combination(action):
+                policy = [-1] * 18
+                policy[0] = 1
                 policy[5] = role
-                policy[17] = 0
-                policy[action] = select_value_by_idx(action)  # set action method on action name
-                # condition
                 for cond, cond_value in zip(action_cond_map[action], combination):
                     policy[cond] = cond_value
-                # method value
-                if policy[11] is not None or policy[14] is not None:
-                    policy[15] = select_value_by_idx(15)
-                # make rest of indices to invalid(-1)
-                for pol_idx in range(0, len(policy)):
-                    if policy[pol_idx] is None:
-                        policy[pol_idx] = -1
-                # print(policy)
-                policy_set.append(policy)
-
-    # compliance policies
-    for role in value_map[5]:
-        policy_type = 2
-        for action in role_action_map[role]:
-            policy = [None] * 18
-            policy[0] = policy_type
-            policy[5] = role
-            # policy[16] = 0.9  # compliance value
-            policy[16] = select_value_by_idx(16)  # compliance value
-            policy[action] = 0  # mark on action
-            for cond_value in value_map[1]:  # MCI level condition
-                policy[1] = cond_value
-
-                # make the rest of indices to invalid (-1)
-                for pol_idx in range(0, len(policy)):
-                    if policy[pol_idx] is None:
-                        policy[pol_idx] = -1
-                policy_set.append(policy)
-    return policy_set
+                add_free(action, value_map[action])     # action method
+                if action in (11, 14):                  # wait, release have a method value
+                    add_free(15, value_map[15])
+                if type_SoS == "A":
+                    policy[17] = 0
+                elif type_SoS == "D":
+                    policy[17] = 1
+                else:
+                    add_free(17, value_map[17])         # enforce or not
+                genes.append(policy)
+
+    # compliance policies: as in the generators, one policy appended once per MCI level,
+    # so all copies hold the last MCI level and share one compliance value
+    if type_SoS != "D":
+        for role in value_map[5]:
+            for action in role_action_map[role]:
+                policy = [-1] * 18
+                policy[0] = 2
+                policy[5] = role
+                policy[action] = 0  # mark on action
+                policy[1] = value_map[1][-1]
+                add_free(16, value_map[16])             # compliance value
+                source_idx = len(genes)
+                for _ in value_map[1]:
+                    if len(genes) != source_idx:
+                        aliases.append((len(genes), source_idx))
+                    genes.append(list(policy))
 
+    return Skeleton(genes, free_positions, domains, aliases)
 
-def gen_individual_multi():   #
-    policy_set = list()
-    # action policies
-    for role in value_map[5]:   # role = 1, 2, 3
-        policy_type = 1
-        for action in role_action_map[role]:
-            combinations = make_combination(action)
-            for combination in combinations:
-                policy = [None] * 18
-                policy[0] = policy_type
-                policy[5] = role
-                policy[17] = select_value_by_idx(17)    # enforce or not
-                policy[action] = select_value_by_idx(action)    # set action method on action name
-                # condition
-                for cond, cond_value in zip(action_cond_map[action], combination):
-                    policy[cond] = cond_value
-                # method value
-                if policy[11] is not None or policy[14] is not None:
-                    policy[15] = select_value_by_idx(15)
-                # make rest of indices to invalid(-1)
-                for pol_idx in range(0, len(policy)):
-                    if policy[pol_idx] is None:
-                        policy[pol_idx] = -1
-                # print(policy)
-                policy_set.append(policy)
-    # compliance policies
-    for role in value_map[5]:
-        policy_type = 2
-        for action in role_action_map[role]:
-            policy = [None] * 18
-            policy[0] = policy_type
-            policy[5] = role
-            # policy[16] = 0.9        # compliance value
-            policy[16] = select_value_by_idx(16)        # compliance value
-            policy[action] = 0      # mark on action
-            for cond_value in value_map[1]:            # MCI level condition
-                policy[1] = cond_value
-
-            # make the rest of indices to invalid (-1)
-                for pol_idx in range(0, len(policy)):
-                    if policy[pol_idx] is None:
-                        policy[pol_idx] = -1
-                policy_set.append(policy)
 
-    return policy_set
+skeletons = dict()
+
+
+def get_skeleton(type_SoS):
+    if type_SoS not in ("A", "D"):
+        type_SoS = "multi"
+    if type_SoS not in skeletons:
+        skeletons[type_SoS] = compile_skeleton(type_SoS)
+    return skeletons[type_SoS]
+
+
+def gen_individual_ack():
+    return get_skeleton("A").new_individual()
+
+
+def gen_individual_multi():
+    return get_skeleton("multi").new_individual()
 
 
 def gen_individual_directed():
-    policy_set = list()
-    # action policies
-    for role in value_map[5]:  # role = 1, 2, 3
-        policy_type = 1
-        for action in role_action_map[role]:
-            combinations = make_combination(action)
-            for combination in combinations:
-                policy = [None] * 18
-                policy[0] = policy_type
-                policy[5] = role
-                policy[17] = 1
-                # set action method on action name
-                policy[action] = select_value_by_idx(action)
-                for cond, cond_value in zip(action_cond_map[action], combination):
-                    policy[cond] = cond_value
-                # method value
-                if policy[11] is not None or policy[14] is not None:
-                    policy[15] = select_value_by_idx(15)
-                # make rest of indices to invalid(-1)
-                for pol_idx in range(0, len(policy)):
-                    if policy[pol_idx] is None:
-                        policy[pol_idx] = -1
-                # print(policy)
-                policy_set.append(policy)
-    # print("Generated Set of Policies", len(policy_set))
-    return policy_set
+    return get_skeleton("D").new_individual()
 
 
 def mut_policy_ack(policy_set, m_portion):
     # in some probability, a policy is mutated by deletion, addition, or modification
 
-    idx_list = list()
-    for i in range(0, len(policy_set)-1):
-        idx_list.append(i)
-
-    to_be_mutated_idx = list()
-    for i in range(0, int(len(policy_set)*m_portion)):
-        num = random.randint(0, len(idx_list)-1)
-        to_be_mutated_idx.append(idx_list[num])
-        del idx_list[num]
+    # distinct policies, the last one included
+    to_be_mutated_idx = random.sample(range(0, len(policy_set)), int(len(policy_set) * m_portion))
 
     for mut_idx in to_be_mutated_idx:
         policy = policy_set[mut_idx]
@@ -323,15 +291,8 @@ def mut_policy_ack(policy_set, m_portion):
 def mut_policy_multi(policy_set, m_portion):
     # in some probability, a policy is mutated by deletion, addition, or modification
 
-    idx_list = list()
-    for i in range(0, len(policy_set)-1):
-        idx_list.append(i)
-
-    to_be_mutated_idx = list()
-    for i in range(0, int(len(policy_set)*m_portion)):
-        num = random.randint(0, len(idx_list)-1)
-        to_be_mutated_idx.append(idx_list[num])
-        del idx_list[num]
+    # distinct policies, the last one included
+    to_be_mutated_idx = random.sample(range(0, len(policy_set)), int(len(policy_set) * m_portion))
 
     for mut_idx in to_be_mutated_idx:
         policy = policy_set[mut_idx]
@@ -367,15 +328,8 @@ def mut_policy_multi(policy_set, m_portion):
 def mut_policy_directed(policy_set, m_portion):
     # in some probability, a policy is mutated by deletion, addition, or modification
 
-    idx_list = list()
-    for i in range(0, len(policy_set) - 1):
-        idx_list.append(i)
-
-    to_be_mutated_idx = list()
-    for i in range(0, int(len(policy_set) * m_portion)):
-        num = random.randint(0, len(idx_list) - 1)
-        to_be_mutated_idx.append(idx_list[num])
-        del idx_list[num]
+    # distinct policies, the last one included
+    to_be_mutated_idx = random.sample(range(0, len(policy_set)), int(len(policy_set) * m_portion))
 
     for mut_idx in to_be_mutated_idx:
         policy = policy_set[mut_idx]
@@ -407,12 +361,7 @@ def gen_individual(ind_size):
     # individual means a set of policies
     policy_set = list()
     for i in range(0, ind_size):
-        policy = gen_policy()
-        while not check_policy(policy):
-            policy = gen_policy()
-            if check_policy(policy):
-                break
-        policy_set.append(policy)
+        policy_set.append(sample_policy())
     return policy_set
 
 
@@ -468,12 +417,7 @@ def mut_policy(policy_set, indpb):
 
     if mut_type_prob < 0.2:
         # mutation by addition
-        policy = gen_policy()
-        while not check_policy(policy):
-            policy = gen_policy()
-            if check_policy(policy):
-                break
-        policy_set.append(policy)
+        policy_set.append(sample_policy())
     elif mut_type_prob < 0.4:
         if len(policy_set) > 2:
             del_idx = random.randint(0, len(policy_set)-1)
@@ -481,15 +425,127 @@ def mut_policy(policy_set, indpb):
     elif mut_type_prob < 1.0:
         for idx in range(0, len(policy_set)-1):
             if random.random() < indpb:
-                copied_policy = list(policy_set[idx])
-                copied_policy = mut_by_modify(copied_policy)
-                while not check_policy(copied_policy):
-                    copied_policy = list(policy_set[idx])
-                    copied_policy = mut_by_modify(copied_policy)
-                policy_set[idx] = copied_policy
+                policy_set[idx] = neighbour_policy(policy_set[idx])
     return policy_set,
 
 
+# Valid-by-construction sampling
+# check_policy accepts a policy only if every condition of its role is set, so a valid policy
+# is built directly instead of regenerating gen_policy() until it passes.
+
+def sample_policy():
+    # Same distribution as gen_policy() conditioned on check_policy(), without rejection.
+    policy = [-1] * 18
+    policy_type = select_value_by_idx(0)
+    policy[0] = policy_type
+    role = select_value_by_idx(5)
+    policy[5] = role
+    action_list = role_action_map[role]
+    action_idx = action_list[select_idx(action_list)]
+
+    if policy_type == 1:    # action policy
+        policy[action_idx] = select_value_by_idx(action_idx)
+        policy[17] = select_value_by_idx(17)
+    elif policy_type == 2:  # compliance policy
+        policy[action_idx] = 0
+        policy[16] = select_value_by_idx(16)
+
+    for cond_idx in role_cond_map[role]:
+        policy[cond_idx] = select_value_by_idx(cond_idx)
+    return policy
+
+
+def enumerate_valid_policies():
+    # every valid policy gen_policy() can produce, in a fixed order
+    policies = list()
+    for policy_type in value_map[0]:
+        for role in value_map[5]:
+            cond_indices = role_cond_map[role]
+            for cond_values in itertools.product(*[value_map[idx] for idx in cond_indices]):
+                for action_idx in role_action_map[role]:
+                    if policy_type == 1:
+                        tails = [(method, -1, enforce) for method in value_map[action_idx] for enforce in value_map[17]]
+                    else:
+                        tails = [(0, compliance, -1) for compliance in value_map[16]]
+                    for action_value, compliance, enforce in tails:
+                        policy = [-1] * 18
+                        policy[0] = policy_type
+                        policy[5] = role
+                        for cond_idx, cond_value in zip(cond_indices, cond_values):
+                            policy[cond_idx] = cond_value
+                        policy[action_idx] = action_value
+                        policy[16] = compliance
+                        policy[17] = enforce
+                        policies.append(tuple(policy))
+    return policies
+
+
+valid_policies = enumerate_valid_policies()
+valid_policy_index = {policy: idx for idx, policy in enumerate(valid_policies)}
+
+
+def sample_uniform_policy():
+    # uniform over all valid policies (every valid policy has the same chance)
+    return list(valid_policies[random.randint(0, len(valid_policies) - 1)])
+
+
+def select_other_value(values, current):
+    # uniform among the values different from the current one
+    candidates = [value for value in values if value != current]
+    return candidates[select_idx(candidates)]
+
+
+def neighbour_policy(policy):
+    # A valid policy which differs from a valid policy in one category, like mut_by_modify
+    # but without retrying: every choice below keeps the policy valid.
+    policy = list(policy)
+    role = policy[5]
+    action_idx = [idx for idx in role_action_map[role] if policy[idx] != -1][0]
+
+    if policy[0] == 1:          # action policy
+        change_list = ['role', 'condition', 'actionName', 'enforce']
+        if len(value_map[action_idx]) > 1:
+            change_list.append('actionMethod')
+        if policy[11] != -1 or policy[14] != -1:
+            change_list.append('methodValue')
+    else:                       # compliance policy
+        change_list = ['role', 'condition', 'actionName', 'compliance']
+    change_category = change_list[select_idx(change_list)]
+
+    if change_category == "role":
+        new_role = select_other_value(value_map[5], role)
+        policy[5] = new_role
+        # keep shared conditions, set the new role's own conditions, drop the others
+        for cond_idx in policy_element['conditions']:
+            if cond_idx not in role_cond_map[new_role]:
+                policy[cond_idx] = -1
+            elif policy[cond_idx] == -1:
+                policy[cond_idx] = select_value_by_idx(cond_idx)
+        policy[action_idx] = -1
+        policy[15] = -1
+        action_list = role_action_map[new_role]
+        new_action = action_list[select_idx(action_list)]
+        policy[new_action] = select_value_by_idx(new_action) if policy[0] == 1 else 0
+    elif change_category == "condition":
+        cond_indices = role_cond_map[role]
+        cond_idx = cond_indices[select_idx(cond_indices)]
+        policy[cond_idx] = select_other_value(value_map[cond_idx], policy[cond_idx])
+    elif change_category == "actionName":
+        new_action = select_other_value(role_action_map[role], action_idx)
+        policy[action_idx] = -1
+        policy[15] = -1
+        policy[new_action] = select_value_by_idx(new_action) if policy[0] == 1 else 0
+    elif change_category == "actionMethod":
+        policy[action_idx] = select_other_value(value_map[action_idx], policy[action_idx])
+    elif change_category == "methodValue":
+        policy[15] = select_other_value(range(1, 6), policy[15])
+    elif change_category == "compliance":
+        policy[16] = select_other_value(value_map[16], policy[16])
+    elif change_category == "enforce":
+        policy[17] = 1 - policy[17]
+    return policy
+
+
 def mut_by_modify(policy):
     # Pick random numbers of policies from the individual.
     # Change values in contents based on relationships.
@@ -0,0 +1,130 @@
+import weakref
+
+""" Immutable value types of policies and policy sets.
+
+        Policy holds the 18 genes of one policy as a tuple and is interned: creating a Policy
+        whose genes equal those of a live Policy returns that object, so identical policies of
+        the whole population share one object and compare by identity. Numbers are compared by
+        value (1 and 1.0 are one Policy, which keeps the genes it was created with), the same
+        way fitness_cache.policy_set_key does, so equal PolicySets have equal cache keys. PolicySet is a tuple of Policy objects with a cached hash.
+        Both are read like the list form (len, indexing, iteration); the operators of
+        policy_op change lists, so individuals are converted with freeze / thaw.
+"""
+
+# genes key -> Policy, an entry disappears with the last reference to its Policy
+intern_table = weakref.WeakValueDictionary()
+
+
+class Policy:
+    __slots__ = ("genes", "hash", "__weakref__")
+
+    def __new__(cls, genes):
+        key = tuple(genes)     # as a dict key, 1 and 1.0 are the same
+        policy = intern_table.get(key)
+        if policy is None:
+            policy = object.__new__(cls)
+            policy.genes = key
+            policy.hash = hash(key)
+            intern_table[key] = policy
+        return policy
+
+    def __setattr__(self, name, value):
+        if hasattr(self, "hash"):
+            raise AttributeError("Policy is immutable")
+        object.__setattr__(self, name, value)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        # interned: equal genes are the same object
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __getitem__(self, idx):
+        return self.genes[idx]
+
+    def __iter__(self):
+        return iter(self.genes)
+
+    def __reduce__(self):
+        # unpickled policies are interned again
+        return Policy, (self.genes,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return "Policy(" + repr(list(self.genes)) + ")"
+
+    def to_list(self):
+        return list(self.genes)
+
+
+class PolicySet:
+    __slots__ = ("policies", "hash")
+
+    def __init__(self, policies):
+        object.__setattr__(self, "policies", tuple(p if type(p) is Policy else Policy(p) for p in policies))
+        object.__setattr__(self, "hash", hash(self.policies))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PolicySet is immutable")
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(other) is not PolicySet or self.hash != other.hash:
+            return False
+        # the policies are interned, so the tuples are compared by identity
+        return self.policies == other.policies
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self.policies)
+
+    def __getitem__(self, idx):
+        return self.policies[idx]
+
+    def __iter__(self):
+        return iter(self.policies)
+
+    def __reduce__(self):
+        return PolicySet, (self.policies,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return "PolicySet(" + repr(self.to_list()) + ")"
+
+    def to_list(self, container=list):
+        return container([policy.to_list() for policy in self.policies])
+
+
+def freeze(policy_set):
+    # individual in list form -> PolicySet
+    if type(policy_set) is PolicySet:
+        return policy_set
+    return PolicySet(policy_set)
+
+
+def thaw(policy_set, container=list):
+    # PolicySet -> container of lists, e.g. creator.Individual for the policy_op operators
+    return policy_set.to_list(container)
@@ -0,0 +1,92 @@
+import math
+
+""" Adaptive number of replications (racing).
+
+        A candidate is simulated in chunks of replications. After every chunk the running
+        mean and its confidence interval are updated, and the evaluation stops as soon as
+            - the upper bound is below the incumbent (the candidate cannot win), or
+            - the interval is tighter than the tolerance,
+        otherwise it continues until max_simulation replications are used.
+        The interval is estimated from the chunk means, so at least two chunks are run.
+"""
+
+MAX_SIMULATION = 50     # replications of a full evaluation
+
+# two-sided 95% Student t quantiles by degrees of freedom
+t_table_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+    11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093,
+    20: 2.086, 25: 2.060, 30: 2.042,
+}
+
+
+def t_quantile(df):
+    if df >= 30:
+        return 1.96 if df > 120 else t_table_95[30]
+    while df not in t_table_95:
+        df -= 1
+    return t_table_95[df]
+
+
+class RunningStats:
+    # Welford's online mean/variance
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        if self.n < 2:
+            return float('inf')
+        return self.m2 / (self.n - 1)
+
+    def half_width(self):
+        # 95% confidence half-width of the mean
+        if self.n < 2:
+            return float('inf')
+        return t_quantile(self.n - 1) * math.sqrt(self.variance() / self.n)
+
+
+class SimFitness(tuple):
+    # fitness values which also remember how many replications produced them
+    # and, when the simulator reports every replication, their variance
+    def __new__(cls, values, n_simulation=0, variance=None):
+        obj = tuple.__new__(cls, values)
+        obj.n_simulation = n_simulation
+        obj.variance = variance
+        return obj
+
+
+def race(run_chunk, incumbent=None, chunk=10, max_simulation=MAX_SIMULATION, tolerance=1.0):
+    # run_chunk(n) simulates n replications and returns their mean
+    chunk_stats = RunningStats()
+    used = 0
+    total = 0.0
+    while used < max_simulation:
+        n = min(chunk, max_simulation - used)
+        chunk_mean = run_chunk(n)
+        chunk_stats.add(chunk_mean)
+        total += chunk_mean * n
+        used += n
+
+        half_width = chunk_stats.half_width()
+        upper = chunk_stats.mean + half_width
+        if incumbent is not None and upper < incumbent:
+            break   # dominated by the incumbent
+        if half_width <= tolerance:
+            break   # precise enough
+    return SimFitness((total / used,), used)
+
+
+def evaluate_racing(evaluate, indiv_poli_set, file_num, gen_num, incumbent=None,
+                    chunk=10, max_simulation=MAX_SIMULATION, tolerance=1.0):
+    # evaluate is policy_eval.evaluate or SimulatorPool.evaluate (both take n_simulation)
+    def run_chunk(n):
+        return evaluate(indiv_poli_set, file_num, gen_num, n_simulation=n)[0]
+    return race(run_chunk, incumbent, chunk, max_simulation, tolerance)
@@ -0,0 +1,195 @@
+import os
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import threading
+
+""" Log sink for the simulator output.
+
+        The output of one evaluation is captured as one block and handed to a background
+        thread, which writes the blocks in batches. When the file grows over max_bytes it is
+        rotated: simulation.log -> simulation.log.1.gz -> simulation.log.2.gz ... (backups kept).
+        The logs of pool workers are appended to the log of the main process with merge_log.
+        Levels:
+            full     header line and the whole simulator output of every evaluation
+            summary  one line per evaluation (candidate, replications, result, output lines, time)
+            discard  nothing is written
+"""
+
+SIMUL_LOG = './json/simulation.log'
+LOG_LEVELS = ("full", "summary", "discard")
+LOG_MAX_BYTES = 64 * 1024 * 1024
+LOG_BACKUPS = 5
+
+
+class SimLogSink:
+    def __init__(self, filename, level="full", max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, compress=True,
+                 batch_size=256, flush_interval=1.0):
+        if level not in LOG_LEVELS:
+            raise ValueError("Unknown simulator log level: " + str(level))
+        self.filename = filename
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.file = None
+        self.thread = None
+        if level != "discard":
+            self.thread = threading.Thread(target=self.write_loop, daemon=True)
+            self.thread.start()
+
+    def capture(self, header, output, summary):
+        # one evaluation: header line, raw output (bytes or str), summary line
+        if self.level == "discard":
+            return
+        if self.level == "summary":
+            self.queue.put(summary + "\n")
+        else:
+            self.queue.put((header, output))
+
+    def append(self, text):
+        # text which is already in the format of this log, e.g. the log of a worker
+        if self.level != "discard":
+            self.queue.put(text)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def write_loop(self):
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = batch[0:batch.index(None)]
+            try:
+                self.write(batch)
+            except OSError as e:
+                print("Cannot write the simulator log:", e)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, batch):
+        # one write per evaluation block, one flush per batch
+        for item in batch:
+            if isinstance(item, tuple):
+                header, output = item
+                if isinstance(output, bytes):
+                    output = output.decode('utf-8', errors='replace')
+                if output and not output.endswith("\n"):
+                    output += "\n"
+                item = header + "\n" + output
+            if self.file is None:
+                self.file = open(self.filename, 'a')
+            self.file.write(item)
+            if self.max_bytes and self.file.tell() >= self.max_bytes:
+                self.rotate()
+        if self.file is not None:
+            self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        suffix = ".gz" if self.compress else ""
+        for i in range(self.backups - 1, 0, -1):
+            older = "%s.%d%s" % (self.filename, i, suffix)
+            if os.path.exists(older):
+                os.replace(older, "%s.%d%s" % (self.filename, i + 1, suffix))
+        if self.backups <= 0:
+            os.remove(self.filename)
+            return
+        first = "%s.1%s" % (self.filename, suffix)
+        if self.compress:
+            with open(self.filename, 'rb') as src, gzip.open(first + ".tmp", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(first + ".tmp", first)
+            os.remove(self.filename)
+        else:
+            os.replace(self.filename, first)
+
+
+# sink of this process, created on first use with log_config
+log_sink = None
+log_config = {"filename": SIMUL_LOG, "level": "full", "max_bytes": LOG_MAX_BYTES, "backups": LOG_BACKUPS,
+              "compress": True}
+
+
+def configure_log(**config):
+    # change the settings (filename, level, max_bytes, backups, compress) of the next sink
+    close_log()
+    log_config.update(config)
+
+
+def get_log_sink():
+    global log_sink
+    if log_sink is None:
+        log_sink = SimLogSink(**log_config)
+        atexit.register(log_sink.close)
+    return log_sink
+
+
+def close_log():
+    global log_sink
+    if log_sink is not None:
+        log_sink.close()
+        log_sink = None
+
+
+def forget_log():
+    # in a forked child: the writer thread of the parent does not exist here
+    global log_sink
+    log_sink = None
+
+
+def log_files(filename):
+    # the log and its rotated backups
+    directory = os.path.dirname(filename) or "."
+    name = os.path.basename(filename)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, f) for f in os.listdir(directory) if f == name or f.startswith(name + ".")]
+
+
+def merge_log(filename, sink, chunk_size=1024 * 1024):
+    # appends a closed log and its rotated backups, oldest first, to sink and removes them
+    backups = list()
+    for path in log_files(filename):
+        number = path[len(filename) + 1:].split(".")[0]
+        if number.isdigit():
+            backups.append((int(number), path))
+    paths = [path for number, path in sorted(backups, reverse=True)]
+    if os.path.exists(filename):
+        paths.append(filename)
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+            while True:
+                text = f.read(chunk_size)
+                if not text:
+                    break
+                sink.append(text)
+        os.remove(path)
+    return len(paths)
+
+
+def summary_line(candidate, n_simulation, result, output, seconds):
+    n_lines = output.count(b"\n" if isinstance(output, bytes) else "\n")
+    return "%s %s n=%d result=%s lines=%d time=%.3fs" % (time.strftime("%Y-%m-%d %H:%M:%S"), candidate,
+                                                           n_simulation, result, n_lines, seconds)
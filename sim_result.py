@@ -0,0 +1,122 @@
+import os
+import math
+import struct
+import numpy as np
+from racing import t_quantile
+
+""" Result files of the simulator.
+
+        Binary record (Sim_Result.bin), little-endian, written once per evaluation:
+        ------------------------------------------------------------------------
+        offset  0   4s      magic "SIMR"
+                4   uint16  version (1)
+                6   uint16  flags (0)
+                8   uint32  n, number of replications
+                12  uint32  reserved (0)
+                16  float64[n]  value of every replication
+                16+8n float64[n]  wall-clock seconds of every replication
+        ------------------------------------------------------------------------
+        The arrays are read through a memory map without copying.
+        Text fallback (Sim_Result.txt): the mean of all replications as one number, the only
+        output of the current jar; its variance is unknown.
+"""
+
+RESULT_BIN = "Sim_Result.bin"
+RESULT_TXT = "Sim_Result.txt"
+RESULT_MAGIC = b"SIMR"
+RESULT_VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+
+
+class ResultFormatError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
+class ReplicationSummary:
+    def __init__(self, n, mean, variance, half_width, seconds=None):
+        self.n = n
+        self.mean = mean
+        self.variance = variance        # nan if unknown (text result, one replication)
+        self.half_width = half_width    # 95% confidence half-width of the mean
+        self.seconds = seconds          # total simulation time of the replications
+
+    def __repr__(self):
+        return "ReplicationSummary(n=%d, mean=%r, variance=%r, half_width=%r)" % (
+            self.n, self.mean, self.variance, self.half_width)
+
+
+def write_result(filename, values, timings=None):
+    # used by simulators written in Python (sim_stub) and the tests; written atomically
+    values = np.ascontiguousarray(values, dtype='<f8')
+    if timings is None:
+        timings = np.zeros(len(values))
+    timings = np.ascontiguousarray(timings, dtype='<f8')
+    if len(timings) != len(values):
+        raise ValueError("One timing per replication is needed")
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(RESULT_MAGIC, RESULT_VERSION, 0, len(values), 0))
+        f.write(values.tobytes())
+        f.write(timings.tobytes())
+    os.replace(tmp_file, filename)
+
+
+def map_result(filename):
+    # (values, timings) as read-only arrays mapped onto the file
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ResultFormatError("Truncated result header: " + filename)
+    magic, version, flags, n, reserved = HEADER.unpack(header)
+    if magic != RESULT_MAGIC or version != RESULT_VERSION:
+        raise ResultFormatError("Not a version %d result file: %s" % (RESULT_VERSION, filename))
+    if os.path.getsize(filename) != HEADER.size + 16 * n:
+        raise ResultFormatError("Result file size does not match %d replications: %s" % (n, filename))
+    if n == 0:
+        return np.zeros(0), np.zeros(0)
+    records = np.memmap(filename, dtype='<f8', mode='r', offset=HEADER.size, shape=(2, n))
+    return records[0], records[1]
+
+
+def summarize(values, timings=None):
+    n = len(values)
+    if n == 0:
+        return ReplicationSummary(0, float('nan'), float('nan'), float('inf'))
+    mean = float(np.mean(values))
+    variance = float(np.var(values, ddof=1)) if n > 1 else float('nan')
+    half_width = t_quantile(n - 1) * math.sqrt(variance / n) if n > 1 else float('inf')
+    seconds = float(np.sum(timings)) if timings is not None else None
+    return ReplicationSummary(n, mean, variance, half_width, seconds)
+
+
+def read_text_result(filename):
+    # the last number in the file
+    with open(filename) as f:
+        numbers = f.read().split()
+    if not numbers:
+        raise ResultFormatError("Empty result file: " + filename)
+    return float(numbers[-1])
+
+
+def read_result(directory, n_simulation):
+    # summary of the binary result in directory, or of the text result of the current jar
+    bin_file = os.path.join(directory, RESULT_BIN)
+    if os.path.exists(bin_file):
+        values, timings = map_result(bin_file)
+        summary = summarize(values, timings)
+        del values, timings     # release the map
+        return summary
+    mean = read_text_result(os.path.join(directory, RESULT_TXT))
+    return ReplicationSummary(n_simulation, mean, float('nan'), float('inf'))
+
+
+def remove_results(directory):
+    # stale results of the previous run must not be read again
+    for name in (RESULT_BIN, RESULT_TXT):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,93 @@
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+
+""" Stand-in for the SIMVA-SoS simulator speaking the sim_worker protocol.
+
+        Reads one request per line from stdin and answers with one response line.
+        The fitness is a fixed score per policy set plus replication noise, so the
+        worker backend can be tested and benchmarked without the jar.
+        Called like the jar (python sim_stub.py CANDIDATE_FILE N) it simulates one candidate
+        file and writes Sim_Result.txt into the cwd, and Sim_Result.bin with --binary.
+"""
+
+
+def policy_score(policy):
+    # stable pseudo-random score in [0, 1) for a numeric policy
+    text = ",".join(str(float(v)) for v in policy)
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16) / 0x100000000
+
+
+def replicate(policies, n_simulation, noise=5.0, delay=0.0):
+    # (value, seconds) of every replication
+    if len(policies) == 0:
+        return [(0.0, 0.0)] * n_simulation
+    base = 100.0 * sum(policy_score(policy) for policy in policies) / len(policies)
+    replications = list()
+    for i in range(0, n_simulation):
+        start = time.perf_counter()
+        time.sleep(delay)
+        value = min(100.0, max(0.0, random.gauss(base, noise)))
+        replications.append((value, time.perf_counter() - start))
+    return replications
+
+
+def simulate(policies, n_simulation, noise=5.0, delay=0.0):
+    if len(policies) == 0:
+        return 0.0
+    return sum(value for value, seconds in replicate(policies, n_simulation, noise, delay)) / n_simulation
+
+
+def run_candidate(args):
+    # one run like the jar: results in the cwd
+    from json_handle import read_policy
+    from sim_result import RESULT_BIN, RESULT_TXT, write_result
+    policies = read_policy(args.candidate)
+    print("Stub simulation:", args.candidate, "n:", args.n_simulation)
+    replications = replicate(policies, args.n_simulation, args.noise, args.delay)
+    values = [value for value, seconds in replications]
+    if args.binary:
+        write_result(RESULT_BIN, values, [seconds for value, seconds in replications])
+    with open(RESULT_TXT, 'w') as f:
+        f.write(str(sum(values) / len(values) if values else 0.0))
+
+
+def serve(args):
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        if args.crash_rate and random.random() < args.crash_rate:
+            sys.exit(3)
+        request = json.loads(line)
+        print("Stub simulation:", request["id"], "n:", request["n_simulation"])
+        try:
+            values = [value for value, seconds in
+                      replicate(request["policies"], request["n_simulation"], args.noise, args.delay)]
+            fitness = sum(values) / len(values) if values else 0.0
+            response = {"id": request["id"], "fitness": fitness}
+            if len(values) > 1:
+                # sample variance of the replications, like sim_result.summarize
+                response["variance"] = sum((value - fitness) ** 2 for value in values) / (len(values) - 1)
+        except (KeyError, TypeError, ValueError) as e:
+            response = {"id": request["id"], "error": str(e)}
+        print(json.dumps(response), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("candidate", nargs="?", default=None, help="candidate file (jar mode)")
+    parser.add_argument("n_simulation", nargs="?", type=int, default=50, help="replications (jar mode)")
+    parser.add_argument("--binary", action="store_true", help="also write every replication to Sim_Result.bin")
+    parser.add_argument("--noise", type=float, default=5.0, help="std. deviation of one replication")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds per replication")
+    parser.add_argument("--crash-rate", type=float, default=0.0, help="probability to exit on a request")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    if args.candidate is not None:
+        run_candidate(args)
+    else:
+        serve(args)
@@ -0,0 +1,147 @@
+import json
+import queue
+import itertools
+import shlex
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from racing import SimFitness
+from sim_log import get_log_sink, summary_line
+
+""" Long-lived simulator workers.
+
+        Instead of launching one JVM per evaluation, N simulator processes are kept alive
+        and receive policy sets over a line-delimited JSON protocol on stdin/stdout.
+        ------------------------------------------------------------------------
+        request  (one line)  {"id": 7, "policies": [[18 genes], ...], "n_simulation": 50}
+        response (one line)  {"id": 7, "fitness": 63.2, "variance": 4.1}     variance optional
+                             {"id": 7, "error": "message"}
+        ------------------------------------------------------------------------
+        Output lines that do not start with '{' are simulator log lines, the lines of one request
+        go to the simulator log sink (sim_log) as one block.
+        A worker that exits or breaks the pipe is restarted and the request is sent again.
+        sim_stub.py is a Python stand-in simulator speaking the same protocol (for tests only,
+        the command is always given explicitly).
+"""
+
+
+class SimulatorError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
+class SimulatorWorker:
+    def __init__(self, command, cwd=None):
+        self.command = command
+        self.cwd = cwd
+        self.proc = None
+        self.output = list()
+        self.restarts = -1
+        self.start()
+
+    def start(self):
+        self.stop()
+        self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     cwd=self.cwd, universal_newlines=True, bufsize=1)
+        self.restarts += 1
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def request(self, message):
+        # send one request and wait for its response line; the log lines are kept in self.output
+        self.output = list()
+        self.proc.stdin.write(json.dumps(message) + "\n")
+        self.proc.stdin.flush()
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise SimulatorError("Simulator exited: " + str(self.proc.poll()))
+            if not line.startswith("{"):
+                self.output.append(line)
+                continue
+            response = json.loads(line)
+            if response.get("id") == message["id"]:
+                return response
+
+
+class SimulatorPool:
+    def __init__(self, command, n_workers=1, n_simulation=50, max_retries=2, cwd=None):
+        if isinstance(command, str):
+            command = shlex.split(command)
+        self.n_simulation = n_simulation
+        self.max_retries = max_retries
+        self.workers = [SimulatorWorker(command, cwd) for _ in range(n_workers)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.executor = ThreadPoolExecutor(n_workers)
+        self.ids = itertools.count(1)
+
+    def evaluate(self, indiv_poli_set, file_num=0, gen_num=0, n_simulation=None):
+        # same signature as policy_eval.evaluate, so it can be registered as toolbox.evaluate
+        if n_simulation is None:
+            n_simulation = self.n_simulation
+        message = {"id": next(self.ids),
+                   "policies": [list(policy) for policy in indiv_poli_set],
+                   "n_simulation": n_simulation}
+
+        metrics.count("evaluations")
+        metrics.count("replications", n_simulation)
+        worker = self.idle.get()
+        start = time.perf_counter()
+        try:
+            for attempt in range(0, self.max_retries + 1):
+                if not worker.alive():
+                    worker.start()
+                try:
+                    with metrics.phase("simulator"):
+                        response = worker.request(message)
+                    output = "".join(worker.output)
+                    break
+                except (SimulatorError, BrokenPipeError, ValueError) as e:
+                    print("Simulator worker failed, restarting:", e)
+                    metrics.count("worker_restarts")
+                    worker.start()
+            else:
+                raise SimulatorError("Simulator failed " + str(self.max_retries + 1) + " times")
+        finally:
+            self.idle.put(worker)
+
+        candidate = "request " + str(message["id"])
+        with metrics.phase("logging"):
+            get_log_sink().capture("=== " + candidate + " n=" + str(n_simulation), output,
+                                   summary_line(candidate, n_simulation, response.get("fitness", response.get("error")),
+                                                output, time.perf_counter() - start))
+        if "error" in response:
+            raise SimulatorError("Simulator error: " + response["error"])
+        variance = response.get("variance")
+        return SimFitness((float(response["fitness"]),), n_simulation, None if variance is None else float(variance))
+
+    def map(self, func, *iterables):
+        # toolbox.map replacement: one request in flight per worker
+        return list(self.executor.map(func, *iterables))
+
+    def restarts(self):
+        return sum(worker.restarts for worker in self.workers)
+
+    def close(self):
+        self.executor.shutdown()
+        for worker in self.workers:
+            if worker.alive():
+                # closing stdin asks the worker to finish
+                worker.proc.stdin.close()
+                try:
+                    worker.proc.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    pass
+            worker.stop()
@@ -0,0 +1,92 @@
+import time
+import random
+import asyncio
+from operator import attrgetter
+from fitness_cache import policy_set_key
+
+""" Asynchronous steady-state GA.
+
+        A fixed number of evaluations is kept in flight. Whenever one finishes, the child is
+        inserted into the population (replacing the worst individual if it is better) and a
+        replacement child is bred right away with toolbox.select/mate and the mutation operator,
+        so no worker waits for the slowest simulation of a generation.
+        The run stops when the evaluation budget or the wall-clock budget is used up.
+"""
+
+
+def breed(population, toolbox, mutate, cxpb, mutpb):
+    # one child from two selected parents, always different from its first parent
+    parent1, parent2 = [toolbox.clone(ind) for ind in toolbox.select(population, 2)]
+    if random.random() < cxpb:
+        toolbox.mate(parent1, parent2)
+        del parent1.fitness.values
+    if random.random() < mutpb or parent1.fitness.valid:
+        mutate(parent1)
+        del parent1.fitness.values
+    return parent1
+
+
+def insert(population, child):
+    worst_idx = min(range(0, len(population)), key=lambda i: population[i].fitness)
+    if child.fitness > population[worst_idx].fitness:
+        population[worst_idx] = child
+        return True
+    return False
+
+
+def assign_fitness(ind, fit):
+    ind.fitness.values = fit
+
+
+async def steady_state(population, toolbox, mutate, evaluate, executor, n_in_flight=1, cxpb=0.5, mutpb=0.6,
+                       max_evals=None, max_time=None, cache=None, assign=assign_fitness,
+                       first_num=0, gen_num=0, max_cache_hits=1000):
+    # evaluate(ind, file_num, gen_num) runs in the executor, everything else in the event loop
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    running = dict()    # future -> (child, cache key)
+    n_evals = 0
+    n_inserted = 0
+    n_cache_hits = 0    # consecutive, a converged population may only produce known genotypes
+
+    def budget_left():
+        if max_evals is not None and n_evals >= max_evals:
+            return False
+        if max_time is not None and time.monotonic() - start >= max_time:
+            return False
+        return n_cache_hits < max_cache_hits
+
+    while True:
+        while len(running) < n_in_flight and budget_left():
+            child = breed(population, toolbox, mutate, cxpb, mutpb)
+            key = None
+            if cache is not None:
+                key = policy_set_key(child)
+                fit = cache.get(key)
+                if fit is not None:
+                    assign(child, fit)
+                    n_inserted += insert(population, child)
+                    n_cache_hits += 1
+                    continue
+            future = loop.run_in_executor(executor, evaluate, child, first_num + n_evals, gen_num)
+            running[future] = (child, key)
+            n_evals += 1
+            n_cache_hits = 0
+
+        if not running:
+            break
+        done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            child, key = running.pop(future)
+            fit = future.result()
+            if cache is not None:
+                cache.put(key, fit)
+            assign(child, fit)
+            n_inserted += insert(population, child)
+
+        best = max(population, key=attrgetter("fitness"))
+        print("Evaluations:", n_evals, "Inserted:", n_inserted, "Current Best:", best.fitness.values[0])
+
+    print(">> Steady-state GA finished. Evaluations:", n_evals,
+          "Time:", round(time.monotonic() - start, 1), "s")
+    return population
@@ -0,0 +1,172 @@
+import numpy as np
+from collections import deque
+from policy_op import value_map, role_action_map
+
+""" Surrogate model for pre-screening offspring.
+
+        Every evaluated (policy set, fitness) pair trains a ridge regression on features of
+        the 18-gene encoding:
+            - action policies: count of each (action, method, MCI level), of each wait/release
+              method value and of enforced policies per role
+            - compliance policies: mean compliance level per (action, MCI level)
+        A generation breeds pool_factor times more offspring than needed, and only the ones
+        with the best predicted fitness are simulated.
+        Before simulation every candidate is predicted, afterwards the prediction is compared
+        with the real fitness. The Spearman rank correlation over the last window candidates
+        decides if the surrogate is used: below min_correlation it is switched off (offspring
+        are bred and simulated as without surrogate) and it keeps learning until it is reliable again.
+"""
+
+MCI_LEVELS = value_map[1]
+ACTIONS = [action for role in value_map[5] for action in role_action_map[role]]
+
+
+def make_feature_index():
+    index = dict()
+    for action in ACTIONS:
+        for method in value_map[action]:
+            for mci in MCI_LEVELS:
+                index[("action", action, method, mci)] = len(index)
+    for action in (11, 14):
+        for method_value in value_map[15]:
+            index[("method", action, method_value)] = len(index)
+    for role in value_map[5]:
+        index[("enforce", role)] = len(index)
+    for action in ACTIONS:
+        for mci in MCI_LEVELS:
+            index[("compliance", action, mci)] = len(index)
+    return index
+
+
+feature_index = make_feature_index()
+N_FEATURES = len(feature_index) + 1     # last one: bias
+
+
+def policy_set_features(policy_set):
+    x = np.zeros(N_FEATURES)
+    x[-1] = 1.0
+    n_compliance = np.zeros(N_FEATURES)
+    for policy in policy_set:
+        if policy[0] == 1:      # action policy
+            action = next((a for a in role_action_map.get(policy[5], ()) if policy[a] != -1), None)
+            if action is None:
+                continue
+            idx = feature_index.get(("action", action, policy[action], policy[1]))
+            if idx is not None:
+                x[idx] += 1
+            idx = feature_index.get(("method", action, policy[15]))
+            if idx is not None:
+                x[idx] += 1
+            if policy[17] == 1:
+                x[feature_index[("enforce", policy[5])]] += 1
+        elif policy[0] == 2:    # compliance policy
+            action = next((a for a in role_action_map.get(policy[5], ()) if policy[a] != -1), None)
+            idx = feature_index.get(("compliance", action, policy[1]))
+            if idx is not None:
+                x[idx] += policy[16]
+                n_compliance[idx] += 1
+    np.divide(x, n_compliance, out=x, where=n_compliance > 0)
+    return x
+
+
+def rank(values):
+    # ranks starting at 0, ties get their average rank
+    values = np.asarray(values, dtype=np.float64)
+    ranks = np.empty(len(values))
+    ranks[np.argsort(values, kind='mergesort')] = np.arange(len(values))
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return (np.bincount(inverse, weights=ranks) / counts)[inverse]
+
+
+def rank_correlation(a, b):
+    # Spearman's rho, nan if one side is constant
+    ra = rank(a)
+    rb = rank(b)
+    if ra.std() == 0 or rb.std() == 0:
+        return float('nan')
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+
+class Surrogate:
+    def __init__(self, pool_factor=3, min_train=20, window=50, min_correlation=0.3, ridge=1.0):
+        self.pool_factor = pool_factor
+        self.min_train = min_train
+        self.min_correlation = min_correlation
+        self.ridge = ridge
+        self.xtx = ridge * np.eye(N_FEATURES)
+        self.xty = np.zeros(N_FEATURES)
+        self.weights = None
+        self.n_train = 0
+        self.checks = deque(maxlen=window)      # (predicted, real) of simulated candidates
+        self.n_screened = 0                     # bred but never simulated
+
+    def trained(self):
+        return self.n_train >= self.min_train
+
+    def correlation(self):
+        if len(self.checks) < self.min_train:
+            return float('nan')
+        predicted, real = zip(*self.checks)
+        return rank_correlation(predicted, real)
+
+    def enabled(self):
+        # used for screening once trained and not proven unreliable
+        if not self.trained():
+            return False
+        rho = self.correlation()
+        return rho != rho or rho >= self.min_correlation
+
+    def predict(self, individuals):
+        # predicted fitness of every individual, None before the model is trained
+        if not self.trained() or not individuals:
+            return None
+        if self.weights is None:
+            self.weights = np.linalg.solve(self.xtx, self.xty)
+        features = np.array([policy_set_features(ind) for ind in individuals])
+        return features @ self.weights
+
+    def observe(self, individuals, predicted=None):
+        # learn from evaluated individuals; predicted: their predictions made before the simulation
+        if predicted is not None:
+            for ind, value in zip(individuals, predicted):
+                self.checks.append((float(value), ind.fitness.values[0]))
+        features = np.array([policy_set_features(ind) for ind in individuals]).reshape(-1, N_FEATURES)
+        fitness = np.array([ind.fitness.values[0] for ind in individuals], dtype=np.float64)
+        self.xtx += features.T @ features
+        self.xty += features.T @ fitness
+        self.n_train += len(individuals)
+        self.weights = None
+
+    def screen(self, candidates, n):
+        # the n candidates with the best predicted fitness
+        predicted = self.predict(candidates)
+        if predicted is None or len(candidates) <= n:
+            return list(candidates[0:n])
+        best_idx = np.argsort(-predicted, kind='mergesort')[0:n]
+        self.n_screened += len(candidates) - n
+        return [candidates[i] for i in sorted(best_idx)]
+
+    def state(self):
+        # plain data for a checkpoint
+        return {"config": {"pool_factor": self.pool_factor, "min_train": self.min_train,
+                           "window": self.checks.maxlen, "min_correlation": self.min_correlation,
+                           "ridge": self.ridge},
+                "xtx": self.xtx.tolist(), "xty": self.xty.tolist(), "n_train": self.n_train,
+                "checks": list(self.checks), "n_screened": self.n_screened}
+
+    @classmethod
+    def from_state(cls, state):
+        surrogate = cls(**state["config"])
+        if len(state["xty"]) != N_FEATURES:
+            print(">> Surrogate of the checkpoint has other features, it is trained again")
+            return surrogate
+        surrogate.xtx = np.array(state["xtx"], dtype=np.float64)
+        surrogate.xty = np.array(state["xty"], dtype=np.float64)
+        surrogate.n_train = state["n_train"]
+        surrogate.checks.extend(tuple(check) for check in state["checks"])
+        surrogate.n_screened = state["n_screened"]
+        return surrogate
+
+    def stats(self):
+        return {"trained": self.n_train, "correlation": self.correlation(),
+                "enabled": self.enabled(), "screened_out": self.n_screened}
@@ -0,0 +1,946 @@
+import os
+import json
+import sys
+import random
+import time
+import subprocess
+import sim_worker
+import sim_stub
+import fitness_cache
+import broker
+import islands
+import hall_of_fame
+import sim_log
+import gzip
+import policy_op
+import policy_check
+import surrogate
+import sim_result
+import candidate_store
+import policy_types
+import crossover
+import mutation
+import policy_array
+import pickle
+import copy
+import json_handle
+import numpy as np
+import racing
+from checkpoint import load_checkpoint, pack_individuals, unpack_individuals
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim_stub.py")
+
+
+def test_sim_worker_pool_with_stub():
+    pool = sim_worker.SimulatorPool([sys.executable, STUB, "--noise", "0"], n_workers=2)
+    try:
+        policy_sets = [[[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]] * i for i in range(1, 5)]
+        fitnesses = pool.map(pool.evaluate, policy_sets)
+        assert len(fitnesses) == 4
+        # the stub has no noise, so equal policies give equal fitness
+        assert len(set(fitnesses)) == 1
+        assert 0.0 <= fitnesses[0][0] <= 100.0
+        # replications and their variance reach the individual like with policy_eval
+        assert all(isinstance(fit, racing.SimFitness) and fit.n_simulation == 50 and fit.variance == 0.0
+                   for fit in fitnesses)
+    finally:
+        pool.close()
+    pool = sim_worker.SimulatorPool([sys.executable, STUB, "--noise", "5"], n_workers=1)
+    try:
+        fitness = pool.evaluate(policy_sets[0], n_simulation=20)
+        assert fitness.n_simulation == 20 and 0.0 < fitness.variance < 100.0
+        assert pool.evaluate(policy_sets[0], n_simulation=1).variance is None
+    finally:
+        pool.close()
+
+
+def test_sim_worker_restarts_crashed_worker():
+    pool = sim_worker.SimulatorPool([sys.executable, STUB, "--crash-rate", "0.3"],
+                                    n_workers=1, max_retries=20)
+    try:
+        for i in range(0, 20):
+            fitness = pool.evaluate([[2, 1, -1, 1, -1, 1, 0, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0.5, -1]])
+            assert len(fitness) == 1
+        assert pool.restarts() > 0
+    finally:
+        pool.close()
+
+
+def test_fitness_cache_lru_disk_tier_and_counters(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    cache = fitness_cache.FitnessCache(filename, namespace="A", max_size=3)
+    for i in range(0, 4):
+        cache.put("k%d" % i, (float(i),))
+    assert len(cache) == 3 and "k0" not in cache.memory
+    cache.get("k1")     # k1 becomes the most recently used, k2 is evicted next
+    cache.put("k4", (4.0,))
+    assert list(cache.memory) == ["k3", "k1", "k4"]
+    # evicted entries come from the disk tier and are remembered again
+    assert cache.get("k0") == (0.0,) and cache.get("k2") == (2.0,)
+    assert cache.get("missing") is None
+    assert cache.stats() == {"hits": 3, "disk_hits": 2, "misses": 1, "partial": 0}
+    cache.put("k1", racing.SimFitness((11.0,), 50, variance=2.5))
+    cache.close()
+
+    # a new run: everything from disk, SimFitness with its replications and variance
+    cache = fitness_cache.FitnessCache(filename, namespace="A", max_size=3)
+    assert len(cache) == 0
+    assert [cache.get("k%d" % i) for i in range(0, 5)] == [(0.0,), (11.0,), (2.0,), (3.0,), (4.0,)]
+    cache.get("k4")
+    assert cache.stats() == {"hits": 6, "disk_hits": 5, "misses": 0, "partial": 0}
+    fit = cache.get("k1")   # evicted again by k2, k3, k4
+    assert isinstance(fit, racing.SimFitness) and fit.n_simulation == 50 and fit.variance == 2.5
+    assert cache.stats() == {"hits": 7, "disk_hits": 6, "misses": 0, "partial": 0}
+    cache.close()
+    other = fitness_cache.FitnessCache(filename, namespace="D")
+    assert other.get("k0") is None and other.stats()["misses"] == 1
+    other.close()
+
+
+def test_policy_set_key_normalises_numbers():
+    policy = [1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, 1, 0]
+    key = fitness_cache.policy_set_key([policy])
+    assert fitness_cache.policy_set_key([[float(v) for v in policy]]) == key
+    assert fitness_cache.policy_set_key([tuple(policy)]) == key
+    assert fitness_cache.policy_set_key([policy_types.Policy(policy)]) == key
+    assert fitness_cache.policy_set_key([policy[:16] + [0.5, 0]]) != key
+    assert fitness_cache.policy_set_key([policy, policy]) != key
+
+
+def test_multi_fidelity_promotes_and_caches_full_results_only(tmp_path):
+    import main
+    from fidelity import MultiFidelity
+    random.seed(51)
+    individuals = [main.creator.Individual(policy_op.gen_individual(3)) for i in range(0, 12)]
+    # the stub without noise: every replication gives the policy set's score
+    scores = [100.0 * sum(sim_stub.policy_score(policy) for policy in ind) / len(ind) for ind in individuals]
+    margin = 10.0
+    promoted = [score >= max(scores) - margin for score in scores]
+    assert 0 < sum(promoted) < len(individuals)
+
+    pool = sim_worker.SimulatorPool([sys.executable, STUB, "--noise", "0"], n_workers=2)
+    registered = dict(main.toolbox.__dict__)
+    cache = fitness_cache.FitnessCache(str(tmp_path / "cache.db"), min_simulation=20)
+    try:
+        main.toolbox.register("map", pool.executor.map)
+        multi_fidelity = MultiFidelity(pool.evaluate, (4, 20), margin)
+        assert main.evaluate_population(individuals, 0, cache, multi_fidelity=multi_fidelity) == len(individuals)
+    finally:
+        main.toolbox.__dict__.clear()
+        main.toolbox.__dict__.update(registered)
+        pool.close()
+    assert [ind.n_simulation for ind in individuals] == [20 if p else 4 for p in promoted]
+    assert all(abs(ind.fitness.values[0] - score) < 1e-9 for ind, score in zip(individuals, scores))
+    assert multi_fidelity.n_replications == 4 * len(individuals) + 16 * sum(promoted)
+    # only the promoted candidates, evaluated at full fidelity, are in the cache
+    cached = [cache.get(fitness_cache.policy_set_key(ind)) for ind in individuals]
+    assert [fit is not None for fit in cached] == promoted
+    assert all(fit.n_simulation == 20 for fit in cached if fit is not None)
+    assert cache.stats()["partial"] == len(individuals) - sum(promoted)
+    cache.close()
+
+
+def test_multi_fidelity_rejects_invalid_stages():
+    from fidelity import MultiFidelity
+    for stages in ((50, 10), (5, 5, 50), (0, 50), (-5, 50), (), (5, 50.0)):
+        try:
+            MultiFidelity(None, stages)
+            assert False, stages
+        except ValueError:
+            pass
+    assert MultiFidelity(None, [5, 20, 50]).full() == 50
+
+
+def test_stub_results_are_cached_apart_from_the_jar(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    policy_set = [[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]]
+    key = fitness_cache.policy_set_key(policy_set)
+    stub = fitness_cache.FitnessCache(filename, namespace=fitness_cache.cache_namespace("A", "python  sim_stub.py"))
+    stub.put(key, (12.5,))
+    stub.close()
+    jar = fitness_cache.FitnessCache(filename, namespace=fitness_cache.cache_namespace("A"))
+    assert jar.get(key) is None
+    jar.close()
+    stub = fitness_cache.FitnessCache(filename, namespace=fitness_cache.cache_namespace("A", ["python", "sim_stub.py"]))
+    assert stub.get(key) == (12.5,)
+    stub.close()
+
+
+def test_only_full_racing_results_are_cached(tmp_path):
+    import main
+    filename = str(tmp_path / "cache.db")
+    registered = dict(main.toolbox.__dict__)
+    individuals = [main.creator.Individual(policy_op.gen_individual_ack()) for i in range(0, 6)]
+    stopped = set(fitness_cache.policy_set_key(ind) for ind in individuals[0:3])
+
+    def evaluate(indiv_poli_set, file_num=0, gen_num=0):
+        # a race stopped after 20 replications for the first three
+        n_simulation = 20 if fitness_cache.policy_set_key(indiv_poli_set) in stopped else racing.MAX_SIMULATION
+        return racing.SimFitness((float(n_simulation),), n_simulation)
+
+    cache = fitness_cache.FitnessCache(filename, min_simulation=racing.MAX_SIMULATION)
+    try:
+        main.toolbox.register("map", map)
+        main.toolbox.register("evaluate", evaluate)
+        assert main.evaluate_population(individuals, 0, cache) == 6
+        assert [ind.n_simulation for ind in individuals] == [20, 20, 20, 50, 50, 50]
+        assert cache.stats()["partial"] == 3
+    finally:
+        main.toolbox.__dict__.clear()
+        main.toolbox.__dict__.update(registered)
+        cache.close()
+
+    cache = fitness_cache.FitnessCache(filename, min_simulation=racing.MAX_SIMULATION)
+    assert [cache.get(fitness_cache.policy_set_key(ind)) is not None for ind in individuals] == [False] * 3 + [True] * 3
+    # partial entries written without the limit (an older cache file) are ignored
+    unlimited = fitness_cache.FitnessCache(filename)
+    unlimited.put("partial", racing.SimFitness((1.0,), 20))
+    unlimited.close()
+    assert cache.get("partial") is None
+    cache.close()
+
+
+def write_policy_file(path, policy_sets):
+    # one top-level array per policy set, like json.dump(..., indent=4) of several files in one
+    text = "\n".join(json.dumps([json_handle.poli_to_dict(policy) for policy in policies], indent=4)
+                     for policies in policy_sets)
+    with open(path, 'w') as f:
+        f.write(text)
+    return text
+
+
+def test_streaming_reader_across_chunk_boundaries(tmp_path):
+    random.seed(11)
+    policy_sets = [policy_op.gen_individual_ack(), [], policy_op.gen_individual_multi()]
+    filename = str(tmp_path / "policies.json")
+    lines = write_policy_file(filename, policy_sets).split("\n")
+    expected = list(json_handle.iter_json_items(filename, chunk_size=1 << 20))
+    assert [value for value, line, column in expected] == \
+        [json_handle.poli_to_dict(policy) for policies in policy_sets for policy in policies]
+    # every element is reported at its opening brace
+    assert all(lines[line - 1][column - 1] == "{" for value, line, column in expected)
+    for chunk_size in (1, 2, 7, 64, 1000):
+        assert list(json_handle.iter_json_items(filename, chunk_size=chunk_size)) == expected
+
+
+def test_policy_file_error_positions(tmp_path):
+    random.seed(12)
+    filename = str(tmp_path / "policies.json")
+    lines = write_policy_file(filename, [policy_op.gen_individual_ack()]).split("\n")
+    # the separator after the first element is removed: "}," -> "}"
+    separator = next(idx for idx, line in enumerate(lines) if line == "    },")
+    lines[separator] = "    }"
+    with open(filename, 'w') as f:
+        f.write("\n".join(lines))
+    for chunk_size in (3, 64, 1 << 20):
+        try:
+            list(json_handle.iter_json_items(filename, chunk_size=chunk_size))
+            assert False, "no error"
+        except json_handle.PolicyFileError as e:
+            assert (e.line, e.column) == (separator + 2, 5)     # the '{' of the second element
+            assert str(e).startswith(filename + ":" + str(separator + 2) + ":5: ")
+
+    # truncated file: the position where the missing value should start
+    with open(filename, 'w') as f:
+        f.write('[\n  {"policyType": "ActionPolicy",\n  "role": ')
+    try:
+        list(json_handle.iter_json_items(filename, chunk_size=4))
+        assert False, "no error"
+    except json_handle.PolicyFileError as e:
+        assert (e.line, e.column) == (3, 11)
+
+    # malformed policy: the position of its entry
+    write_policy_file(filename, [policy_op.gen_individual_ack()[0:3]])
+    with open(filename) as f:
+        policies = json.load(f)
+    del policies[2]["role"]
+    with open(filename, 'w') as f:
+        f.write(json.dumps(policies, indent=4))
+    expected = list(json_handle.iter_json_items(filename))[2][1:]
+    try:
+        json_handle.read_policy(filename)
+        assert False, "no error"
+    except json_handle.PolicyFileError as e:
+        assert (e.line, e.column) == expected and "#2" in e.value
+
+
+def test_sample_policy_matches_rejection_sampling():
+    random.seed(21)
+    n = 20000
+    rejected = list()
+    while len(rejected) < n:
+        policy = policy_op.gen_policy()
+        if policy_check.check_policy(policy):
+            rejected.append(policy)
+    sampled = [policy_op.sample_policy() for i in range(0, n)]
+    assert all(policy_check.check_policy(policy) for policy in sampled)
+
+    def frequencies(policies):
+        counts = dict()
+        for policy in policies:
+            action_idx = [idx for idx in range(6, 15) if policy[idx] != -1][0]
+            for key in [(idx, value) for idx, value in enumerate(policy)] + [("action", policy[0], action_idx)]:
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    expected = frequencies(rejected)
+    observed = frequencies(sampled)
+    assert set(observed) == set(expected)
+    for key, count in expected.items():
+        p = count / float(n)
+        assert abs(observed[key] / float(n) - p) <= 5 * (2 * p * (1 - p) / n) ** 0.5 + 1e-3, key
+
+
+def test_neighbour_policy_is_valid_and_different():
+    random.seed(22)
+    for i in range(0, 5000):
+        policy = policy_op.sample_policy() if i % 2 else policy_op.sample_uniform_policy()
+        original = list(policy)
+        neighbour = policy_op.neighbour_policy(policy)
+        assert policy == original      # the input is not changed
+        assert neighbour != policy
+        assert len(neighbour) == 18 and neighbour[0] == policy[0]
+        assert policy_check.check_policy(neighbour), (policy, neighbour)
+
+
+def test_policy_set_json_matches_json_dumps():
+    random.seed(31)
+    json_handle.policy_fragment.cache_clear()
+    policy_sets = [policy_op.gen_individual_ack(), policy_op.gen_individual_multi(), policy_op.gen_individual(30), []]
+    # sets sharing policies reuse the cached fragments
+    policy_sets.append(policy_sets[0][0:40] + policy_sets[2][0:10])
+    policy_sets.append([list(policy) for policy in reversed(policy_sets[1])])
+    # equal values of other types are written differently and must not share a fragment
+    policy_sets.append([[float(v) for v in policy] for policy in policy_sets[2]])
+    policy_sets.append(policy_sets[0])
+    for policies in policy_sets:
+        dicts = [json_handle.poli_to_dict(policy) for policy in policies]
+        assert json_handle.policy_set_json(policies) == json.dumps(dicts, indent=4)
+        assert json_handle.policy_set_json(policies, compact=True) == json.dumps(dicts, separators=(',', ':'))
+    assert json_handle.policy_fragment.cache_info().hits > 0
+
+
+def test_population_array_round_trip():
+    random.seed(41)
+    fixed = [policy_op.gen_individual_ack() for i in range(0, 5)]
+    ragged = [policy_op.gen_individual(n) for n in (1, 7, 3)] + [policy_op.gen_individual_multi()]
+    for population in (fixed, ragged):
+        genes = policy_array.population_to_array(population)
+        assert genes.dtype == np.int8 and genes.shape == (len(population), max(map(len, population)), 18)
+        assert policy_array.individual_lengths(genes).tolist() == [len(ind) for ind in population]
+        decoded = policy_array.array_to_population(genes)
+        assert decoded == population
+        # the same types: compliance stays a float, every other gene an int
+        assert [[[type(v) for v in policy] for policy in ind] for ind in decoded] == \
+            [[[type(v) for v in policy] for policy in ind] for ind in population]
+        assert [json_handle.policy_set_json(ind) for ind in decoded] == \
+            [json_handle.policy_set_json(ind) for ind in population]
+    try:
+        policy_array.encode_policies([[1] * 16 + [0.25, 1]])
+        assert False, "no error"
+    except ValueError:
+        pass
+
+
+def random_policy(rng):
+    # mostly plausible genes with some out-of-range values
+    policy = policy_op.gen_policy()
+    for i in range(0, rng.randint(0, 3)):
+        idx = rng.randint(0, 17)
+        if idx == 16:
+            policy[idx] = rng.choice([-1, 0.3, 0.9])
+        else:
+            policy[idx] = rng.randint(-1, 5)
+    return policy
+
+
+def test_check_policy_batch_matches_check_policy():
+    rng = random.Random(7)
+    random.seed(7)
+    policies = [random_policy(rng) for i in range(0, 20000)]
+    policies += policy_op.gen_individual_ack() + policy_op.gen_individual_multi() + policy_op.gen_individual(50)
+
+    mask, errors = policy_check.check_policy_batch(policies)
+    expected = [policy_check.check_policy(policy) for policy in policies]
+    assert mask.tolist() == expected
+    assert ((errors == policy_check.POLICY_OK) == mask).all()
+    # every check is exercised
+    assert set(errors.tolist()) == set(range(0, 7))
+
+
+def test_check_policy_batch_error_codes():
+    valid = [1, 1, 2, 3, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]
+    cases = {
+        policy_check.POLICY_OK: valid,
+        policy_check.TYPE_ERROR: [3] + valid[1:],
+        policy_check.ROLE_ERROR: valid[:5] + [-1] + valid[6:],
+        policy_check.CONDITION_ERROR: valid[:4] + [2] + valid[5:],
+        policy_check.ACTION_ERROR: valid[:7] + [1] + valid[8:],
+        policy_check.COMPLIANCE_ERROR: valid[:16] + [0.5, 0],
+        policy_check.ENFORCE_ERROR: valid[:17] + [-1],
+    }
+    mask, errors = policy_check.check_policy_batch(list(cases.values()))
+    assert errors.tolist() == list(cases.keys())
+
+
+class Scored(list):
+    # minimal individual: policy list with a fitness
+    class Fitness:
+        valid = True
+
+        def __init__(self, value):
+            self.values = (value,)
+
+    def __init__(self, policies, value):
+        list.__init__(self, policies)
+        self.fitness = Scored.Fitness(value)
+
+
+def test_surrogate_learns_and_disables_itself():
+    random.seed(3)     # policy_op draws from the global generator
+    rng = random.Random(3)
+    individuals = [policy_op.gen_individual_ack() for i in range(0, 60)]
+    feature = surrogate.feature_index[("action", 6, 1, 1)]
+
+    def true_score(ind):
+        return float(surrogate.policy_set_features(ind)[feature])
+
+    model = surrogate.Surrogate(min_train=20)
+    model.observe([Scored(ind, true_score(ind)) for ind in individuals[0:30]])
+    predicted = model.predict(individuals[30:])
+    model.observe([Scored(ind, true_score(ind)) for ind in individuals[30:]], predicted)
+    assert model.correlation() > 0.5 and model.enabled()
+    # restored from the plain state of a checkpoint
+    restored = surrogate.Surrogate.from_state(pickle.loads(pickle.dumps(model.state())))
+    assert np.allclose(restored.predict(individuals[0:10]), model.predict(individuals[0:10]))
+    assert restored.stats() == model.stats()
+
+    # fitness unrelated to the features: the rank correlation drops and screening stops
+    noisy = surrogate.Surrogate(min_train=20, window=300)
+    noisy.observe([Scored(ind, rng.random()) for ind in individuals[0:30]])
+    for i in range(0, 10):
+        batch = [policy_op.gen_individual_ack() for j in range(0, 30)]
+        predicted = noisy.predict(batch)
+        noisy.observe([Scored(ind, rng.random()) for ind in batch], predicted)
+    assert not noisy.enabled()
+
+
+def start_broker_worker(address, *stub_args):
+    return subprocess.Popen([sys.executable, os.path.abspath(broker.__file__), "worker", "%s:%d" % address,
+                             "--heartbeat", "0.2", "--retry", "0.2",
+                             "--sim-worker", " ".join([sys.executable, STUB, "--noise", "0"] + list(stub_args))],
+                            stdout=subprocess.DEVNULL)
+
+
+def test_broker_requeues_jobs_of_dead_workers():
+    job_broker = broker.Broker("127.0.0.1", 0, n_simulation=5, heartbeat_timeout=2.0)
+    slow = start_broker_worker(job_broker.address, "--delay", "0.5")
+    workers = [slow]
+    try:
+        policy_set = [[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]]
+        # identical candidates in flight are simulated once
+        futures = [job_broker.submit(policy_set) for i in range(0, 3)]
+        assert len(set(id(future) for future in futures)) == 1
+
+        # the slow worker takes the job and dies, a new worker finishes it
+        deadline = time.monotonic() + 10
+        while job_broker.stats()["running"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        slow.kill()
+        workers.append(start_broker_worker(job_broker.address))
+        fitness = futures[0].result(timeout=20)
+        assert 0.0 <= fitness[0] <= 100.0
+        # replications and variance cross the wire
+        assert isinstance(fitness, racing.SimFitness) and fitness.n_simulation == 5 and fitness.variance == 0.0
+        assert job_broker.stats()["requeued"] >= 1
+
+        fitnesses = job_broker.map(job_broker.evaluate, [policy_set * i for i in range(1, 5)])
+        assert len(set(fitnesses)) == 1
+    finally:
+        job_broker.close()
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+
+
+def test_broker_requires_token_on_public_interface():
+    try:
+        broker.Broker("0.0.0.0", 0)
+        assert False, "no error"
+    except ValueError:
+        pass
+    job_broker = broker.Broker("127.0.0.1", 0, n_simulation=7, token="secret")
+    try:
+        future = job_broker.submit([[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]])
+
+        def evaluate(policies, n_simulation):
+            return racing.SimFitness((42.0,), n_simulation, variance=1.5)
+
+        # without or with a wrong token the connection is closed before any job is handed out
+        assert broker.run_worker(job_broker.address, evaluate, max_jobs=1) == 0
+        assert broker.run_worker(job_broker.address, evaluate, max_jobs=1, token="guess") == 0
+        assert not future.done()
+        assert broker.run_worker(job_broker.address, evaluate, max_jobs=1, token="secret") == 1
+        fitness = future.result(timeout=10)
+        assert fitness == (42.0,) and fitness.n_simulation == 7 and fitness.variance == 1.5
+    finally:
+        job_broker.close()
+
+
+class FakeWorker:
+    # stands in for a worker connection (BrokerHandler)
+    def __init__(self, name):
+        self.name = name
+
+
+def test_broker_fails_job_after_losing_max_attempts_workers():
+    job_broker = broker.Broker("127.0.0.1", 0, heartbeat_timeout=60.0, max_attempts=2)
+    try:
+        future = job_broker.submit([[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]])
+        for attempt in range(0, 2):
+            worker = FakeWorker("worker-%d" % attempt)
+            job_broker.connected(worker)
+            assert job_broker.next_job(worker, wait=0).attempts == attempt + 1
+            job_broker.disconnected(worker)
+        try:
+            future.result(timeout=0)
+            assert False, "the job did not fail"
+        except sim_worker.SimulatorError:
+            pass
+        stats = job_broker.stats()
+        assert stats["requeued"] == 1 and stats["failed"] == 1 and stats["queued"] == 0 and stats["running"] == 0
+    finally:
+        job_broker.close()
+
+
+def test_migration_replaces_worst_of_next_island():
+    policy = [1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]
+    populations = [[Scored([policy] * (10 * k + i + 1), 10 * k + i) for i in range(0, 5)] for k in range(0, 3)]
+    targets = islands.migrate(populations, 2, lambda ind: Scored(list(ind), ind.fitness.values[0]), "ring",
+                              key=lambda ind: ind.fitness.values[0])
+    assert targets == [1, 2, 0]
+    # every island gets the two best of the previous one in place of its two worst
+    assert sorted(ind.fitness.values[0] for ind in populations[0]) == [2, 3, 4, 23, 24]
+    assert sorted(ind.fitness.values[0] for ind in populations[1]) == [3, 4, 12, 13, 14]
+    assert sorted(ind.fitness.values[0] for ind in populations[2]) == [13, 14, 22, 23, 24]
+    targets = islands.migration_targets(5, "random")
+    assert sorted(targets) == list(range(0, 5)) and all(t != i for i, t in enumerate(targets))
+
+
+def test_hall_of_fame_keeps_top_unique_individuals():
+    policy = [1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]
+    rng = random.Random(5)
+    values = [rng.random() for i in range(0, 50)]
+    # every genotype appears four times
+    individuals = [Scored([policy] * (i % 50 + 1), values[i % 50]) for i in range(0, 200)]
+    best = hall_of_fame.HallOfFame(5, key=lambda ind: ind.fitness.values[0], clone=lambda ind: ind)
+    best.update(individuals)
+    expected = sorted(values, reverse=True)[0:5]
+    assert [ind.fitness.values[0] for ind in best] == expected
+    assert best.best().fitness.values[0] == expected[0] and len(best) == 5
+
+
+def test_sim_log_sink_rotates_and_compresses(tmp_path):
+    filename = str(tmp_path / "simulation.log")
+    sink = sim_log.SimLogSink(filename, max_bytes=2000, backups=2)
+    for i in range(0, 100):
+        sink.capture("=== candidate %d" % i, b"replication line\n" * 5, "summary %d" % i)
+    sink.capture("=== last", "", "summary")
+    sink.close()
+    assert sorted(os.listdir(str(tmp_path))) == ["simulation.log", "simulation.log.1.gz", "simulation.log.2.gz"]
+    with gzip.open(filename + ".1.gz", 'rt') as f:
+        text = f.read()
+    assert text.startswith("=== candidate") and "replication line" in text
+    with open(filename) as f:
+        assert f.read().endswith("=== last\n")
+
+    summary = sim_log.SimLogSink(filename + ".summary", level="summary")
+    summary.capture("=== candidate", b"a\nb\n", "one line")
+    summary.close()
+    with open(filename + ".summary") as f:
+        assert f.read() == "one line\n"
+
+
+def test_sim_result_binary_record_and_text_fallback(tmp_path):
+    directory = str(tmp_path)
+    values = [61.0, 63.5, 59.25, 64.0]
+    sim_result.write_result(os.path.join(directory, sim_result.RESULT_BIN), values, [0.5] * 4)
+    mapped, timings = sim_result.map_result(os.path.join(directory, sim_result.RESULT_BIN))
+    assert list(mapped) == values and float(np.sum(timings)) == 2.0
+    del mapped, timings
+    summary = sim_result.read_result(directory, 50)
+    assert summary.n == 4 and summary.mean == np.mean(values)
+    assert abs(summary.variance - np.var(values, ddof=1)) < 1e-12 and 0 < summary.half_width < 10
+
+    # the stub called like the jar writes both files
+    sim_result.remove_results(directory)
+    candidate = os.path.join(directory, "cand.json")
+    with open(candidate, 'w') as f:
+        f.write(json_handle.policy_set_json([[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]]))
+    subprocess.run([sys.executable, STUB, candidate, "20", "--binary"], cwd=directory, check=True)
+    summary = sim_result.read_result(directory, 20)
+    with open(os.path.join(directory, sim_result.RESULT_TXT)) as f:
+        assert abs(float(f.read()) - summary.mean) < 1e-9
+    assert summary.n == 20 and summary.variance > 0
+
+    # without the binary record only the mean is known
+    os.remove(os.path.join(directory, sim_result.RESULT_BIN))
+    text_summary = sim_result.read_result(directory, 20)
+    assert abs(text_summary.mean - summary.mean) < 1e-9 and text_summary.variance != text_summary.variance
+
+
+def test_candidate_store_writes_once_and_collects(tmp_path):
+    store = candidate_store.CandidateStore(str(tmp_path), max_age=100.0, max_bytes=None, grace=0.0)
+    policy_set = [[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]]
+    key, path = store.put(policy_set)
+    assert store.put([list(policy) for policy in policy_set]) == (key, path)
+    assert store.stats()["writes"] == 1 and store.stats()["reuses"] == 1
+    with open(path) as f:
+        assert f.read() == json_handle.policy_set_json(policy_set)
+    other, other_path = store.put(policy_set * 2)
+    store.release(other)
+
+    # referenced entries survive, the others are removed when they are too old
+    assert store.gc(now=time.time() + 1000) == 1
+    assert os.path.exists(path) and not os.path.exists(other_path)
+    store.release(key)
+    store.release(key)
+    assert store.gc() == 0
+    assert store.gc(now=time.time() + 1000) == 1 and os.listdir(str(tmp_path)) == []
+
+    # over the size limit the least recently used entries go first
+    store.max_bytes = 1
+    store.max_age = 1000.0
+    for n in range(1, 4):
+        store.release(store.put(policy_set * n)[0])
+        time.sleep(0.01)
+    newest = store.path(store.put(policy_set * 4)[0])
+    assert store.gc() == 3 and os.listdir(str(tmp_path)) == [os.path.basename(newest)]
+
+
+def test_policy_types_are_interned_and_hashable():
+    random.seed(4)
+    individual = policy_op.gen_individual_ack()
+    frozen = policy_types.freeze(individual)
+    again = policy_types.freeze([list(policy) for policy in individual])
+    assert frozen == again and hash(frozen) == hash(again) and frozen is not again
+    assert all(a is b for a, b in zip(frozen, again))
+    assert frozen.to_list() == individual and policy_types.thaw(frozen) == individual
+    assert json_handle.policy_set_json(frozen) == json_handle.policy_set_json(individual)
+
+    # 1 and 1.0 are one policy, as in the fitness cache key
+    policy = [1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]
+    assert policy_types.Policy(policy) is policy_types.Policy(tuple(policy))
+    as_float = [float(v) for v in policy]
+    assert policy_types.Policy(policy) is policy_types.Policy(as_float)
+    assert policy_types.freeze([policy]) == policy_types.freeze([as_float])
+    assert fitness_cache.policy_set_key([policy]) == fitness_cache.policy_set_key([as_float])
+    other = list(policy)
+    other[16] = 0.5
+    assert policy_types.Policy(policy) is not policy_types.Policy(other)
+
+    assert pickle.loads(pickle.dumps(frozen)) == frozen
+    assert pickle.loads(pickle.dumps(frozen[0])) is frozen[0]
+    assert copy.deepcopy(frozen) is frozen
+    mutated = policy_types.thaw(frozen)
+    mutated[0][16] = 0.1 if mutated[0][16] != 0.1 else 0.2
+    assert policy_types.freeze(mutated) != frozen
+
+
+def test_aligned_crossover_exchanges_blocks_of_free_genes():
+    random.seed(5)
+    skeleton = policy_op.get_skeleton("multi")
+    free = set(skeleton.free_positions)
+    for mode in ("uniform", "role", "action"):
+        cx = crossover.AlignedCrossover(skeleton, mode, rng=np.random.default_rng(5))
+        parent1, parent2 = skeleton.new_individual(), skeleton.new_individual()
+        swapped = set()
+        while not swapped:     # with 3 role blocks nothing may be exchanged
+            child1, child2 = [list(policy) for policy in parent1], [list(policy) for policy in parent2]
+            cx(child1, child2)
+            for p in range(0, len(skeleton)):
+                for g in range(0, 18):
+                    assert sorted([child1[p][g], child2[p][g]]) == sorted([parent1[p][g], parent2[p][g]])
+                    if parent1[p][g] != parent2[p][g] and child1[p][g] == parent2[p][g]:
+                        assert (p, g) in free
+                        swapped.add((p, g))
+        # a block is exchanged completely or not at all
+        blocks = {cx.gene_block[i] for i, pos in enumerate(skeleton.free_positions) if pos in swapped}
+        for i, pos in enumerate(skeleton.free_positions):
+            if cx.gene_block[i] in blocks and parent1[pos[0]][pos[1]] != parent2[pos[0]][pos[1]]:
+                assert pos in swapped
+        if mode == "role":
+            assert cx.n_blocks == 3
+
+    # other skeletons are crossed over as before
+    short1, short2 = policy_op.gen_individual(5), policy_op.gen_individual(7)
+    cx(short1, short2)
+    assert cx.n_fallback == 1 and len(short1) + len(short2) == 12
+
+
+def mutation_counts(parent, children):
+    # changes per gene over all children, and the new compliance values
+    changes = [0] * 18
+    compliance = dict()
+    last = 0
+    for child in children:
+        for p, (old, new) in enumerate(zip(parent, child)):
+            for g in range(0, 18):
+                if old[g] != new[g]:
+                    changes[g] += 1
+                    last += p == len(parent) - 1
+                    if g == 16:
+                        compliance[new[g]] = compliance.get(new[g], 0) + 1
+    return changes, compliance, last
+
+
+def test_batch_mutation_matches_scalar_distribution():
+    random.seed(6)
+    n = 300
+    for type_SoS in ("A", "D", "multi"):
+        skeleton = policy_op.get_skeleton(type_SoS)
+        parent = skeleton.new_individual()
+        scalar = [[list(policy) for policy in parent] for i in range(0, n)]
+        for child in scalar:
+            mutation.SCALAR_MUTATION[type_SoS](child, 0.5)
+        engine = mutation.BatchMutation(skeleton, type_SoS, rng=np.random.default_rng(6))
+        batch = engine.mutate([[list(policy) for policy in parent] for i in range(0, n)])
+
+        scalar_changes, scalar_compliance, scalar_last = mutation_counts(parent, scalar)
+        batch_changes, batch_compliance, batch_last = mutation_counts(parent, batch)
+        for g in range(0, 18):
+            # counts are roughly Poisson: within 4 standard deviations of their difference
+            bound = 4 * (scalar_changes[g] + batch_changes[g]) ** 0.5 + 5
+            assert abs(scalar_changes[g] - batch_changes[g]) <= bound, (type_SoS, g)
+        total = float(sum(scalar_compliance.values()) or 1)
+        for value in policy_op.value_map[16]:
+            assert abs(scalar_compliance.get(value, 0) - batch_compliance.get(value, 0)) / total < 0.03
+        # the last policy is mutated as well (it never was before)
+        assert scalar_last > 0 and batch_last > 0
+        # the values keep the types of the scalar operator, e.g. for the candidate files
+        assert json_handle.policy_set_json(batch[0]).count(".") == json_handle.policy_set_json(parent).count(".")
+
+        # the array form gets exactly the same edits
+        genes = policy_array.population_to_array([parent] * 5)
+        children = [copy.deepcopy(parent) for i in range(0, 5)]
+        edits = engine.draw(5)
+        mutation.apply_edits(children, edits)
+        engine.mutate_array(genes, edits)
+        assert policy_array.array_to_population(genes) == children
+
+
+def test_skeleton_keeps_compliance_structure_of_generators():
+    random.seed(7)
+    n_compliance = sum(len(policy_op.role_action_map[role]) for role in policy_op.value_map[5])
+    for type_SoS in ("A", "multi"):
+        skeleton = policy_op.get_skeleton(type_SoS)
+        individual = skeleton.new_individual()
+        compliance = [policy for policy in individual if policy[0] == 2]
+        # one policy per (role, action), appended once per MCI level: the copies are one object
+        assert len(compliance) == n_compliance * len(policy_op.value_map[1])
+        assert len({id(policy) for policy in compliance}) == n_compliance
+        for k in range(0, n_compliance):
+            group = compliance[k * 5:k * 5 + 5]
+            assert all(policy is group[0] for policy in group) and group[0][1] == policy_op.value_map[1][-1]
+        assert sum(1 for p, g in skeleton.free_positions if g == 16) == n_compliance
+
+        # the array form keeps the copies equal, also when they are mutated
+        genes = policy_array.SkeletonArray(skeleton).new_population(20, np.random.default_rng(7))
+        for p, source in skeleton.aliases:
+            assert np.array_equal(genes[:, p], genes[:, source])
+        engine = mutation.BatchMutation(skeleton, type_SoS, rng=np.random.default_rng(7))
+        engine.mutate_array(genes)
+        for p, source in skeleton.aliases:
+            assert np.array_equal(genes[:, p], genes[:, source])
+
+        # and so does a checkpoint
+        import main
+        packed = pickle.loads(pickle.dumps(pack_individuals([main.creator.Individual(individual)])))
+        restored = unpack_individuals(packed, main.creator.Individual)[0]
+        assert restored == individual
+        assert len({id(policy) for policy in restored if policy[0] == 2}) == n_compliance
+    assert not policy_op.get_skeleton("D").aliases
+
+
+class Interrupted(Exception):
+    pass
+
+
+def run_ga(directory, crash_after=None, resume=False, **options):
+    # a short generational run in directory with a deterministic in-process evaluator;
+    # returns the sorted (fitness, variance, policies) of the result, the number of evaluations
+    # and the crossover statistics of the last checkpoint
+    import main
+    os.makedirs(os.path.join(directory, "json"), exist_ok=True)
+    cwd = os.getcwd()
+    registered = dict(main.toolbox.__dict__)
+    n_evals = [0]
+
+    def evaluate(indiv_poli_set, file_num=0, gen_num=0, n_simulation=50):
+        if crash_after is not None and n_evals[0] >= crash_after:
+            raise Interrupted()
+        n_evals[0] += 1
+        value = 100.0 * sum(sim_stub.policy_score(policy) for policy in indiv_poli_set) / len(indiv_poli_set)
+        return racing.SimFitness((value,), n_simulation, variance=value / 10.0)
+
+    os.chdir(directory)
+    try:
+        main.toolbox.register("evaluate", evaluate)
+        random.seed(0)
+        population = main.main("A", cache_file=None, checkpoint_file=os.path.join("json", "checkpoint.pkl.gz"),
+                               checkpoint_evals=True, resume=resume, n_generations=4, **options)
+    finally:
+        os.chdir(cwd)
+        main.toolbox.__dict__.clear()
+        main.toolbox.__dict__.update(registered)
+    stats = load_checkpoint(os.path.join(directory, "json", "checkpoint.pkl.gz"))["crossover"]
+    return (sorted((ind.fitness.values[0], ind.variance, [list(policy) for policy in ind]) for ind in population),
+            n_evals[0], stats)
+
+
+def test_resume_with_batch_operators_matches_uninterrupted_run(tmp_path):
+    options = {"crossover_mode": "uniform", "batch_mutation": True}
+    expected, n_evals, expected_stats = run_ga(str(tmp_path / "full"), **options)
+    interrupted = str(tmp_path / "interrupted")
+    try:
+        run_ga(interrupted, crash_after=n_evals * 2 // 3, **options)
+        assert False, "the run was not interrupted"
+    except Interrupted:
+        pass
+    resumed, n_resumed, resumed_stats = run_ga(interrupted, resume=True, **options)
+    assert resumed == expected
+    assert resumed_stats == expected_stats
+    assert n_resumed == n_evals - n_evals * 2 // 3     # nothing is simulated twice
+
+
+def test_resume_after_interruption_matches_uninterrupted_run(tmp_path):
+    # default operators; interrupted in the middle of a generation, some offspring evaluated
+    expected, n_evals, expected_stats = run_ga(str(tmp_path / "full"))
+    assert len(expected) == 21      # the last population and the best individual, as before
+    interrupted = str(tmp_path / "interrupted")
+    crash_after = n_evals // 2 + 3
+    try:
+        run_ga(interrupted, crash_after=crash_after)
+        assert False, "the run was not interrupted"
+    except Interrupted:
+        pass
+    state = load_checkpoint(os.path.join(interrupted, "json", "checkpoint.pkl.gz"))
+    assert state["phase"] == "evaluating" and state["done"]
+
+    def plain(value):
+        # no DEAP or framework classes: the checkpoint survives changes of those classes
+        if isinstance(value, dict):
+            return all(plain(k) and plain(v) for k, v in value.items())
+        if type(value) in (list, tuple):
+            return all(plain(v) for v in value)
+        return value is None or type(value) in (str, int, float, bool)
+    assert plain(state)
+    resumed, n_resumed, resumed_stats = run_ga(interrupted, resume=True)
+    assert resumed == expected
+    assert all(variance is not None for fitness, variance, policies in resumed)
+    assert resumed_stats == expected_stats and resumed_stats["n_evaluated"] > 0
+    assert n_resumed == n_evals - crash_after
+
+
+def test_interrupted_run_releases_resources(tmp_path):
+    import main
+    os.makedirs(str(tmp_path / "json"))
+    cwd = os.getcwd()
+    registered = dict(main.toolbox.__dict__)
+    closed = list()
+
+    def evaluate(indiv_poli_set, file_num=0, gen_num=0, n_simulation=50):
+        sim_log.get_log_sink()      # the log sink is open while simulating
+        raise KeyboardInterrupt()
+
+    class Cache(fitness_cache.FitnessCache):
+        def close(self):
+            closed.append(self)
+            fitness_cache.FitnessCache.close(self)
+
+    os.chdir(str(tmp_path))
+    try:
+        main.toolbox.register("evaluate", evaluate)
+        before = dict(main.toolbox.__dict__)
+        main.FitnessCache, original = Cache, main.FitnessCache
+        try:
+            main.main("A", cache_file=os.path.join("json", "cache.db"), crossover_mode="uniform", n_generations=1)
+            assert False, "the run was not interrupted"
+        except KeyboardInterrupt:
+            pass
+        finally:
+            main.FitnessCache = original
+        # operators and evaluation backend as before the run, log and cache closed
+        assert main.toolbox.__dict__ == before
+        assert sim_log.log_sink is None
+        assert len(closed) == 1 and closed[0].db is None
+    finally:
+        os.chdir(cwd)
+        main.toolbox.__dict__.clear()
+        main.toolbox.__dict__.update(registered)
+
+
+def test_policy_eval_reports_missing_result(tmp_path):
+    import policy_eval
+    log_config = dict(sim_log.log_config)
+    store_config = dict(candidate_store.store_config)
+    command, work_dir = policy_eval.SIMUL_CMD, policy_eval.work_dir
+    sim_log.configure_log(filename=str(tmp_path / "simulation.log"))
+    candidate_store.configure_store(directory=str(tmp_path / "candidates"))
+    policy_eval.work_dir = str(tmp_path)
+    policy_set = [[1, 1, -1, 1, -1, 1, 2, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0]]
+    try:
+        # the stub in jar mode: every replication in Sim_Result.bin
+        policy_eval.SIMUL_CMD = [sys.executable, STUB, "--binary"]
+        fitness = policy_eval.evaluate(policy_set, 3, 1, n_simulation=10)
+        assert fitness.n_simulation == 10 and fitness.variance > 0.0
+        sim_log.close_log()
+        with open(str(tmp_path / "simulation.log")) as f:
+            summary = [line for line in f if line.startswith("=== ")][0].split()
+        # one whitespace-separated field per label
+        assert summary[1].startswith("1_cand_poli_set3_") and summary[1].endswith(".json")
+        assert summary[2] == "n=10"
+
+        # a simulator which writes no result: a clear error, not FileNotFoundError
+        policy_eval.SIMUL_CMD = [sys.executable, "-c", "import sys; print('out of memory'); sys.exit(1)"]
+        try:
+            policy_eval.evaluate(policy_set, 4, 1, n_simulation=10)
+            assert False, "no error"
+        except sim_worker.SimulatorError as e:
+            message = str(e)
+            assert str(tmp_path / "candidates") in message     # the candidate file
+            assert "exit status 1" in message and "out of memory" in message
+    finally:
+        policy_eval.SIMUL_CMD, policy_eval.work_dir = command, work_dir
+        sim_log.configure_log(**log_config)
+        candidate_store.configure_store(**store_config)
+
+
+def test_worker_logs_are_merged_and_removed(tmp_path):
+    import policy_eval
+    log_config = dict(sim_log.log_config)
+    base = tmp_path / "workers"
+    shared = tmp_path / "json"
+    shared.mkdir()
+    for pid, blocks in (("101", ["oldest\n", "older\n", "newest\n"]), ("202", ["other\n"])):
+        work = base / pid
+        work.mkdir(parents=True)
+        os.symlink(str(shared), str(work / "json"))
+        for i, block in enumerate(reversed(blocks[0:-1])):
+            with gzip.open(str(work / ("simulation.log.%d.gz" % (i + 1))), 'wt') as f:
+                f.write(block)
+        with open(str(work / "simulation.log"), 'w') as f:
+            f.write(blocks[-1])
+    sim_log.configure_log(filename=str(tmp_path / "simulation.log"))
+    try:
+        with open(str(tmp_path / "simulation.log"), 'w') as f:
+            f.write("main\n")
+        policy_eval.collect_workers(str(base))
+        sim_log.close_log()
+        with open(str(tmp_path / "simulation.log")) as f:
+            assert f.read() == "main\noldest\nolder\nnewest\nother\n"
+        # the worker directories are gone, not the directory their json link points to
+        assert not base.exists() and shared.is_dir()
+        policy_eval.collect_workers(str(base))
+    finally:
+        sim_log.configure_log(**log_config)